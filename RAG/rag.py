@@ -1,8 +1,14 @@
 # RAG function from langchain
 
 import os
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
 from dotenv import load_dotenv
 
+from Simulated.simulated_patient.tracing import span
+
 from RAG.helper_functions import (  # 需在你的 helper_functions 中提供这些对象
     RecursiveCharacterTextSplitter,
     OpenAIEmbeddings,
@@ -10,8 +16,37 @@ from RAG.helper_functions import (  # 需在你的 helper_functions 中提供这
     retrieve_context_per_question,
 )
 
+# 每个病例的向量库只构建一次，按 (resource 哈希, chunk size, overlap, embedding 模型) 复用，
+# 超过 RAG_CACHE_SIZE 个病例后淘汰最久未用的
+RAG_CACHE_SIZE = int(os.getenv("RAG_CACHE_SIZE", "16"))
+_vector_stores = OrderedDict()
+_build_locks = {}
+_cache_lock = threading.Lock()
+_embeddings = None
+# OpenAIEmbeddings 未显式配置地址时使用的默认地址（与 openai SDK 一致）
+OPENAI_DEFAULT_BASE = "https://api.openai.com/v1"
+
+
+def get_embeddings():
+    global _embeddings
+    with _cache_lock:
+        if _embeddings is None:
+            # 从 .env 读取环境变量（不在代码中写入密钥）
+            load_dotenv()
+            if not os.getenv("OPENAI_API_KEY"):
+                raise RuntimeError("未检测到 OPENAI_API_KEY，请在环境或 .env 中设置")
+            _embeddings = OpenAIEmbeddings()  # 从环境变量读取 OPENAI_API_KEY / OPENAI_API_BASE
+    return _embeddings
+
+
+def embedding_endpoint(embeddings=None):
+    """向量库所用的 (embedding 模型, 接口地址)；同名模型在不同服务上的向量不能混用。"""
+    embeddings = embeddings or get_embeddings()
+    base_url = getattr(embeddings, "openai_api_base", None) or os.getenv("OPENAI_BASE_URL") or OPENAI_DEFAULT_BASE
+    return embeddings.model, str(base_url).rstrip("/")
 
-def encode_from_string(content: str, chunk_size: int, chunk_overlap: int):
+
+def encode_from_string(content: str, chunk_size: int, chunk_overlap: int, embeddings=None):
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=chunk_size,
         chunk_overlap=chunk_overlap,
@@ -23,22 +58,55 @@ def encode_from_string(content: str, chunk_size: int, chunk_overlap: int):
     for chunk in chunks:
         chunk.metadata["relevance_score"] = 1.0
 
-    embeddings = OpenAIEmbeddings()  # 从环境变量读取 OPENAI_API_KEY / OPENAI_API_BASE
+    embeddings = embeddings or get_embeddings()
     vectorstore = FAISS.from_documents(chunks, embeddings)
     return vectorstore
 
 
-def rag_patient(question: str, resource: str, size: int, overlap: int, top_k: int) -> str:
-    # 从 .env 读取环境变量（不在代码中写入密钥）
-    load_dotenv()
-    if not os.getenv("OPENAI_API_KEY"):
-        raise RuntimeError("未检测到 OPENAI_API_KEY，请在环境或 .env 中设置")
+def get_vector_store(content: str, chunk_size: int, chunk_overlap: int):
+    """返回病例文本对应的向量库；首次调用时构建，之后直接复用。"""
+    embeddings = get_embeddings()
+    key = (hashlib.sha256(content.encode("utf-8")).hexdigest(), chunk_size, chunk_overlap, embeddings.model)
+
+    with _cache_lock:
+        if key in _vector_stores:
+            _vector_stores.move_to_end(key)
+            return _vector_stores[key]
+        build_lock = _build_locks.setdefault(key, threading.Lock())
+
+    # 同一病例并发请求时只构建一次
+    with build_lock:
+        with _cache_lock:
+            if key in _vector_stores:
+                return _vector_stores[key]
+        with span("rag.build", "rag", chars=len(content)):
+            vectorstore = encode_from_string(content, chunk_size, chunk_overlap, embeddings)
+        with _cache_lock:
+            _vector_stores[key] = vectorstore
+            _build_locks.pop(key, None)
+            while len(_vector_stores) > RAG_CACHE_SIZE:
+                _vector_stores.popitem(last=False)
+    return vectorstore
+
 
+def rag_patient(question: str, resource: str, size: int, overlap: int, top_k: int,
+                query_embedding=None, query_endpoint=None) -> str:
+    """query_embedding 为调用方已算好的问题向量（可为 Future，建库完成后再取），query_endpoint 为算出它的
+    (模型, 接口地址)；仅当与向量库的 embedding_endpoint() 一致时才复用，否则由检索器自行向量化。"""
     content = resource
-    chunks_vector_store = encode_from_string(content, chunk_size=size, chunk_overlap=overlap)
-    chunks_query_retriever = chunks_vector_store.as_retriever(search_kwargs={"k": top_k})
+    chunks_vector_store = get_vector_store(content, chunk_size=size, chunk_overlap=overlap)
 
-    context = retrieve_context_per_question(question, chunks_query_retriever)
+    if query_embedding is not None and query_endpoint == embedding_endpoint():
+        if isinstance(query_embedding, Future):
+            query_embedding = query_embedding.result()
+        with span("rag.search", "rag"):
+            docs = chunks_vector_store.similarity_search_by_vector(list(query_embedding), k=top_k)
+        context = [doc.page_content for doc in docs]
+    else:
+        # 检索器内部会先请求问题向量，计入 rag.search
+        with span("rag.search", "rag"):
+            chunks_query_retriever = chunks_vector_store.as_retriever(search_kwargs={"k": top_k})
+            context = retrieve_context_per_question(question, chunks_query_retriever)
 
     rag_info = "".join(context)
     return rag_info
@@ -23,7 +23,7 @@ def summary(patient_question: str, doctor_answer: str):
     prompt = prompt_template.format(chatstream=memory_stream)
 
     messages = [{"role": "user", "content": prompt}]
-    memory_summary = llm_api(messages)
+    memory_summary = llm_api(messages, prompt_key="summary_memory")
 
     MEMORY_FILE.write_text(memory_summary, encoding="utf-8")
     print("✅ 已更新记忆摘要。")
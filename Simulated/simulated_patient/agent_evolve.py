@@ -1,23 +1,27 @@
-import os
 import numpy as np
 import csv
-import json
+import threading
 from pathlib import Path
-from Simulated.simulated_patient.api_call import llm_api
-from openai import OpenAI
+# 向量接口带批量请求与持久化缓存，同一文本在整个运行期间只请求一次
+from Simulated.simulated_patient.api_call import llm_api, get_text_embedding, get_text_embeddings
+# 检索与写入都走二进制存储（float32 .npy + 元数据），CSV 仅作为可读的镜像保留
+from Simulated.simulated_patient.evolve_store import open_store, row_key
+from Simulated.simulated_patient.case_context import load_prompts
+from Simulated.simulated_patient.tracing import traced
 
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-BASE_URL = os.getenv("BASE_URL")
 
-if not OPENAI_API_KEY:
-    raise RuntimeError("未设置环境变量 OPENAI_API_KEY")
+_path_locks = {}
+_path_locks_lock = threading.Lock()
 
-client_kwargs = {"api_key": OPENAI_API_KEY}
-if BASE_URL:
-    client_kwargs["base_url"] = BASE_URL
-client = OpenAI(**client_kwargs)
 
+def evolve_lock(directory) -> threading.Lock:
+    """同一进化记忆文件的锁：查重、写入存储与 CSV 镜像必须在同一把锁内完成（多个后台线程 / 病例并发写）。"""
+    key = Path(directory).resolve()
+    with _path_locks_lock:
+        return _path_locks.setdefault(key, threading.Lock())
 
+
+@traced("csv.write", "io")
 def write_to_csv(
     directory,
     embedding_res,
@@ -31,14 +35,8 @@ def write_to_csv(
     embedding_res_str = ",".join(map(str, embedding_res))
     data_to_write = [embedding_res_str, question, rag_info, answer, requirements]
 
-    if directory.is_file() and not write_header:
-        with directory.open("r", newline="", encoding="gbk") as file:
-            reader = csv.reader(file)
-            _ = next(reader, None)
-            for row in reader:
-                if row and row[0] == embedding_res_str:
-                    return
-    else:
+    # 重复检测由存储的行 id 索引负责，这里只做追加
+    if write_header or not directory.is_file():
         with directory.open("w", newline="", encoding="gbk") as file:
             writer = csv.writer(file)
             writer.writerow(["qus_embedding", "question", "rag_info", "answer", "requirements"])
@@ -48,20 +46,14 @@ def write_to_csv(
         writer.writerow(data_to_write)
 
 
+@traced("csv.write", "io")
 def write_csv(directory, qus_1, emb_1, emb_2, ans_1, rag_1, qus_2, ans_2, rag_2, write_header=False):
     directory = Path(directory)
     embedding_res_str1 = ",".join(map(str, emb_1))
     embedding_res_str2 = ",".join(map(str, emb_2))
     data_to_write = [qus_1, embedding_res_str1, rag_1, ans_1, embedding_res_str2, qus_2, ans_2, rag_2]
 
-    if directory.is_file() and not write_header:
-        with directory.open("r", newline="", encoding="gbk") as file:
-            reader = csv.reader(file)
-            _ = next(reader, None)
-            for row in reader:
-                if row and row[0] == embedding_res_str1:
-                    return
-    else:
+    if write_header or not directory.is_file():
         with directory.open("w", newline="", encoding="gbk") as file:
             writer = csv.writer(file)
             writer.writerow(
@@ -73,14 +65,6 @@ def write_csv(directory, qus_1, emb_1, emb_2, ans_1, rag_1, qus_2, ans_2, rag_2,
         writer.writerow(data_to_write)
 
 
-def get_text_embedding(text: str):
-    text = text or "None"
-    return client.embeddings.create(
-        input=text,
-        model="text-embedding-ada-002",
-    ).model_dump()["data"][0]["embedding"]
-
-
 def read_qus_embedding_from_csv(directory):
     directory = Path(directory)
     qus_embedding_list = []
@@ -115,96 +99,81 @@ def get_cosine_similarity(embeddingi, embeddingj):
 
 
 def quality_check(question, rag_info, answer):
-    json_file_path = Path("Simulated/Prompt/prompt_data.json")  # 相对路径
-    with json_file_path.open("r", encoding="utf-8") as file:
-        data = json.load(file)
-        prompt = "".join(data["quality_check_evolve"])
+    prompt = load_prompts()["quality_check_evolve"]
     prompt.format(question=question, infomation=rag_info, answer=answer)
     messages = [{"role": "user", "content": prompt}]
-    return llm_api(messages)
+    return llm_api(messages, prompt_key="quality_check_evolve")
 
 
+@traced("evolve.store", "evolve")
 def store_patient_qa(directory, question, rag_info, answer, requirements):
+    store = open_store(directory)
+    key = row_key(question, answer)
+    if key in store:
+        return
+    # 请求向量不持锁；查重与写入在锁内重新检查，避免并发写入重复的行
     embedding_res = get_text_embedding(question)
-    qus_embedding_list = read_qus_embedding_from_csv(directory)
-    evolve_flag = 1
-    for stored_qus_embedding in qus_embedding_list:
-        stored_qus_embedding = [float(item.strip()) for item in stored_qus_embedding.split(",")]
-        if get_cosine_similarity(stored_qus_embedding, embedding_res) > 0.95:
+    with evolve_lock(directory):
+        # 近似重复只在向量索引上检测
+        if key in store or store.any_similar({"qus_embedding": embedding_res}, 0.95):
             print("此条问答已有相似例子，取消进化。")
-            evolve_flag = 0
-            break
-    if evolve_flag:
+            return
+        store.append(
+            {"qus_embedding": embedding_res},
+            {"question": question, "rag_info": rag_info, "answer": answer, "requirements": requirements},
+        )
         write_to_csv(directory, embedding_res, question, rag_info, answer, requirements)
 
 
+@traced("evolve.store", "evolve")
 def store_doctor_qa(directory, record):
     qus_1, ans_1, rag_1, qus_2, ans_2, rag_2 = record
-    qus_1_emb = get_text_embedding(qus_1)
-    qus_2_emb = get_text_embedding(qus_2)
-    qus1_embedding_list, qus2_embedding_list = read_qus_embedding_doctor(directory)
-    evolve_flag = 1
-    for stored_qus1_embedding, stored_qus2_embedding in zip(qus1_embedding_list, qus2_embedding_list):
-        stored_qus1_embedding = [float(item.strip()) for item in stored_qus1_embedding.split(",")]
-        stored_qus2_embedding = [float(item.strip()) for item in stored_qus2_embedding.split(",")]
-        if get_cosine_similarity(stored_qus1_embedding, qus_1_emb) > 0.8 and get_cosine_similarity(
-            stored_qus2_embedding, qus_2_emb
-        ) > 0.8:
+    store = open_store(directory)
+    key = row_key(qus_1, ans_1, qus_2, ans_2)
+    if key in store:
+        return
+    qus_1_emb, qus_2_emb = get_text_embeddings([qus_1, qus_2])
+    with evolve_lock(directory):
+        if key in store or store.any_similar({"qus_embedding": qus_1_emb, "qus2_embedding": qus_2_emb}, 0.8):
             print("此条问答已有相似例子，取消进化。")
-            evolve_flag = 0
-            break
-    if evolve_flag:
+            return
+        store.append(
+            {"qus_embedding": qus_1_emb, "qus2_embedding": qus_2_emb},
+            {"question1": qus_1, "rag_info1": rag_1, "answer1": ans_1,
+             "question2": qus_2, "answer2": ans_2, "rag_info2": rag_2},
+        )
         write_csv(directory, qus_1, qus_1_emb, qus_2_emb, ans_1, rag_1, qus_2, ans_2, rag_2)
-        print(f"store {qus_1} + {qus_2}")
+    print(f"store {qus_1} + {qus_2}")
 
 
-def get_most_related_qus(rank_dic):
-    sorted_items = sorted(rank_dic.items(), key=lambda x: x[1], reverse=True)
-    if len(sorted_items) > 2:
-        return [item[0] for item in sorted_items[:2]]
-    elif 0 < len(sorted_items) <= 2:
-        return [item[0] for item in sorted_items[:1]]
-    else:
-        return []
+def get_most_related_qus(result):
+    """超过阈值的行多于 2 条时取前 2 条，否则取最相似的 1 条。"""
+    if result.total > 2:
+        return result.ids[:2].tolist()
+    return result.ids[:1].tolist()
 
 
-def get_evolve_info(related_qus_list, directory):
-    directory = Path(directory)
-    matched_rows_data = []
-    with directory.open(newline="", encoding="gbk") as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            if row["qus_embedding"] in related_qus_list:
-                matched_row = {header: row[header] for header in reader.fieldnames}
-                matched_rows_data.append(matched_row)
-    return matched_rows_data
+def get_evolve_info(related_row_ids, directory):
+    """按行号取回相似问答的元数据（不含向量列）。"""
+    return open_store(directory).rows(related_row_ids)
 
 
 def get_consistency(directory, qus_embedding):
-    qus_embedding_list = read_qus_embedding_from_csv(directory)
-    rank_dic = {}
-    for stored_embedding_str in qus_embedding_list:
-        stored_embedding_list = [float(item.strip()) for item in stored_embedding_str.split(",")]
-        task_question_alignment = get_cosine_similarity(stored_embedding_list, qus_embedding)
-        if task_question_alignment > 0.9:
-            rank_dic[stored_embedding_str] = task_question_alignment
-    return get_most_related_qus(rank_dic)
-
-
-def get_consistency_doctor(directory, qus_embedding, ans_embedding):
-    qus1_embedding_list, qus2_embedding_list = read_qus_embedding_doctor(directory)
-    rank_dic = {}
-    for qus_emb, ans_emb in zip(qus1_embedding_list, qus2_embedding_list):
-        qus1_emb_list = [float(item.strip()) for item in qus_emb.split(",")]
-        qus2_emb_list = [float(item.strip()) for item in ans_emb.split(",")]
-        task_question_alignment = get_cosine_similarity(qus1_emb_list, qus_embedding)
-        if task_question_alignment > 0.25:
-            rank_dic[qus_emb] = task_question_alignment
-    return get_most_related_qus(rank_dic)
-
-
-def agent_evolving_patient(directory, question):
-    qus_embedding = get_text_embedding(question)
+    """返回与问题最相似的若干行的行号。"""
+    result = open_store(directory).search("qus_embedding", qus_embedding, k=2, threshold=0.9)
+    return get_most_related_qus(result)
+
+
+def get_consistency_doctor(directory, qus_embedding, ans_embedding=None):
+    result = open_store(directory).search("qus_embedding", qus_embedding, k=2, threshold=0.25)
+    return get_most_related_qus(result)
+
+
+@traced("evolve.lookup", "evolve")
+def agent_evolving_patient(directory, question, qus_embedding=None):
+    # 调用方已有问题向量时直接复用，省去一次向量请求
+    if qus_embedding is None:
+        qus_embedding = get_text_embedding(question, prompt_key="patient_answer_generator")
     related_qus_list = get_consistency(directory, qus_embedding)
     if related_qus_list:
         return get_evolve_info(related_qus_list, directory)
@@ -212,10 +181,11 @@ def agent_evolving_patient(directory, question):
         return {}
 
 
+@traced("evolve.lookup", "evolve")
 def agent_evolving_doctor(directory, record):
-    qus_embedding = get_text_embedding(record[0])
-    ans_embedding = get_text_embedding(record[1])
-    related_qus_list = get_consistency_doctor(directory, qus_embedding, ans_embedding)
+    # 只按上一轮问题检索，回答的向量并不参与相似度计算
+    qus_embedding = get_text_embedding(record[0], prompt_key="doctor_question_info")
+    related_qus_list = get_consistency_doctor(directory, qus_embedding)
     if related_qus_list:
         return get_evolve_info(related_qus_list, directory)
     else:
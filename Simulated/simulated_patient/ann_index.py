@@ -0,0 +1,76 @@
+"""
+进化记忆的近似最近邻索引（faiss，CPU 本地构建）。
+向量在加入前已按行归一化，内积即余弦相似度。
+  EVOLVE_ANN           hnsw（默认）/ ivf / off
+  EVOLVE_ANN_MIN_ROWS  行数低于该值时仍使用精确检索，默认 20000
+  EVOLVE_HNSW_M / EVOLVE_HNSW_EF_SEARCH / EVOLVE_IVF_NPROBE  索引参数
+"""
+import os
+from pathlib import Path
+
+import numpy as np
+
+try:
+    import faiss
+except ImportError:  # faiss 为可选依赖，缺失时只做精确检索
+    faiss = None
+
+ANN_BACKEND = os.getenv("EVOLVE_ANN", "hnsw").lower()
+ANN_MIN_ROWS = int(os.getenv("EVOLVE_ANN_MIN_ROWS", "20000"))
+HNSW_M = int(os.getenv("EVOLVE_HNSW_M", "32"))
+HNSW_EF_SEARCH = int(os.getenv("EVOLVE_HNSW_EF_SEARCH", "128"))
+IVF_NPROBE = int(os.getenv("EVOLVE_IVF_NPROBE", "16"))
+
+
+def ann_available(backend=None) -> bool:
+    return faiss is not None and (backend or ANN_BACKEND) in ("hnsw", "ivf")
+
+
+class AnnIndex:
+    def __init__(self, index, backend):
+        self.index = index
+        self.backend = backend
+
+    @classmethod
+    def build(cls, matrix: np.ndarray, backend=None) -> "AnnIndex":
+        backend = backend or ANN_BACKEND
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        dim = matrix.shape[1]
+        if backend == "hnsw":
+            index = faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efSearch = HNSW_EF_SEARCH
+        elif backend == "ivf":
+            nlist = max(1, int(np.sqrt(len(matrix))))
+            index = faiss.IndexIVFFlat(faiss.IndexFlatIP(dim), dim, nlist, faiss.METRIC_INNER_PRODUCT)
+            index.train(matrix)
+            index.nprobe = IVF_NPROBE
+        else:
+            raise ValueError(f"未知的 ANN 后端：{backend}")
+        index.add(matrix)
+        return cls(index, backend)
+
+    @classmethod
+    def load(cls, path: Path, backend=None) -> "AnnIndex":
+        index = faiss.read_index(str(path))
+        if backend == "hnsw" or isinstance(index, faiss.IndexHNSWFlat):
+            index.hnsw.efSearch = HNSW_EF_SEARCH
+            backend = "hnsw"
+        else:
+            index.nprobe = IVF_NPROBE
+            backend = "ivf"
+        return cls(index, backend)
+
+    def save(self, path: Path):
+        faiss.write_index(self.index, str(path))
+
+    def __len__(self):
+        return self.index.ntotal
+
+    def add(self, rows: np.ndarray):
+        self.index.add(np.ascontiguousarray(rows, dtype=np.float32))
+
+    def search(self, query: np.ndarray, k: int):
+        """query 为已归一化的单个向量，返回 (行号数组, 相似度数组)，按相似度降序。"""
+        scores, ids = self.index.search(np.ascontiguousarray(query, dtype=np.float32)[None, :], k)
+        keep = ids[0] >= 0
+        return ids[0][keep], scores[0][keep]
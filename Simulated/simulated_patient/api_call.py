@@ -1,93 +1,450 @@
 import os
-import re
-from openai import OpenAI
+import asyncio
+import time
+import threading
 
-# ===== 从环境变量中读取配置 =====
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-BASE_URL = os.getenv("BASE_URL")  # 例如：https://ark.cn-beijing.volces.com/api/v3
+from Simulated.simulated_patient import llm_client
+from Simulated.simulated_patient.llm_cache import make_key, cache_from_env
+from Simulated.simulated_patient.token_usage import token_accounting
+from Simulated.simulated_patient import embedding_cache as emb_cache
+from Simulated.simulated_patient.tracing import span
+from Simulated.simulated_patient.rate_limit import Scheduler, priority_for, estimate_tokens, with_backoff
+from Simulated.simulated_patient.routing import route, LITE
+from Simulated.simulated_patient.single_flight import SingleFlight
+from Simulated.simulated_patient import streaming
+from Simulated.simulated_patient.hedging import (
+    LatencyTracker, CircuitBreaker, CLOSED, PROBE, DEGRADED_ERRORS, LLM_BREAKER_FAILURES,
+    timeout_for, hedged, failure_kind,
+)
 
-if not OPENAI_API_KEY:
-    raise ValueError("❌ 未找到 OPENAI_API_KEY 环境变量，请先在系统中设置。")
+# ===== 配置 =====
+# 客户端在首次请求时由 llm_client 创建，导入本模块不需要 OPENAI_API_KEY
+# 同时在途的 LLM / embedding 请求上限，同时也是 keep-alive 连接池的大小
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+# 单个 embedding 请求中最多携带的文本条数
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
 
-client_kwargs = {"api_key": OPENAI_API_KEY}
-if BASE_URL:
-    client_kwargs["base_url"] = BASE_URL
+LLM_MODEL = 'ep-20240814160016-j24nr'
+LLM_LITE_MODEL = 'ep-20240822150534-5nj65'
+EMBEDDING_MODEL = "text-embedding-ada-002"
+TEMPERATURE = 0.2
+TOP_P = 1.0
 
-client = OpenAI(**client_kwargs)
+# 各调用点的延迟分布（决定对冲时机）与主模型熔断状态（见 hedging）
+latency_tracker = LatencyTracker()
+breaker = CircuitBreaker()
+# 流式请求各调用点的首 token 耗时与所需字段完整的耗时（见 streaming）
+ttft_tracker = LatencyTracker()
+field_tracker = LatencyTracker()
+
+
+# ===== 后台事件循环 =====
+# 异步客户端与并发信号量都绑定在一个常驻后台线程的事件循环上，
+# 同步调用（任意线程）与异步调用（任意事件循环）都把请求投递到这里执行。
+_loop = None
+_loop_lock = threading.Lock()
+_scheduler = None
+_flights = None
+
+
+def _get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="llm-api-loop", daemon=True).start()
+            _loop = loop
+    return _loop
+
+
+# 响应缓存（设置 LLM_CACHE_PATH 后启用，见 llm_cache.cache_from_env）与持久化的 文本 -> 向量 缓存
+# （见 embedding_cache.cache_from_env）同客户端一样在首次使用时创建，导入本模块不会创建缓存文件；
+# 未启用时为 None
+_UNSET = object()
+_response_cache = _UNSET
+_embedding_cache = _UNSET
+_cache_lock = threading.Lock()
+
+
+def _get_response_cache():
+    global _response_cache
+    with _cache_lock:
+        if _response_cache is _UNSET:
+            _response_cache = cache_from_env()
+    return _response_cache
+
+
+def _get_embedding_cache():
+    global _embedding_cache
+    with _cache_lock:
+        if _embedding_cache is _UNSET:
+            _embedding_cache = emb_cache.cache_from_env()
+    return _embedding_cache
+
+
+def _get_scheduler():
+    # 只在后台事件循环中调用，无需加锁
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = Scheduler(LLM_MAX_CONCURRENCY)
+    return _scheduler
+
+
+def _get_flights():
+    # 同 _get_scheduler，只在后台事件循环中调用
+    global _flights
+    if _flights is None:
+        _flights = SingleFlight()
+    return _flights
+
+
+def set_max_concurrency(limit: int):
+    """调整同时在途的请求上限；应在发出第一个请求之前调用。"""
+    global LLM_MAX_CONCURRENCY, _scheduler
+    if limit < 1:
+        raise ValueError("limit 必须为正整数")
+    LLM_MAX_CONCURRENCY = limit
+    _scheduler = None
+    llm_client.set_pool_size(limit)
+
+
+def _submit(coro):
+    """把协程投递到后台事件循环，返回 concurrent.futures.Future。"""
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop())
+
+
+async def _run_on_loop(coro):
+    """在调用方的事件循环中等待后台事件循环上执行的协程。"""
+    return await asyncio.wrap_future(_submit(coro))
 
 
 # ===== 功能函数 =====
-def token_counter(usage):
-    file_path_overall = 'make_task/token_count/token_overall.txt'
-    file_path_stream = 'make_task/token_count/token_stream.txt'
-
-    with open(file_path_stream, 'r', encoding='utf-8') as file:
-        token_str_stream = file.read()
-    with open(file_path_overall, 'r', encoding='utf-8') as file:
-        token_str_overall = file.read()
-
-    with open(file_path_stream, 'w', encoding='utf-8') as tok:
-        for key, value in usage.items():
-            token_str_stream += f"{key}: **{value}**\n"
-        tok.write(token_str_stream)
-
-    if not token_str_overall.strip():
-        with open(file_path_overall, 'w', encoding='utf-8') as tok:
-            tok.write(token_str_stream)
-    else:
-        numbers = [int(num) for num in re.findall(r'\d+', token_str_overall)]
-        token_str_new = ''
-        with open(file_path_overall, 'w', encoding='utf-8') as tok:
-            for i, (key, value) in enumerate(usage.items()):
-                token_str_new += f"{key}: **{value + numbers[i]}**\n"
-            tok.write(token_str_new)
-
-
-def llm_api(messages):
-    response = client.chat.completions.create(
-        messages=messages,
-        model='ep-20240814160016-j24nr',
-        temperature=0.2,
-        top_p=1.0,
-        n=1,
-        stream=False,
-        frequency_penalty=0.0,
-        presence_penalty=0.0,
-        logit_bias={}
-    ).model_dump()
-    response_text = response['choices'][0]['message']['content']
-    token_counter(response['usage'])
-    return response_text
-
-
-def llm_api_lite(messages):
-    response = client.chat.completions.create(
-        messages=messages,
-        model='ep-20240822150534-5nj65',
-        temperature=0.2,
-        top_p=1.0,
-        n=1,
-        stream=False,
-        frequency_penalty=0.0,
-        presence_penalty=0.0,
-        logit_bias={}
-    ).model_dump()
-    response_text = response['choices'][0]['message']['content']
-    token_counter(response['usage'])
-    return response_text
-
-
-def get_text_embedding(text: str):
-    text = text or "None"
-    return client.embeddings.create(
-        input=text,
-        model="text-embedding-ada-002"
-    ).model_dump()['data'][0]['embedding']
+def token_counter(usage, prompt_key=None, model=None):
+    """把一次调用的 usage 记入当前病例 / 智能体 / 调用点 / 模型的统计（仅内存，病例结束时落盘）。"""
+    token_accounting.record(usage, prompt_key, model=model)
+
+
+async def _scheduled(priority, estimated, request):
+    """按优先级与限流排队后发出 request()，429 时退避重试；返回 model_dump() 后的响应（流式请求已是字典）。"""
+    scheduler = _get_scheduler()
+
+    async def attempt():
+        async with scheduler.slot(priority, estimated):
+            response = await request()
+            if not isinstance(response, dict):
+                response = response.model_dump()
+        scheduler.settle(estimated, (response.get('usage') or {}).get('total_tokens', 0))
+        return response
+
+    return await with_backoff(attempt, scheduler)
+
+
+def _estimated_usage(messages, text):
+    prompt_tokens = estimate_tokens((message['content'] for message in messages), completion=0)
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": len(text), "total_tokens": prompt_tokens + len(text)}
+
+
+def _record_stream(prompt_key, info):
+    if info["ttft"] is not None:
+        ttft_tracker.record(prompt_key, info["ttft"])
+    if info["time_to_field"] is not None:
+        field_tracker.record(prompt_key, info["time_to_field"])
+    if info["stopped_early"]:
+        field_tracker.count(prompt_key, "early_stops")
+
+
+async def _chat_completion(messages, model, priority, prompt_key=None, stream=None):
+    """
+    主模型熔断时改用 lite 模型；按调用点的延迟分布对冲，主模型服务异常时用 lite 模型重试一次。
+    降级得到的响应带 fallback_model 字段，不写入响应缓存。
+    stream 为 (fields, on_delta) 时流式读取（见 streaming）；带 on_delta 的请求不对冲，避免重复输出。
+    """
+    gate = breaker.allow(model) if model != LLM_LITE_MODEL else CLOSED
+    if gate is None:
+        latency_tracker.count(prompt_key, "fallbacks")
+        return {**await _chat_completion(messages, LLM_LITE_MODEL, priority, prompt_key, stream),
+                "fallback_model": LLM_LITE_MODEL}
+    options = {}
+    timeout = timeout_for(prompt_key)
+    if timeout is not None:
+        options["timeout"] = timeout
+    estimated = estimate_tokens(message['content'] for message in messages)
+    scheduler = _get_scheduler()
+
+    def create(**extra):
+        return llm_client.get_async_client().chat.completions.create(
+            messages=messages,
+            model=model,
+            temperature=TEMPERATURE,
+            top_p=TOP_P,
+            n=1,
+            frequency_penalty=0.0,
+            presence_penalty=0.0,
+            logit_bias={},
+            **options,
+            **extra,
+        )
+
+    async def streamed():
+        fields, on_delta = stream
+        started = time.perf_counter()
+        response = await streaming.consume(
+            await create(stream=True, stream_options={"include_usage": True}), started, fields, on_delta
+        )
+        if response['usage'] is None:
+            # 提前关闭的流没有 usage
+            response['usage'] = _estimated_usage(messages, response['choices'][0]['message']['content'])
+        return response
+
+    def attempt():
+        return _scheduled(priority, estimated, streamed if stream else lambda: create(stream=False))
+
+    hedge_delay = None if stream and stream[1] is not None else latency_tracker.hedge_delay(prompt_key)
+    start = time.perf_counter()
+    try:
+        response, hedge = await hedged(attempt, hedge_delay, scheduler.has_idle_slot)
+    except DEGRADED_ERRORS as exc:
+        breaker.failure(model)
+        latency_tracker.count(prompt_key, failure_kind(exc))
+        if model == LLM_LITE_MODEL or LLM_BREAKER_FAILURES <= 0:
+            raise
+        latency_tracker.count(prompt_key, "fallbacks")
+        return {**await _chat_completion(messages, LLM_LITE_MODEL, priority, prompt_key, stream),
+                "fallback_model": LLM_LITE_MODEL}
+    except BaseException as exc:
+        # 探测请求以其他方式结束时也要清除探测状态，否则主模型会一直处于熔断中
+        if gate == PROBE:
+            breaker.release(model, failed=not isinstance(exc, asyncio.CancelledError))
+        raise
+    breaker.success(model)
+    latency_tracker.record(prompt_key, time.perf_counter() - start)
+    if hedge:
+        latency_tracker.count(prompt_key, "hedged")
+        if hedge == "won":
+            latency_tracker.count(prompt_key, "hedge_wins")
+    if response.get('stream'):
+        _record_stream(prompt_key, response['stream'])
+    return response
+
+
+async def _coalesced_chat(messages, model, priority, prompt_key=None, stream=None):
+    """
+    相同模型与消息的并发调用只发出一次请求；返回 (响应, 是否为合并的跟随者)。
+    提前结束的流式请求按所需字段区分；带 on_delta 的请求需要自己的输出，不参与合并。
+    """
+    if stream and stream[1] is not None:
+        return await _chat_completion(messages, model, priority, prompt_key, stream), False
+    key = make_key(model, messages, TEMPERATURE, TOP_P)
+    if stream and stream[0]:
+        key = f"{key}|{streaming.signature(stream[0])}"
+    return await _get_flights().do(
+        "chat", key, lambda: _chat_completion(messages, model, priority, prompt_key, stream)
+    )
+
+
+async def _embedding_batch(texts, model, priority):
+    response = await _scheduled(
+        priority,
+        estimate_tokens(texts, completion=0),
+        lambda: llm_client.get_async_client().embeddings.create(input=texts, model=model),
+    )
+    data = sorted(response['data'], key=lambda item: item['index'])
+    return [item['embedding'] for item in data]
+
+
+async def _embedding_batches(texts, model, priority):
+    batches = [texts[i:i + EMBEDDING_BATCH_SIZE] for i in range(0, len(texts), EMBEDDING_BATCH_SIZE)]
+    results = await asyncio.gather(*[_embedding_batch(batch, model, priority) for batch in batches])
+    return [vector for batch in results for vector in batch]
+
+
+async def _embeddings(texts, model, priority):
+    """texts 互不相同；已有相同文本在途时等待该请求，其余文本分批请求。"""
+    vectors, _ = await _get_flights().do_many(
+        "embedding",
+        [(model, text) for text in texts],
+        lambda keys: _embedding_batches([text for _, text in keys], model, priority),
+    )
+    return vectors
+
+
+def _embedding_lookup(texts, model):
+    """去重并查询缓存，返回 (已知向量 {text: vector}, 需要请求的文本列表)。"""
+    unique = list(dict.fromkeys(texts))
+    found = {}
+    embedding_cache = _get_embedding_cache()
+    if embedding_cache:
+        keys = {text: emb_cache.make_key(model, text) for text in unique}
+        cached = embedding_cache.get_many(keys.values())
+        found = {text: cached[key] for text, key in keys.items() if key in cached}
+    return found, [text for text in unique if text not in found]
+
+
+def _embedding_store(found, missing, vectors, model):
+    found.update(zip(missing, vectors))
+    embedding_cache = _get_embedding_cache()
+    if embedding_cache and missing:
+        embedding_cache.put_many((emb_cache.make_key(model, text), found[text]) for text in missing)
+
+
+def _response_text(response, prompt_key=None, model=None, shared=False):
+    # 合并的跟随者没有发出请求，不计 token
+    if not shared:
+        token_counter(response['usage'], prompt_key, response.get('fallback_model') or model)
+    return response['choices'][0]['message']['content']
+
+
+def _cache_lookup(messages, model, cache):
+    response_cache = _get_response_cache()
+    if not (cache and response_cache):
+        return None, None
+    key = make_key(model, messages, TEMPERATURE, TOP_P)
+    return key, response_cache.get(key)
+
+
+def _stream_spec(fields=None, on_delta=None):
+    """流式请求时返回 (fields, on_delta)，否则返回 None。"""
+    if on_delta is None and not streaming.LLM_STREAM:
+        return None
+    return tuple(fields or ()), on_delta
+
+
+def _cached_text(cached, on_delta=None):
+    text = cached['choices'][0]['message']['content']
+    if on_delta is not None:
+        on_delta(text)
+    return text
+
+
+def _cache_store(key, response, latency):
+    # 降级或提前结束（内容不完整）的响应不缓存
+    truncated = (response.get('stream') or {}).get('stopped_early')
+    if key is not None and not response.get('fallback_model') and not truncated:
+        _get_response_cache().put(key, response, latency)
+
+
+def cache_stats() -> dict:
+    """返回响应缓存的命中统计（未启用缓存时返回空字典）。"""
+    response_cache = _get_response_cache()
+    return response_cache.stats() if response_cache else {}
+
+
+def scheduler_stats() -> dict:
+    """各优先级的请求数与排队秒数、429 次数（进程内累计）。"""
+    return _scheduler.snapshot() if _scheduler else {}
+
+
+def coalesce_stats() -> dict:
+    """发出的请求数与合并到在途请求的调用数（embedding 按文本计），以及当前在途数（进程内累计）。"""
+    return _flights.snapshot() if _flights else {}
+
+
+def stream_stats() -> dict:
+    """流式请求各调用点的首 token 耗时（ttft）与所需字段完整耗时（time_to_field）分位数、提前结束次数（进程内累计）。"""
+    return {"ttft": ttft_tracker.snapshot(), "time_to_field": field_tracker.snapshot()}
+
+
+def latency_stats() -> dict:
+    """各调用点的延迟分位数（p50 / p95 / p99）与对冲、超时、降级次数，以及熔断状态（进程内累计）。"""
+    return {"calls": latency_tracker.snapshot(), "breaker": breaker.snapshot()}
+
+
+def reset_cache_stats():
+    response_cache = _get_response_cache()
+    if response_cache:
+        response_cache.reset_stats()
+
+
+async def _acomplete(messages, model, cache, prompt_key, fields=None, on_delta=None):
+    with span(f"llm:{prompt_key or 'unlabeled'}", "llm", model=model):
+        key, cached = _cache_lookup(messages, model, cache)
+        if cached is not None:
+            return _cached_text(cached, on_delta)
+        start = time.time()
+        response, shared = await _run_on_loop(_coalesced_chat(
+            messages, model, priority_for(prompt_key), prompt_key, _stream_spec(fields, on_delta)
+        ))
+        if not shared:
+            _cache_store(key, response, time.time() - start)
+        return _response_text(response, prompt_key, model, shared)
+
+
+def _complete(messages, model, cache, prompt_key, fields=None, on_delta=None):
+    with span(f"llm:{prompt_key or 'unlabeled'}", "llm", model=model):
+        key, cached = _cache_lookup(messages, model, cache)
+        if cached is not None:
+            return _cached_text(cached, on_delta)
+        start = time.time()
+        response, shared = _submit(_coalesced_chat(
+            messages, model, priority_for(prompt_key), prompt_key, _stream_spec(fields, on_delta)
+        )).result()
+        if not shared:
+            _cache_store(key, response, time.time() - start)
+        return _response_text(response, prompt_key, model, shared)
+
+
+async def allm_api(messages, prompt_key=None, cache=True, fields=None, on_delta=None):
+    return await _acomplete(messages, routed_model(prompt_key), cache, prompt_key, fields, on_delta)
+
+
+async def allm_api_lite(messages, prompt_key=None, cache=True, fields=None, on_delta=None):
+    return await _acomplete(messages, LLM_LITE_MODEL, cache, prompt_key, fields, on_delta)
+
+
+async def aget_text_embeddings(texts, model=EMBEDDING_MODEL, prompt_key="embedding"):
+    texts = [text or "None" for text in texts]
+    with span("embedding", "embedding", texts=len(texts)):
+        found, missing = _embedding_lookup(texts, model)
+        if missing:
+            vectors = await _run_on_loop(_embeddings(missing, model, priority_for(prompt_key)))
+            _embedding_store(found, missing, vectors, model)
+    return [found[text] for text in texts]
+
+
+async def aget_text_embedding(text: str, prompt_key="embedding"):
+    return (await aget_text_embeddings([text], prompt_key=prompt_key))[0]
+
+
+def routed_model(prompt_key=None) -> str:
+    """llm_api 对该调用点实际使用的模型（见 routing）。"""
+    return LLM_LITE_MODEL if route(prompt_key) == LITE else LLM_MODEL
+
+
+def llm_api(messages, prompt_key=None, cache=True, fields=None, on_delta=None):
+    """
+    prompt_key 标记调用点（通常为 prompt_data 中的键名），用于 token 分项统计与模型路由。
+    fields：调用方只使用回答中这些正则的首个匹配时传入，流式请求在它们都完整后提前结束（返回的文本不完整）；
+    on_delta：逐段接收回答文本（流式输出到终端等），命中缓存时收到整段文本。
+    """
+    return _complete(messages, routed_model(prompt_key), cache, prompt_key, fields, on_delta)
+
+
+def llm_api_lite(messages, prompt_key=None, cache=True, fields=None, on_delta=None):
+    return _complete(messages, LLM_LITE_MODEL, cache, prompt_key, fields, on_delta)
+
+
+def get_text_embeddings(texts, model=EMBEDDING_MODEL, prompt_key="embedding"):
+    """
+    批量获取向量：输入去重、先查持久化缓存，未命中的文本按 EMBEDDING_BATCH_SIZE 分批请求。
+    prompt_key 决定调度优先级：默认按后台请求排队，关键路径上的调用传入所属调用点的键。
+    """
+    texts = [text or "None" for text in texts]
+    with span("embedding", "embedding", texts=len(texts)):
+        found, missing = _embedding_lookup(texts, model)
+        if missing:
+            vectors = _submit(_embeddings(missing, model, priority_for(prompt_key))).result()
+            _embedding_store(found, missing, vectors, model)
+    return [found[text] for text in texts]
+
+
+def get_text_embedding(text: str, prompt_key="embedding"):
+    return get_text_embeddings([text], prompt_key=prompt_key)[0]
+
+
+def embedding_endpoint(model=EMBEDDING_MODEL):
+    """get_text_embeddings 所用的 (模型, 接口地址)，供 RAG 判断问题向量能否与向量库混用。"""
+    return model, str(llm_client.get_async_client().base_url).rstrip("/")
 
 
 def get_code_embedding(code: str):
-    code = code or "#"
-    return client.embeddings.create(
-        input=code,
-        model="text-embedding-ada-002"
-    ).model_dump()['data'][0]['embedding']
+    return get_text_embeddings([code or "#"])[0]
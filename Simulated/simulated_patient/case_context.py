@@ -0,0 +1,32 @@
+"""
+病例上下文与 prompt 注册表。
+prompt_data.json 只在首次使用时读取一次，之后作为只读映射共享；
+每个病例的 resource / vague_resource 放在 CaseContext 里随对象传递，不再写回磁盘，
+同一份代码目录下可以并发运行多个病例。
+"""
+import json
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from types import MappingProxyType
+
+PROMPT_PATH = Path("Simulated") / "Prompt" / "prompt_data.json"
+
+
+@lru_cache(maxsize=None)
+def load_prompts(path: Path = PROMPT_PATH):
+    """读取并拼接 prompt_data.json 中的各条 prompt，返回只读映射。"""
+    data = json.loads(Path(path).read_text(encoding="utf-8"))
+    final = {}
+    for k, v in data.items():
+        # v 可能是列表（每行一段），拼接为完整 prompt
+        final[k] = "".join(v) if isinstance(v, list) else str(v)
+    return MappingProxyType(final)
+
+
+@dataclass(frozen=True)
+class CaseContext:
+    case_id: str
+    resource: str
+    vague_resource: str
+    directory: Path
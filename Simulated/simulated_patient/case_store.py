@@ -0,0 +1,186 @@
+"""
+病例库：把 dataset/patient_text.xlsx 的全部单元格和 bulit_dataset.py 生成的 patient_data.json
+（或 --format jsonl 的分桶输出）一次性转换为 SQLite，按 (sheet, row, col) 与 Patient-SN 建索引，
+取单个病例不再打开整个工作簿。
+行号与 openpyxl 一致（从 1 开始，第 1 行为表头），列号从 0 开始，即 sheet[row][col]。
+
+首次使用时自动构建；工作簿更新后重新构建：
+    python -m Simulated.simulated_patient.case_store dataset/patient_text.xlsx [dataset/patient_data.json | 分桶目录]
+  CASE_STORE_PATH  病例库文件，默认 dataset/case_store.sqlite；设为空串则直接读取工作簿
+"""
+import os
+import sys
+import json
+import sqlite3
+import threading
+from pathlib import Path
+
+import openpyxl
+
+XLSX_PATH = Path("dataset") / "patient_text.xlsx"
+PATIENT_JSON_PATH = Path("dataset") / "patient_data.json"
+PATIENT_SN = "Patient-SN"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cells (
+    sheet TEXT NOT NULL, row INTEGER NOT NULL, col INTEGER NOT NULL,
+    value TEXT NOT NULL, patient_sn TEXT,
+    PRIMARY KEY (sheet, row, col)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS cells_patient ON cells (patient_sn);
+CREATE TABLE IF NOT EXISTS patients (patient_sn TEXT PRIMARY KEY, records TEXT NOT NULL) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS source (path TEXT PRIMARY KEY, mtime REAL NOT NULL, size INTEGER NOT NULL);
+"""
+
+
+def _fingerprint(path: Path):
+    stat = path.stat()
+    return stat.st_mtime, stat.st_size
+
+
+class CaseStore:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cells").fetchone()[0]
+
+    def cell(self, sheet_name: str, row_number: int, col_number: int):
+        """返回单元格文本；不存在（或为空）时返回 None。"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM cells WHERE sheet = ? AND row = ? AND col = ?",
+                (sheet_name, row_number, col_number),
+            ).fetchone()
+        return row[0] if row else None
+
+    def has_sheet(self, sheet_name: str) -> bool:
+        with self._lock:
+            row = self._conn.execute("SELECT 1 FROM cells WHERE sheet = ? LIMIT 1", (sheet_name,)).fetchone()
+        return row is not None
+
+    def patient_sn(self, sheet_name: str, row_number: int):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT patient_sn FROM cells WHERE sheet = ? AND row = ? LIMIT 1", (sheet_name, row_number)
+            ).fetchone()
+        return row[0] if row else None
+
+    def patient(self, patient_sn: str):
+        """返回 patient_data.json 中该患者的记录列表；不存在时返回 None。"""
+        with self._lock:
+            row = self._conn.execute("SELECT records FROM patients WHERE patient_sn = ?", (patient_sn,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def iter_cases(self, sheet_name: str, col_number: int, start: int = 2, end=None, batch_size: int = 500):
+        """按行号顺序逐批产出 (row, text, patient_sn)，跳过空单元格；始终从表头下一行（第 2 行）开始。"""
+        last = max(start, 2) - 1
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT row, value, patient_sn FROM cells WHERE sheet = ? AND col = ? AND row > ? AND row <= ? "
+                    "ORDER BY row LIMIT ?",
+                    (sheet_name, col_number, last, end if end is not None else sys.maxsize, batch_size),
+                ).fetchall()
+            if not rows:
+                return
+            yield from rows
+            last = rows[-1][0]
+
+    def is_current(self, xlsx_path: Path) -> bool:
+        """工作簿自构建以来未被修改。"""
+        xlsx_path = Path(xlsx_path)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT mtime, size FROM source WHERE path = ?", (str(xlsx_path.resolve()),)
+            ).fetchone()
+        return row is not None and xlsx_path.is_file() and tuple(row) == _fingerprint(xlsx_path)
+
+    def build(self, xlsx_path: Path, patient_json_path=None):
+        """清空后重新导入工作簿（只读流式读取）与可选的患者 JSON。"""
+        xlsx_path = Path(xlsx_path)
+        wb = openpyxl.load_workbook(xlsx_path, read_only=True)
+        try:
+            with self._lock:
+                self._conn.execute("DELETE FROM cells")
+                self._conn.execute("DELETE FROM patients")
+                self._conn.execute("DELETE FROM source")
+                for sheet in wb.worksheets:
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO cells (sheet, row, col, value, patient_sn) VALUES (?, ?, ?, ?, ?)",
+                        _sheet_cells(sheet),
+                    )
+                if patient_json_path and Path(patient_json_path).exists():
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO patients (patient_sn, records) VALUES (?, ?)",
+                        ((sn, json.dumps(records, ensure_ascii=False)) for sn, records in _iter_patients(patient_json_path)),
+                    )
+                self._conn.execute(
+                    "INSERT INTO source (path, mtime, size) VALUES (?, ?, ?)",
+                    (str(xlsx_path.resolve()), *_fingerprint(xlsx_path)),
+                )
+                self._conn.commit()
+        finally:
+            wb.close()
+        return self
+
+
+def _iter_patients(path):
+    """patient_data.json，或 bulit_dataset.py --format jsonl 输出的分桶目录。"""
+    path = Path(path)
+    if path.is_dir():
+        for part in sorted(path.glob("*.jsonl")):
+            with part.open("r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        patient = json.loads(line)
+                        yield patient[PATIENT_SN], patient["records"]
+    else:
+        yield from json.loads(path.read_text(encoding="utf-8")).items()
+
+
+def _sheet_cells(sheet):
+    sn_col = None
+    for row_number, values in enumerate(sheet.iter_rows(values_only=True), start=1):
+        if row_number == 1 and PATIENT_SN in values:
+            sn_col = values.index(PATIENT_SN)
+        patient_sn = None
+        if sn_col is not None and row_number > 1 and sn_col < len(values) and values[sn_col] is not None:
+            patient_sn = str(values[sn_col])
+        for col_number, value in enumerate(values):
+            if value is not None:
+                yield sheet.title, row_number, col_number, str(value), patient_sn
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def open_case_store(xlsx_path=XLSX_PATH):
+    """返回进程内共享的病例库；不存在或工作簿已更新时自动（重新）构建，未启用时返回 None。"""
+    global _store
+    path = os.getenv("CASE_STORE_PATH", "dataset/case_store.sqlite")
+    if not path:
+        return None
+    with _store_lock:
+        if _store is None:
+            store = CaseStore(path)
+            if Path(xlsx_path).is_file() and not store.is_current(xlsx_path):
+                store.build(xlsx_path, PATIENT_JSON_PATH)
+            _store = store
+    return _store
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("用法：python -m Simulated.simulated_patient.case_store <patient_text.xlsx> [patient_data.json]")
+        sys.exit(1)
+    out = os.getenv("CASE_STORE_PATH") or "dataset/case_store.sqlite"
+    store = CaseStore(out).build(Path(sys.argv[1]), Path(sys.argv[2]) if len(sys.argv) > 2 else PATIENT_JSON_PATH)
+    print(f"已写入 {out}：{len(store)} 个单元格")
@@ -0,0 +1,21 @@
+import os
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+# 一个医生同时推进的下级科室医生数；1 表示逐个串行
+SUB_DOCTOR_FANOUT = int(os.getenv("SUB_DOCTOR_FANOUT", "1"))
+
+
+def submit_with_context(pool, fn, *args, **kwargs):
+    """向线程池提交任务，并把当前线程的 contextvars（病例、智能体等统计标签）带过去。"""
+    return pool.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def map_in_threads(fn, items, max_workers: int):
+    """并发执行 fn(item)，按 items 原顺序返回结果；max_workers <= 1 时在当前线程串行执行。"""
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        return [fn(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as pool:
+        futures = [submit_with_context(pool, fn, item) for item in items]
+        return [future.result() for future in futures]
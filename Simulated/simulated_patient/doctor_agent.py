@@ -5,13 +5,21 @@ import json
 from pathlib import Path
 
 from Simulated.simulated_patient.api_call import llm_api
-from Simulated.simulated_patient.agent_evolve import store_doctor_qa, agent_evolving_doctor
+from Simulated.simulated_patient.agent_evolve import store_doctor_qa, agent_evolving_doctor, evolve_lock
 from make_task.overall_assessment_llm import overall_assessment_doctor
 from RAG.rag import rag_patient
+from Simulated.simulated_patient.token_usage import tracked_agent
+from Simulated.simulated_patient.concurrency import map_in_threads, SUB_DOCTOR_FANOUT
+from Simulated.simulated_patient.postprocess import inline, settle, split_future
+from Simulated.simulated_patient.tracing import traced
+
+
+def star_pattern(symbol):
+    return f'{symbol}{symbol}(.*?){symbol}{symbol}'
 
 
 def match_star(context, symbol):
-    pattern = f'{symbol}{symbol}(.*?){symbol}{symbol}'
+    pattern = star_pattern(symbol)
     match = re.search(pattern, context)
     if match:
         question_match = re.sub(symbol, "", match[0])
@@ -25,7 +33,7 @@ def match_star(context, symbol):
 def crisis_memory_summary(memory_info, prompt):
     prompt = prompt.format(chatstream=memory_info)
     messages = [{"role": "user", "content": prompt}]
-    summarized_memory = llm_api(messages)
+    summarized_memory = llm_api(messages, prompt_key="crisis_memory_summary")
     return summarized_memory
 
 
@@ -34,8 +42,11 @@ def memory_control():
 
 
 class Doctor:
-    def __init__(self, patient, office=None, main_complaint=None, directory=None, prompt_data=None, level=1):
+    def __init__(self, patient, office=None, main_complaint=None, directory=None, prompt_data=None, level=1,
+                 sub_doctor_fanout=None, postprocessor=None):
         self.sub_doctor = []
+        # 下级科室医生每轮的问答可以并发推进，上限为 sub_doctor_fanout
+        self.sub_doctor_fanout = sub_doctor_fanout or SUB_DOCTOR_FANOUT
         self.office = office
         self.main_complaint = main_complaint
         self.dialog_history = ""
@@ -61,7 +72,16 @@ class Doctor:
         self.new_human = 0
         self.last_doc_rel = 0
         self.last_doc_faith = 0
+        # 上一轮的评估与记录写入在后台执行；同一医生的任务按提交顺序串行
+        self.postprocessor = postprocessor or inline
+        self._pending = None
+
+    @property
+    def agent_name(self):
+        return f"doctor:{self.office}"
 
+    @tracked_agent
+    @traced("doctor.question")
     def doctor_qus(self, answer, patient_score, rel, faith, human):
         print(f"{self.office} Doctor question {self.last_qus}")
         print("Patient answer", answer)
@@ -70,13 +90,15 @@ class Doctor:
         evolve_csv = Path("dataset") / f"doctor_evolve_{self.office}.csv"
         evolve_csv.parent.mkdir(parents=True, exist_ok=True)
 
-        if not evolve_csv.is_file():
-            with evolve_csv.open("w", newline="", encoding="gbk") as file:
-                writer = csv.writer(file)
-                writer.writerow([
-                    "question1", "qus_embedding", "rag_info1", "answer1",
-                    "qus2_embedding", "question2", "answer2", "rag_info2"
-                ])
+        # 与后台写入共用同一把锁，避免两个线程都以 "w" 打开而清空已写入的行
+        with evolve_lock(evolve_csv):
+            if not evolve_csv.is_file():
+                with evolve_csv.open("w", newline="", encoding="gbk") as file:
+                    writer = csv.writer(file)
+                    writer.writerow([
+                        "question1", "qus_embedding", "rag_info1", "answer1",
+                        "qus2_embedding", "question2", "answer2", "rag_info2"
+                    ])
 
         doctor_evolve_info = agent_evolving_doctor(
             str(evolve_csv),
@@ -94,31 +116,23 @@ class Doctor:
             few_shot_example = "无示例。"
 
         prompt = self.prompt_data["doctor_question_info"]
-        info = self.prompt_data["resource"]
+        info = self.patient.resource
         prompt = prompt.format(self.office, self.main_complaint, self.summary, self.dialog_history, few_shot_example, info)
 
         if len(self.sub_doctor) > 0:
-            for doctor in self.sub_doctor:
-                if not doctor.dialog_turn > 5:
-                    doctor_question = doctor.doctor_qus(
-                        doctor.new_patient_answer, doctor.new_patient_score,
-                        doctor.new_rel, doctor.new_faith, doctor.new_human
-                    )
-                    if doctor_question == "skip":
-                        continue
-                    patient_answer, pat_score, rel_, faith_, human_ = self.patient.patient_ans(doctor_question)
-                    doctor.new_patient_answer = patient_answer
-                    doctor.new_patient_score = pat_score
-                    doctor.new_rel = rel_
-                    doctor.new_faith = faith_
-                    doctor.new_human = human_
-                    doctor.make_summary()
-
+            skipped = map_in_threads(self.sub_doctor_round, self.sub_doctor, self.sub_doctor_fanout)
+            # 按招募顺序拼接总结（本轮提问为 skip 的医生不拼接），与串行执行时的 prompt 完全一致
+            for doctor, skip in zip(self.sub_doctor, skipped):
+                if skip:
+                    continue
                 prompt += f"*****{doctor.office}*****"
                 prompt += doctor.summary
 
         messages = [{"role": "user", "content": prompt}]
-        response = llm_api(messages)
+        # 只用到首个 **问题** 与 ##种类##，流式请求时两者完整即结束
+        response = llm_api(
+            messages, prompt_key="doctor_question_info", fields=(star_pattern(r"\*"), star_pattern("#"))
+        )
 
         qus = match_star(response, r"\*")
         if "NO" in qus:
@@ -129,36 +143,23 @@ class Doctor:
         self.dialog_history += f"patient answer: {answer}\n"
         office = "NO"
 
-        self.store(
+        category = match_star(response, r"#")
+
+        # 记录文件在此同步创建，招募时 check_files 能立即看到该科室
+        if self.last_qus != "":
+            self.record_path()
+        store_args = (
             self.last_qus, self.last_qus_category, answer, office,
             self.last_score, self.last_score_patient, self.last_rel, self.last_faith,
             self.last_human, self.last_doc_rel, self.last_doc_faith
         )
-
-        category = match_star(response, r"#")
-
-        useful_info = rag_patient(
-            self.last_qus,
-            self.patient.resource,
-            size=120,
-            overlap=40,
-            top_k=2
+        self._pending = self.postprocessor.submit(
+            self.assess_turn, self._pending, str(evolve_csv), self.last_qus, answer, self.record, store_args
         )
-
-        score, doc_rel, doc_faith = 0, 0, 0
-        if self.last_qus != "":
-            score, doc_rel, doc_faith, _ = overall_assessment_doctor(self.last_qus, useful_info, answer)
-            print(f"score: {score}")
-            print(self.record)
-            print(self.last_qus)
-
-        # 修正：字符串比较使用 !=
-        if score >= 3 and self.record[0] != "":
-            if self.last_score >= 1:
-                store_doctor_qa(
-                    str(evolve_csv),
-                    self.record + [self.last_qus] + [answer] + [useful_info]
-                )
+        if self.postprocessor.deferred:
+            useful_info, score, doc_rel, doc_faith = split_future(self._pending, 4)
+        else:
+            useful_info, score, doc_rel, doc_faith = self._pending.result()
 
         self.record = [self.last_qus, answer, useful_info]
         self.last_score = score
@@ -180,6 +181,59 @@ class Doctor:
 
         return qus
 
+    @tracked_agent
+    @traced("postprocess.doctor", "postprocess")
+    def assess_turn(self, previous, evolve_csv, last_qus, answer, record, store_args):
+        """写入上一轮记录、评估上一轮提问，达标则存入进化记忆；返回 (rag 信息, score, rel, faith)。"""
+        if previous is not None:
+            # 等前一个任务完成，保证记录行的顺序；其异常已由 postprocessor 报告
+            previous.exception()
+        # 前序任务失败时取默认值，只让失败的那一轮缺失，后续轮次照常写入
+        self.store(*[settle(value) for value in store_args])
+
+        useful_info = rag_patient(
+            last_qus,
+            self.patient.resource,
+            size=120,
+            overlap=40,
+            top_k=2
+        )
+
+        score, doc_rel, doc_faith = 0, 0, 0
+        if last_qus != "":
+            score, doc_rel, doc_faith, _ = overall_assessment_doctor(last_qus, useful_info, answer)
+            print(f"score: {score}")
+            print(record)
+            print(last_qus)
+
+        # store_args[4] 为上一轮提问的得分
+        if score >= 3 and record[0] != "" and settle(store_args[4]) >= 1:
+            store_doctor_qa(
+                evolve_csv,
+                [settle(value, "") for value in record] + [last_qus] + [answer] + [useful_info]
+            )
+        return useful_info, score, doc_rel, doc_faith
+
+    def sub_doctor_round(self, doctor):
+        """下级科室医生的一轮：提问 -> 病人回答 -> 更新总结。本轮提问为 skip 时返回 True。"""
+        if doctor.dialog_turn > 5:
+            return False
+        doctor_question = doctor.doctor_qus(
+            doctor.new_patient_answer, doctor.new_patient_score,
+            doctor.new_rel, doctor.new_faith, doctor.new_human
+        )
+        if doctor_question == "skip":
+            return True
+        patient_answer, pat_score, rel_, faith_, human_ = self.patient.patient_ans(doctor_question)
+        doctor.new_patient_answer = patient_answer
+        doctor.new_patient_score = pat_score
+        doctor.new_rel = rel_
+        doctor.new_faith = faith_
+        doctor.new_human = human_
+        doctor.make_summary()
+        return False
+
+    @tracked_agent
     def conclusion(self):
         prompt = self.prompt_data["conclusion"]
         prompt = prompt.format(self.office, self.summary, self.dialog_history)
@@ -190,13 +244,10 @@ class Doctor:
                 prompt += doctor.summary
 
         messages = [{"role": "user", "content": prompt}]
-        response = llm_api(messages)
+        response = llm_api(messages, prompt_key="conclusion")
         return response
 
-    def store(self, qus, category, ans, office, doc_score, pat_score,
-              last_rel, last_faith, last_human, last_doc_rel, last_doc_faith):
-        if qus == "":
-            return
+    def record_path(self) -> Path:
         path = self.directory / "doctor_record" / f"{self.office}_{self.level}.csv"
         path.parent.mkdir(parents=True, exist_ok=True)
 
@@ -209,6 +260,14 @@ class Doctor:
                     "patient_rel", "patient_faith", "patient_human",
                     "doctor_rel", "doctor_faith"
                 ])
+        return path
+
+    @traced("csv.write", "io")
+    def store(self, qus, category, ans, office, doc_score, pat_score,
+              last_rel, last_faith, last_human, last_doc_rel, last_doc_faith):
+        if qus == "":
+            return
+        path = self.record_path()
 
         with path.open("a", newline="", encoding="gbk") as file:
             writer = csv.writer(file)
@@ -222,11 +281,12 @@ class Doctor:
                 str(last_doc_rel), str(last_doc_faith)
             ])
 
+    @tracked_agent
     def recruit(self):
         prompt = self.prompt_data["recruit"]
         prompt = prompt.format(self.office, self.main_complaint, self.summary, self.dialog_history, self.dialog_turn)
         messages = [{"role": "user", "content": prompt}]
-        res = llm_api(messages)
+        res = llm_api(messages, prompt_key="recruit")
 
         new_office = match_star(res, r"\#")
         if "NO" not in new_office:
@@ -241,7 +301,8 @@ class Doctor:
 
                 new_doctor = Doctor(
                     self.patient, office, main_complaint=self.main_complaint,
-                    directory=self.directory, prompt_data=self.prompt_data, level=self.level + 1
+                    directory=self.directory, prompt_data=self.prompt_data, level=self.level + 1,
+                    sub_doctor_fanout=self.sub_doctor_fanout, postprocessor=self.postprocessor
                 )
 
                 doctor_question = new_doctor.doctor_qus(new_doctor.main_complaint, 0, 0, 0, 0)
@@ -257,12 +318,13 @@ class Doctor:
                 print(f"招募 {office} 医生")
         return new_office
 
+    @tracked_agent
     def make_summary(self):
         prompt = self.prompt_data["summary"]
         prompt = prompt.format(self.office, self.summary)
         prompt += self.dialog_history
         messages = [{"role": "user", "content": prompt}]
-        self.summary = llm_api(messages)
+        self.summary = llm_api(messages, prompt_key="summary")
         self.dialog_history = ""
 
     def doctor_reflect(self):
@@ -271,17 +333,18 @@ class Doctor:
     def doctor_chat(self):
         pass
 
+    @tracked_agent
     def doctor_crisis_answer(self, office, patient_crisis):
         auto = True
         if auto:
-            resource = self.prompt_data["resource"]
+            resource = self.patient.resource
             dq_path = self.directory / "doctor_question.txt"
             memory_stream_chat = dq_path.read_text(encoding="utf-8") if dq_path.exists() else ""
 
             prompt = self.prompt_data["doctor_crisis_answer"]
             prompt = prompt.format(office=office, chat=memory_stream_chat, crisis=patient_crisis, information=resource)
             messages = [{"role": "user", "content": prompt}]
-            doctor_answer = llm_api(messages)
+            doctor_answer = llm_api(messages, prompt_key="doctor_crisis_answer")
         else:
             doctor_answer = input("请输入回复：")
         return doctor_answer
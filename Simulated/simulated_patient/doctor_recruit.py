@@ -1,22 +1,9 @@
-import os
 import re
 from typing import List, Dict, Any, Optional
 
 from Simulated.simulated_patient.api_call import llm_api
 
 
-# =========== 环境变量读取（隐去隐私信息，不在代码中写密钥） ===========
-# 要求外部环境已设置：
-#   export OPENAI_API_KEY="your_key"
-#   export BASE_URL="https://your-base.url"   # 可选
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-if not OPENAI_API_KEY:
-    raise RuntimeError("未设置环境变量 OPENAI_API_KEY，请在运行前 `export OPENAI_API_KEY=...`")
-
-# 如果你的 llm_api 会读取 BASE_URL，也可以在这里校验（可选）
-# BASE_URL = os.getenv("BASE_URL")
-
-
 def match_star(context: str, symbol: str) -> str:
     """匹配 **...** 或 ##...## 样式的片段，返回去掉符号后的内容；未匹配返回 'NO'。"""
     # symbol 可能传入 "\*" 或 "\#"，需要正则转义
@@ -109,7 +96,7 @@ class Recruit:
                 office, self.main_complaint, self.summary, self.dialog_history, self.dialog_turn
             )
             messages = [{"role": "user", "content": prompt}]
-            res = llm_api(messages)
+            res = llm_api(messages, prompt_key="recruit")
 
             # 从 ##...## 中解析科室字符串，可能包含多个，以逗号分隔
             parsed = match_star(res, r"\#")
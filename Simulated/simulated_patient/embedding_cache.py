@@ -0,0 +1,54 @@
+import os
+import sqlite3
+import hashlib
+import threading
+from array import array
+from pathlib import Path
+
+
+def make_key(model: str, text: str) -> str:
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """持久化的 文本 -> 向量 缓存（SQLite），键为 (model, text) 的哈希，向量以 float32 存储。"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, keys):
+        """返回 {key: vector}，只包含已缓存的键。"""
+        found = {}
+        keys = list(keys)
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                for key, blob in rows:
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    found[key] = vector.tolist()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items):
+        rows = [(key, array("f", vector).tobytes()) for key, vector in items]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)", rows)
+            self._conn.commit()
+
+
+def cache_from_env():
+    """EMBEDDING_CACHE_PATH 指定缓存文件（默认 dataset/embedding_cache.sqlite），设为空串则不启用。"""
+    path = os.getenv("EMBEDDING_CACHE_PATH", "dataset/embedding_cache.sqlite").strip()
+    return EmbeddingCache(path) if path else None
@@ -0,0 +1,413 @@
+"""
+进化记忆的二进制存储：
+- 每个向量列保存为一个连续的 float32 .npy 矩阵（N x D），读取时使用内存映射；
+- 行元数据（question / rag_info / answer / requirements 等）保存在 meta.jsonl，按行号定位；
+- 每行的稳定 id（规范化后的问题 + 回答的哈希）保存在 ids.txt，用于常数时间的去重与查找。
+
+dataset/patient_evolve.csv 对应目录 dataset/patient_evolve.store/，
+旧的 CSV 文件可通过以下命令迁移（存储已存在且非空时报错；加 --force 删除已有存储后重新迁移）：
+    python -m Simulated.simulated_patient.evolve_store [--force] dataset/patient_evolve.csv dataset/doctor_evolve_*.csv
+"""
+import csv
+import sys
+import json
+import hashlib
+import threading
+import unicodedata
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+
+from Simulated.simulated_patient import ann_index
+
+PATIENT_VECTOR_COLUMNS = ("qus_embedding",)
+DOCTOR_VECTOR_COLUMNS = ("qus_embedding", "qus2_embedding")
+# 参与计算行 id 的元数据字段
+PATIENT_KEY_FIELDS = ("question", "answer")
+DOCTOR_KEY_FIELDS = ("question1", "answer1", "question2", "answer2")
+
+# 近似检索时，重复检测在第一列上取的候选行数
+_DUPLICATE_CANDIDATES = 32
+# 近似索引每新增这么多行落盘一次
+_ANN_SAVE_EVERY = 1000
+
+# .npy 头部固定为 128 字节，追加数据时只需原地改写 shape
+_HEADER_SIZE = 128
+_MAGIC = b"\x93NUMPY\x01\x00"
+
+
+def _npy_header(rows: int, dim: int) -> bytes:
+    header = f"{{'descr': '<f4', 'fortran_order': False, 'shape': ({rows}, {dim}), }}"
+    header_len = _HEADER_SIZE - len(_MAGIC) - 2
+    header = header.ljust(header_len - 1) + "\n"
+    return _MAGIC + header_len.to_bytes(2, "little") + header.encode("latin1")
+
+
+def _read_npy_shape(path: Path):
+    with path.open("rb") as f:
+        np.lib.format.read_magic(f)
+        shape, _, _ = np.lib.format.read_array_header_1_0(f)
+    return shape
+
+
+def _append_npy(path: Path, matrix: np.ndarray):
+    matrix = np.ascontiguousarray(matrix, dtype="<f4")
+    if not path.exists():
+        with path.open("wb") as f:
+            f.write(_npy_header(0, matrix.shape[1]))
+    rows, dim = _read_npy_shape(path)
+    if matrix.shape[1] != dim:
+        raise ValueError(f"向量维度不一致：{matrix.shape[1]} != {dim}")
+    with path.open("r+b") as f:
+        f.seek(_HEADER_SIZE + rows * dim * 4)
+        f.write(matrix.tobytes())
+        f.seek(0)
+        f.write(_npy_header(rows + matrix.shape[0], dim))
+
+
+def _truncate_npy(path: Path, rows: int):
+    """把 .npy 截断为前 rows 行（改写头部的 shape 并截掉多余的数据）。"""
+    old_rows, dim = _read_npy_shape(path)
+    if old_rows <= rows:
+        return
+    with path.open("r+b") as f:
+        f.write(_npy_header(rows, dim))
+        f.truncate(_HEADER_SIZE + rows * dim * 4)
+
+
+def _normalize_text(text) -> str:
+    return " ".join(unicodedata.normalize("NFKC", str(text or "")).split()).lower()
+
+
+def row_key(*texts) -> str:
+    """由规范化后的问题、回答等文本计算稳定的行 id。"""
+    payload = "\x1f".join(_normalize_text(text) for text in texts)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    matrix = np.array(matrix, dtype=np.float32, ndmin=2)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class SearchResult(NamedTuple):
+    ids: np.ndarray      # 命中行号，按相似度降序，最多 k 个
+    scores: np.ndarray   # 对应的余弦相似度
+    total: int           # 超过阈值的总行数
+
+
+class EvolveStore:
+    def __init__(self, path, vector_columns, key_fields=PATIENT_KEY_FIELDS):
+        self.path = Path(path)
+        self.vector_columns = tuple(vector_columns)
+        self.key_fields = tuple(key_fields)
+        self.meta_path = self.path / "meta.jsonl"
+        self.ids_path = self.path / "ids.txt"
+        self._lock = threading.RLock()
+        self._mmaps = {}
+        self._normalized = {}
+        self._ann_indexes = {}
+        self._offsets = []
+        self._ids = {}
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._load_offsets()
+        self._load_ids()
+
+    def _npy_path(self, column):
+        return self.path / f"{column}.npy"
+
+    def _load_offsets(self):
+        offsets, end = [], 0
+        if self.meta_path.exists():
+            with self.meta_path.open("rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # 写了一半的行
+                    offsets.append(end)
+                    end += len(line)
+        # 写入中断后各文件的行数可能不一致：以最短的为准，把所有向量列与元数据截断到同一行数，
+        # 否则之后追加的向量会接在多出的行后面，与元数据错位
+        for column in self.vector_columns:
+            npy = self._npy_path(column)
+            if npy.exists():
+                offsets = offsets[:_read_npy_shape(npy)[0]]
+        rows = len(offsets)
+        # 向量先于元数据写入，中断只会留下缺少元数据的向量；元数据非空而向量文件不存在说明文件被删除，
+        # 截断会丢掉全部元数据，直接报错
+        missing = [str(self._npy_path(column)) for column in self.vector_columns if not self._npy_path(column).exists()]
+        if rows and missing:
+            raise FileNotFoundError(f"缺少向量文件：{', '.join(missing)}（元数据有 {rows} 行），请从 CSV 重新迁移")
+        for column in self.vector_columns:
+            npy = self._npy_path(column)
+            if npy.exists():
+                _truncate_npy(npy, rows)
+        if self.meta_path.exists():
+            size = offsets[-1] + len(self._read_line(offsets[-1])) if offsets else 0
+            if self.meta_path.stat().st_size > size:
+                with self.meta_path.open("r+b") as f:
+                    f.truncate(size)
+        self._offsets = offsets
+
+    def _read_line(self, offset) -> bytes:
+        with self.meta_path.open("rb") as f:
+            f.seek(offset)
+            return f.readline()
+
+    def _load_ids(self):
+        text = self.ids_path.read_text(encoding="ascii") if self.ids_path.exists() else ""
+        keys = text.split()
+        if not text.endswith("\n"):
+            keys = keys[:-1]  # 写了一半的 id
+        stale = len(keys) != len(self)
+        keys = keys[:len(self)]
+        if len(keys) < len(self):
+            # 旧版本的存储没有 id 索引，按元数据补齐
+            keys += [self.key_of(meta) for meta in self.rows(range(len(keys), len(self)))]
+        if stale:
+            # 与元数据行数对齐，之后的追加才不会错位
+            self.ids_path.write_text("".join(key + "\n" for key in keys), encoding="ascii")
+        self._ids = {key: row_id for row_id, key in enumerate(keys)}
+
+    def key_of(self, meta: dict) -> str:
+        return row_key(*(meta.get(field, "") for field in self.key_fields))
+
+    def find(self, key: str):
+        """按行 id 查找行号，不存在时返回 None。"""
+        return self._ids.get(key)
+
+    def __contains__(self, key):
+        return key in self._ids
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def vectors(self, column=None) -> np.ndarray:
+        """返回某一向量列的 (N, D) 只读内存映射矩阵；为空时返回 shape 为 (0, 0) 的数组。"""
+        column = column or self.vector_columns[0]
+        with self._lock:
+            n = len(self)
+            cached = self._mmaps.get(column)
+            if cached is not None and cached.shape[0] >= n:
+                return cached[:n]
+            npy = self._npy_path(column)
+            if n == 0 or not npy.exists():
+                return np.zeros((0, 0), dtype=np.float32)
+            mmap = np.load(npy, mmap_mode="r")
+            self._mmaps[column] = mmap
+            return mmap[:n]
+
+    def normalized(self, column=None) -> np.ndarray:
+        """返回某一向量列按行归一化后的常驻内存矩阵，新增行增量追加，不重复计算范数。"""
+        column = column or self.vector_columns[0]
+        with self._lock:
+            n = len(self)
+            buf, filled = self._normalized.get(column, (None, 0))
+            if buf is None:
+                vectors = self.vectors(column)
+                buf, filled = (_normalize(vectors), n) if n else (None, 0)
+            elif filled < n:
+                buf = self._grow(buf, filled, _normalize(self.vectors(column)[filled:n]))
+                filled = n
+            if buf is None:
+                return np.zeros((0, 0), dtype=np.float32)
+            self._normalized[column] = (buf, filled)
+            return buf[:filled]
+
+    @staticmethod
+    def _grow(buf, filled, rows):
+        needed = filled + rows.shape[0]
+        if needed > buf.shape[0]:
+            bigger = np.empty((max(needed, buf.shape[0] * 2), buf.shape[1]), dtype=np.float32)
+            bigger[:filled] = buf[:filled]
+            buf = bigger
+        buf[filled:needed] = rows
+        return buf
+
+    def similarities(self, column, query) -> np.ndarray:
+        """一次矩阵-向量乘法得到 query 与该列所有行的余弦相似度。"""
+        matrix = self.normalized(column)
+        if matrix.shape[0] == 0:
+            return np.zeros(0, dtype=np.float32)
+        return matrix @ _normalize(query)[0]
+
+    def _ann(self, column):
+        """返回该列的近似索引；未启用、faiss 不可用或行数低于 ANN_MIN_ROWS 时返回 None。"""
+        if not ann_index.ann_available() or len(self) < ann_index.ANN_MIN_ROWS:
+            return None
+        with self._lock:
+            matrix = self.normalized(column)
+            entry = self._ann_indexes.get(column)
+            if entry is None:
+                path = self.path / f"{column}.{ann_index.ANN_BACKEND}.faiss"
+                ann = ann_index.AnnIndex.load(path, ann_index.ANN_BACKEND) if path.exists() else None
+                if ann is None or len(ann) > matrix.shape[0]:
+                    ann = ann_index.AnnIndex.build(matrix)
+                    ann.save(path)
+                entry = self._ann_indexes[column] = [ann, path, len(ann)]
+            ann, path, saved = entry
+            if len(ann) < matrix.shape[0]:
+                ann.add(matrix[len(ann):])
+            if len(ann) - saved >= _ANN_SAVE_EVERY:
+                ann.save(path)
+                entry[2] = len(ann)
+            return ann
+
+    def search(self, column, query, k: int, threshold: float = -1.0) -> SearchResult:
+        """
+        返回相似度超过 threshold 的前 k 行。
+        行数达到 ANN_MIN_ROWS 时走近似索引，此时 total 最多统计到 k + 1；否则精确计算（argpartition 取 top-k）。
+        """
+        ann = self._ann(column)
+        if ann is not None:
+            with self._lock:
+                ids, scores = ann.search(_normalize(query)[0], k + 1)
+            keep = scores > threshold
+            ids, scores = ids[keep], scores[keep]
+            return SearchResult(ids[:k], scores[:k], int(ids.size))
+
+        scores = self.similarities(column, query)
+        candidates = np.flatnonzero(scores > threshold)
+        total = int(candidates.size)
+        if total > k:
+            candidates = candidates[np.argpartition(scores[candidates], -k)[-k:]] if k > 0 else candidates[:0]
+        ids = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return SearchResult(ids, scores[ids], total)
+
+    def any_similar(self, queries: dict, threshold: float) -> bool:
+        """queries 为 {列名: 向量}；是否存在某一行在所有给定列上的相似度都超过 threshold。"""
+        columns = list(queries)
+        if columns and self._ann(columns[0]) is not None:
+            # 先用近似索引在第一列上找候选行，再在其余列上精确核对
+            ids = self.search(columns[0], queries[columns[0]], _DUPLICATE_CANDIDATES, threshold).ids
+            mask = np.ones(ids.size, dtype=bool)
+            for column in columns[1:]:
+                mask &= self.normalized(column)[ids] @ _normalize(queries[column])[0] > threshold
+            return bool(mask.any())
+
+        mask = None
+        for column, query in queries.items():
+            above = self.similarities(column, query) > threshold
+            mask = above if mask is None else mask & above
+        return bool(mask is not None and mask.any())
+
+    def rows(self, row_ids):
+        """按行号读取元数据。"""
+        result = []
+        with self._lock, self.meta_path.open("rb") as f:
+            for row_id in row_ids:
+                f.seek(self._offsets[row_id])
+                result.append(json.loads(f.readline().decode("utf-8")))
+        return result
+
+    def append(self, vectors: dict, meta: dict) -> int:
+        """追加一行：vectors 为 {列名: 向量}，meta 为元数据字典。返回行号（已存在相同 id 时返回原行号）。"""
+        return self.append_many({k: [v] for k, v in vectors.items()}, [meta])[0]
+
+    def append_many(self, vectors: dict, metas: list) -> list:
+        """批量追加：vectors 为 {列名: (k, D) 矩阵}，metas 为 k 个元数据字典。返回行号列表，重复 id 不会再次写入。"""
+        if not metas:
+            return []
+        with self._lock:
+            keys = [self.key_of(meta) for meta in metas]
+            keep, pending = [], {}
+            for i, key in enumerate(keys):
+                if key not in self._ids and key not in pending:
+                    pending[key] = len(self) + len(keep)
+                    keep.append(i)
+            if keep:
+                self._mmaps.clear()
+                # 先写向量再写元数据与 id，中断时多出的部分在下次打开时被截断或补齐
+                for column in self.vector_columns:
+                    matrix = np.asarray(vectors[column], dtype=np.float32)[keep]
+                    _append_npy(self._npy_path(column), matrix)
+                    if column in self._normalized:
+                        buf, filled = self._normalized[column]
+                        self._normalized[column] = (self._grow(buf, filled, _normalize(matrix)), filled + len(matrix))
+                    if column in self._ann_indexes:
+                        self._ann_indexes[column][0].add(_normalize(matrix))
+                with self.meta_path.open("ab") as f:
+                    for i in keep:
+                        self._offsets.append(f.tell())
+                        f.write((json.dumps(metas[i], ensure_ascii=False) + "\n").encode("utf-8"))
+                with self.ids_path.open("a", encoding="ascii") as f:
+                    f.write("".join(keys[i] + "\n" for i in keep))
+                self._ids.update(pending)
+            return [self._ids[key] for key in keys]
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def store_path_for(csv_path) -> Path:
+    csv_path = Path(csv_path)
+    return csv_path.with_name(csv_path.stem + ".store")
+
+
+def _schema_for(csv_path) -> tuple:
+    """返回 (向量列, 行 id 字段)。"""
+    if Path(csv_path).name.startswith("doctor_evolve"):
+        return DOCTOR_VECTOR_COLUMNS, DOCTOR_KEY_FIELDS
+    return PATIENT_VECTOR_COLUMNS, PATIENT_KEY_FIELDS
+
+
+def open_store(csv_path) -> EvolveStore:
+    """返回 CSV 路径对应的存储（进程内共享同一实例）；首次打开且存储不存在时自动从 CSV 迁移。"""
+    path = store_path_for(csv_path)
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            if not path.exists() and Path(csv_path).is_file():
+                store = migrate_csv(csv_path)
+            else:
+                store = EvolveStore(path, *_schema_for(csv_path))
+            _stores[path] = store
+    return store
+
+
+def _clear_store(path: Path):
+    """只删除存储自己的文件（向量、元数据、id 与近似索引）。"""
+    for pattern in ("*.npy", "*.faiss", "meta.jsonl", "ids.txt"):
+        for file in path.glob(pattern):
+            file.unlink()
+
+
+def migrate_csv(csv_path, force: bool = False) -> EvolveStore:
+    """把旧的 GBK 编码 CSV（向量以逗号拼接的文本存储）转换为二进制存储；force 时先清空已有存储。"""
+    csv_path = Path(csv_path)
+    vector_columns, key_fields = _schema_for(csv_path)
+    path = store_path_for(csv_path)
+    if force:
+        with _stores_lock:
+            _stores.pop(path, None)
+        _clear_store(path)
+    store = EvolveStore(path, vector_columns, key_fields)
+    if len(store):
+        raise FileExistsError(f"存储已存在且非空：{store.path}（加 --force 重新迁移）")
+
+    vectors = {column: [] for column in vector_columns}
+    metas = []
+    with csv_path.open(newline="", encoding="gbk") as csvfile:
+        reader = csv.DictReader(csvfile)
+        for row in reader:
+            if not all(row.get(column) for column in vector_columns):
+                continue
+            for column in vector_columns:
+                vectors[column].append(np.array(row[column].split(","), dtype=np.float32))
+            metas.append({k: v for k, v in row.items() if k not in vector_columns})
+    if metas:
+        store.append_many({column: np.stack(rows) for column, rows in vectors.items()}, metas)
+    print(f"{csv_path} -> {store.path}（{len(store)} 行）")
+    return store
+
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if arg != "--force"]
+    if not args:
+        print("用法：python -m Simulated.simulated_patient.evolve_store [--force] <evolve.csv> [...]")
+        sys.exit(1)
+    for arg in args:
+        migrate_csv(arg, force="--force" in sys.argv[1:])
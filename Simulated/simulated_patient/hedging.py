@@ -0,0 +1,193 @@
+"""
+降低 LLM 尾延迟：按调用点（prompt_key）统计最近的延迟分布，
+  - 对冲请求：调用耗时超过该调用点的第 LLM_HEDGE_PERCENTILE 百分位（且有空闲并发名额）时，
+    再发一个相同的请求，先返回者胜出，另一个被取消（被取消的请求可能仍会计费）；
+  - 按调用点设置单次请求超时；
+  - 熔断：主模型连续 LLM_BREAKER_FAILURES 次超时 / 连接错误 / 5xx 后，冷却期内改用 lite 模型，
+    冷却结束后放行一个探测请求，成功即恢复。
+  LLM_HEDGE_PERCENTILE   触发对冲的延迟百分位，如 95；默认 0（关闭）
+  LLM_HEDGE_MIN_SAMPLES  调用点累计到这么多次延迟样本后才会对冲，默认 20
+  LLM_LATENCY_WINDOW     每个调用点保留的最近样本数，默认 200
+  LLM_TIMEOUTS           单次请求超时（秒），如 "doctor_question_info=30,patient_answer_generator=30,*=90"；
+                         未列出的调用点使用 * 或 LLM_TIMEOUT；格式重试（"x:retry"）未单独列出时沿用 x 的超时
+  LLM_BREAKER_FAILURES   熔断阈值（连续失败次数），默认 5；设为 0 关闭熔断与降级
+  LLM_BREAKER_COOLDOWN   熔断后的冷却秒数，默认 30
+"""
+import os
+import time
+import asyncio
+import threading
+from collections import defaultdict, deque, Counter
+
+import numpy as np
+from openai import APIConnectionError, APITimeoutError, InternalServerError
+
+from Simulated.simulated_patient.routing import RETRY_SUFFIX
+
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_LATENCY_WINDOW = int(os.getenv("LLM_LATENCY_WINDOW", "200"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+
+# 视为主模型服务异常的错误（APITimeoutError 是 APIConnectionError 的子类）
+DEGRADED_ERRORS = (APIConnectionError, InternalServerError)
+
+
+CLOSED, PROBE = "closed", "probe"
+
+
+def parse_timeouts(spec: str) -> dict:
+    timeouts = {}
+    for item in spec.split(","):
+        key, sep, seconds = item.strip().rpartition("=")
+        if sep:
+            timeouts[key.strip()] = float(seconds)
+    return timeouts
+
+
+LLM_TIMEOUTS = parse_timeouts(os.getenv("LLM_TIMEOUTS", ""))
+
+
+def timeout_for(prompt_key=None):
+    """调用点的单次请求超时；未配置时返回 None（使用客户端的 LLM_TIMEOUT）。"""
+    key = prompt_key or "unlabeled"
+    if key not in LLM_TIMEOUTS and key.endswith(RETRY_SUFFIX):
+        key = key[:-len(RETRY_SUFFIX)]
+    return LLM_TIMEOUTS.get(key, LLM_TIMEOUTS.get("*"))
+
+
+class LatencyTracker:
+    """各调用点最近的延迟样本与对冲 / 超时 / 降级计数。"""
+
+    def __init__(self, window: int = LLM_LATENCY_WINDOW):
+        self._lock = threading.Lock()
+        self._samples = defaultdict(lambda: deque(maxlen=window))
+        self._counts = defaultdict(Counter)
+
+    def record(self, prompt_key, seconds: float):
+        with self._lock:
+            self._samples[prompt_key or "unlabeled"].append(seconds)
+            self._counts[prompt_key or "unlabeled"]["requests"] += 1
+
+    def count(self, prompt_key, event: str):
+        with self._lock:
+            self._counts[prompt_key or "unlabeled"][event] += 1
+
+    def hedge_delay(self, prompt_key, percentile: float = LLM_HEDGE_PERCENTILE):
+        """样本足够时返回对冲等待秒数，否则返回 None（不对冲）。"""
+        if percentile <= 0:
+            return None
+        with self._lock:
+            samples = list(self._samples.get(prompt_key or "unlabeled", ()))
+        if len(samples) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        return float(np.percentile(samples, percentile))
+
+    def snapshot(self) -> dict:
+        """{prompt_key: {requests, p50_ms, p95_ms, p99_ms, hedged, hedge_wins, timeouts, errors, fallbacks}}"""
+        with self._lock:
+            keys = set(self._samples) | set(self._counts)
+            table = {}
+            for key in sorted(keys):
+                samples = np.fromiter(self._samples.get(key, ()), dtype=float)
+                row = dict(self._counts[key])
+                if samples.size:
+                    p50, p95, p99 = np.percentile(samples, [50, 95, 99]) * 1000
+                    row.update(p50_ms=round(p50, 1), p95_ms=round(p95, 1), p99_ms=round(p99, 1))
+                table[key] = row
+        return table
+
+
+class CircuitBreaker:
+    """按模型统计连续失败；打开后冷却期内 available() 为 False，冷却结束放行一个探测请求。"""
+
+    def __init__(self, failures: int = LLM_BREAKER_FAILURES, cooldown: float = LLM_BREAKER_COOLDOWN):
+        self.failures = failures
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._state = defaultdict(lambda: {"failures": 0, "opened_at": None, "probing": False, "opened": 0})
+
+    def allow(self, model):
+        """返回 CLOSED（正常放行）、PROBE（本次调用是冷却结束后的探测请求）或 None（熔断中）。"""
+        if self.failures <= 0:
+            return CLOSED
+        with self._lock:
+            state = self._state[model]
+            if state["opened_at"] is None:
+                return CLOSED
+            if state["probing"] or time.monotonic() - state["opened_at"] < self.cooldown:
+                return None
+            state["probing"] = True
+            return PROBE
+
+    def available(self, model) -> bool:
+        return self.allow(model) is not None
+
+    def success(self, model):
+        with self._lock:
+            state = self._state[model]
+            state.update(failures=0, opened_at=None, probing=False)
+
+    def release(self, model, failed: bool):
+        """
+        探测请求既没有成功、也不是服务异常（success / failure 之外）时调用：被取消时不计结果，
+        下一次调用重新探测；其他异常（限流重试耗尽、4xx 等）按失败处理，重新冷却。
+        """
+        with self._lock:
+            state = self._state[model]
+            if not state["probing"]:
+                return
+            state["probing"] = False
+            if failed:
+                state["opened_at"] = time.monotonic()
+
+    def failure(self, model):
+        with self._lock:
+            state = self._state[model]
+            state["failures"] += 1
+            if state["probing"] or (self.failures > 0 and state["failures"] >= self.failures):
+                if state["opened_at"] is None:
+                    state["opened"] += 1
+                state.update(opened_at=time.monotonic(), probing=False)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                model: {"open": state["opened_at"] is not None, "failures": state["failures"], "opened": state["opened"]}
+                for model, state in self._state.items()
+            }
+
+
+def failure_kind(exc) -> str:
+    return "timeouts" if isinstance(exc, APITimeoutError) else "errors"
+
+
+async def hedged(factory, delay=None, can_hedge=None):
+    """
+    执行 factory() 创建的协程；超过 delay 秒仍未完成且 can_hedge() 为真时再执行一次，取先成功者。
+    返回 (结果, 对冲情况)，对冲情况为 None（未对冲）、"fired"（原请求胜出）或 "won"（对冲请求胜出）。
+    """
+    first = asyncio.ensure_future(factory())
+    tasks = [first]
+    try:
+        if delay is None:
+            return await first, None
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done or (can_hedge is not None and not can_hedge()):
+            return await first, None
+        second = asyncio.ensure_future(factory())
+        tasks.append(second)
+        pending = {first, second}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result(), "won" if task is second else "fired"
+        # 两个请求都失败，抛出原请求的异常
+        return first.result(), "fired"
+    finally:
+        # 胜出后（或调用方被取消时）取消仍在进行的请求
+        for task in tasks:
+            if not task.done():
+                task.cancel()
@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+
+
+def make_key(model, messages, temperature, top_p) -> str:
+    """按 (model, messages, temperature, top_p) 计算内容寻址的缓存键。"""
+    payload = json.dumps(
+        {"model": model, "messages": messages, "temperature": temperature, "top_p": top_p},
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    基于 SQLite 的 LLM 响应缓存。
+    - max_bytes：缓存总大小上限，超出后按最近访问时间（LRU）淘汰；
+    - ttl：条目有效期（秒），过期条目视为未命中并被删除；
+    - bypass：不读缓存，但仍把新响应写入（用于刷新缓存）。
+    命中时累计原始请求耗时，用于统计节省的调用次数与秒数。
+    """
+
+    def __init__(self, path, max_bytes=None, ttl=None, bypass=False):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bypass = bypass
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, "
+            "latency REAL NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON responses (last_access)")
+        self._conn.commit()
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "saved_calls": self.hits,
+            "saved_seconds": round(self.saved_seconds, 3),
+            "entries": entries,
+            "bytes": self._total_bytes,
+        }
+
+    def get(self, key):
+        if self.bypass:
+            return None
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, latency, created_at, size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and self.ttl and now - row[2] > self.ttl:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                self._total_bytes -= row[3]
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            self.saved_seconds += row[1]
+        return json.loads(row[0])
+
+    def put(self, key, response, latency: float):
+        data = json.dumps(response, ensure_ascii=False)
+        size = len(data.encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, latency, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, data, size, latency, now, now),
+            )
+            self._total_bytes += size - (old[0] if old else 0)
+            self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now):
+        if self.ttl:
+            expired = self._conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses WHERE created_at < ?", (now - self.ttl,)
+            ).fetchone()[0]
+            if expired:
+                self._conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,))
+                self._total_bytes -= expired
+        if self.max_bytes:
+            while self._total_bytes > self.max_bytes:
+                rows = self._conn.execute(
+                    "SELECT key, size FROM responses ORDER BY last_access LIMIT 64"
+                ).fetchall()
+                if not rows:
+                    break
+                for key, size in rows:
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._total_bytes -= size
+                    if self._total_bytes <= self.max_bytes:
+                        break
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+            self._total_bytes = 0
+
+
+def cache_from_env():
+    """
+    根据环境变量创建缓存；未设置 LLM_CACHE_PATH 时返回 None（不启用缓存）。
+      LLM_CACHE_PATH    缓存文件路径，例如 make_task/llm_cache.sqlite
+      LLM_CACHE_MAX_MB  缓存大小上限（MB），默认 512
+      LLM_CACHE_TTL     条目有效期（秒），默认不过期
+      LLM_CACHE_BYPASS  设为 1 时跳过读取、仅写入
+    """
+    path = os.getenv("LLM_CACHE_PATH", "").strip()
+    if not path:
+        return None
+    max_mb = float(os.getenv("LLM_CACHE_MAX_MB", "512"))
+    ttl = float(os.getenv("LLM_CACHE_TTL", "0")) or None
+    bypass = os.getenv("LLM_CACHE_BYPASS", "0") == "1"
+    return ResponseCache(path, max_bytes=int(max_mb * 1024 * 1024), ttl=ttl, bypass=bypass)
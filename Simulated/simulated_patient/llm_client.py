@@ -0,0 +1,92 @@
+"""
+共享的 OpenAI 客户端。首次使用时才读取配置（含 .env）并创建客户端，导入本模块及 api_call 等
+不需要密钥、也不建立连接；对话与 embedding 请求共用同一个 keep-alive 连接池。
+  OPENAI_API_KEY       密钥，首次请求时检查
+  BASE_URL             对话接口地址
+  OPENAI_API_BASE      embedding 接口地址（get_embedding_client），未设置时用调用方给出的默认地址
+  LLM_MAX_CONCURRENCY  连接池大小，默认 8（与 api_call 的并发上限一致）
+  LLM_TIMEOUT          单次请求超时秒数，默认 60；LLM_CONNECT_TIMEOUT 建立连接超时，默认 10
+  LLM_MAX_RETRIES      同步客户端对连接错误、429 与 5xx 的自动重试次数（指数退避），默认 2；
+                       异步客户端不自动重试，由 api_call 的调度（429 退避）、对冲与熔断负责
+"""
+import os
+import threading
+
+import httpx
+from dotenv import load_dotenv
+from openai import OpenAI, AsyncOpenAI
+
+POOL_SIZE = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+KEEPALIVE_EXPIRY = 30.0
+
+_clients = {}
+_clients_lock = threading.Lock()
+_env_loaded = False
+
+
+def set_pool_size(size: int):
+    """调整连接池大小；只影响之后新建的客户端，应在发出第一个请求之前调用。"""
+    global POOL_SIZE
+    POOL_SIZE = size
+
+
+def _load_env():
+    """.env 只在首次需要配置时读取一次。"""
+    global _env_loaded
+    if not _env_loaded:
+        load_dotenv()
+        _env_loaded = True
+
+
+def _settings(base_url=None) -> dict:
+    _load_env()
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise RuntimeError("未检测到 OPENAI_API_KEY，请在系统或 .env 中设置。")
+    settings = {
+        "api_key": api_key,
+        "timeout": httpx.Timeout(float(os.getenv("LLM_TIMEOUT", "60")),
+                                 connect=float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))),
+        "max_retries": int(os.getenv("LLM_MAX_RETRIES", "2")),
+    }
+    base_url = base_url or os.getenv("BASE_URL")
+    if base_url:
+        settings["base_url"] = base_url
+    return settings
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=POOL_SIZE,
+        max_keepalive_connections=POOL_SIZE,
+        keepalive_expiry=KEEPALIVE_EXPIRY,
+    )
+
+
+def get_async_client(base_url=None) -> AsyncOpenAI:
+    """api_call 后台事件循环使用的异步客户端（只应在该事件循环中使用）。"""
+    key = ("async", base_url)
+    with _clients_lock:
+        if key not in _clients:
+            # SDK 的重试发生在调度名额之内：429 重试绕过令牌桶，超时要等 (重试次数 + 1) 倍才被熔断看到
+            settings = {**_settings(base_url), "max_retries": 0}
+            _clients[key] = AsyncOpenAI(
+                **settings, http_client=httpx.AsyncClient(limits=_limits(), timeout=settings["timeout"])
+            )
+        return _clients[key]
+
+
+def get_client(base_url=None) -> OpenAI:
+    """同步客户端，可在任意线程中共享使用。"""
+    key = ("sync", base_url)
+    with _clients_lock:
+        if key not in _clients:
+            settings = _settings(base_url)
+            _clients[key] = OpenAI(**settings, http_client=httpx.Client(limits=_limits(), timeout=settings["timeout"]))
+        return _clients[key]
+
+
+def get_embedding_client(default_base_url=None) -> OpenAI:
+    """embedding 使用的同步客户端：地址取 OPENAI_API_BASE（读取 .env 之后），未设置时为 default_base_url。"""
+    _load_env()
+    return get_client(os.getenv("OPENAI_API_BASE") or default_base_url)
@@ -2,23 +2,29 @@ import os
 import random
 import json
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-from Simulated.simulated_patient.api_call import llm_api
+from Simulated.simulated_patient.api_call import llm_api, get_text_embedding, embedding_endpoint
 from Simulated.simulated_patient.agent_evolve import store_patient_qa, agent_evolving_patient
 from RAG.rag import rag_patient
 from make_task.overall_assessment_llm import overall_assessment_patient
+from Simulated.simulated_patient.token_usage import tracked_agent
+from Simulated.simulated_patient.postprocess import inline, split_future
+from Simulated.simulated_patient.concurrency import submit_with_context
+from Simulated.simulated_patient.case_context import CaseContext, load_prompts
+from Simulated.simulated_patient.tracing import traced
+from Simulated.simulated_patient.routing import retry_key
+from Simulated.simulated_patient.streaming import STAR_FIELD
 
 
 def question_detect(doctor_question: str) -> bool:
     """返回 True 表示问题过于泛泛；False 表示具体可答。"""
-    json_file_path = Path("Simulated/Prompt/prompt_data.json")
-    with json_file_path.open("r", encoding="utf-8") as file:
-        data = json.load(file)
-        prompt = "".join(data["question_general_detect"])
-    prompt = prompt.format(question=doctor_question)
+    prompt = load_prompts()["question_general_detect"].format(question=doctor_question)
     messages = [{"role": "user", "content": prompt}]
-    res = llm_api(messages)
+    res = llm_api(messages, prompt_key="question_general_detect")
     return not (("是" in res) or ("yes" in res.lower()))
 
 
@@ -38,18 +44,38 @@ def match_requirements(context: str) -> str:
     return matches[0] if matches else ""
 
 
+def _timed(timings: dict, stage: str, fn, *args, **kwargs):
+    """执行 fn 并把耗时（秒）记到 timings[stage]。"""
+    start = time.perf_counter()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        timings[stage] = round(time.perf_counter() - start, 4)
+
+
 class Patient:
-    def __init__(self, vague_info: str = "", resource: str = "", folder_path: str = "", prompt_data=None):
+    agent_name = "patient"
+
+    def __init__(self, case: CaseContext, prompt_data=None, postprocessor=None):
         self.profile = ""
-        self.vague_info = vague_info
-        self.resource = resource
-        self.directory = Path(folder_path) if folder_path else Path(".")
-        self.prompt_data = prompt_data or {}
+        # 病例信息只来自 case，prompt_data 是只读的共享 prompt 注册表
+        self.case = case
+        self.vague_info = case.vague_resource
+        self.resource = case.resource
+        self.directory = Path(case.directory)
+        self.prompt_data = prompt_data or load_prompts()
         self.crisis = ""
+        # 多个医生可能并发向同一病人提问，对话记录的追加需要互斥
+        self._dialog_lock = threading.Lock()
+        # 质量评估与进化记忆写入交给 postprocessor；未指定时同步执行
+        self.postprocessor = postprocessor or inline
+        # 最近一次回答各阶段的耗时（秒），同时追加到 patient_timing.jsonl
+        self.last_timings = {}
 
         # 确保用于记录对话的目录存在
         self.directory.mkdir(parents=True, exist_ok=True)
 
+    @tracked_agent
     def generate_patient_question(self) -> str:
         prompt_tpl = self.prompt_data["patient_question_generator"]
         random_profile_num = random.randint(0, 100)
@@ -58,16 +84,21 @@ class Patient:
 
         prompt = prompt_tpl.format(profile=self.profile, information=self.vague_info)
         messages = [{"role": "user", "content": prompt}]
-        return llm_api(messages)
+        # 调用方只取首个 **...**（match_star）
+        return llm_api(messages, prompt_key="patient_question_generator", fields=(STAR_FIELD,))
 
+    @tracked_agent
     def assign_office(self) -> str:
-        prompt = self.prompt_data["assign_doctor_office"] + self.prompt_data["vague_resource"]
+        prompt = self.prompt_data["assign_doctor_office"] + self.vague_info
         messages = [{"role": "user", "content": prompt}]
-        office = llm_api(messages)
+        office = llm_api(messages, prompt_key="assign_doctor_office", fields=(STAR_FIELD,))
         print("科室：", office)
         return office
 
-    def patient_ans(self, question: str):
+    @tracked_agent
+    @traced("patient.answer")
+    def patient_ans(self, question: str, on_delta=None):
+        """on_delta 不为空时流式生成回答并逐段交给它（交互模式下实时显示）。"""
         # 如果需要，可打开对泛化问题的检测：
         # not_general_flag = question_detect(question)
         not_general_flag = True
@@ -75,23 +106,40 @@ class Patient:
         # 返回值的安全默认值
         score = rel = faith = human = 0
         ans = ""
+        timings = {}
+        start = time.perf_counter()
 
         if not_general_flag:
             prompt_tpl = self.prompt_data["patient_answer_generator"]
 
-            useful_info = rag_patient(
-                question,
-                self.resource,
-                size=120,
-                overlap=40,
-                top_k=2,
-            )
-
             # 进化样例检索（相似问答 few-shot）
             patient_evolve_csv = Path("dataset") / "patient_evolve.csv"
             patient_evolve_csv.parent.mkdir(parents=True, exist_ok=True)
 
-            patient_evolve_info = agent_evolving_patient(str(patient_evolve_csv), question)
+            # RAG 与进化样例检索互不依赖：问题只向量化一次，两者并发检索
+            turn_start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                # 问题向量在回答的关键路径上，与回答生成同级调度
+                embedding = submit_with_context(
+                    pool, _timed, timings, "embedding", get_text_embedding, question, prompt_key="patient_answer_generator"
+                )
+                rag = submit_with_context(
+                    pool, _timed, timings, "rag", rag_patient,
+                    question,
+                    self.resource,
+                    size=120,
+                    overlap=40,
+                    top_k=2,
+                    query_embedding=embedding,
+                    query_endpoint=embedding_endpoint(),
+                )
+                qus_embedding = embedding.result()
+                patient_evolve_info = _timed(
+                    timings, "evolve", agent_evolving_patient, str(patient_evolve_csv), question, qus_embedding
+                )
+                useful_info = rag.result()
+            timings["retrieval"] = round(time.perf_counter() - turn_start, 4)
+
             attention_requirements = ""
             few_shot_example = ""
 
@@ -124,48 +172,69 @@ class Patient:
             )
 
             messages = [{"role": "user", "content": prompt}]
-            ans = llm_api(messages)
-
-            # 质量评估（达到阈值则入库并动态抽取“注意事项”）
-            score, rel, faith, human = overall_assessment_patient(question, useful_info, ans, self.profile)
-
-            if score >= 3:
-                dyn_req_tpl = self.prompt_data["dynamic_requirements"]
-                dyn_prompt = dyn_req_tpl.format(question=question)
-                dyn_msg = [{"role": "user", "content": dyn_prompt}]
-
-                # 稳健提取一次 **...** 的 requirements
-                for _ in range(3):
-                    requirements_raw = llm_api(dyn_msg)
-                    requirements = match_requirements(requirements_raw)
-                    if requirements:
-                        store_patient_qa(str(patient_evolve_csv), question, useful_info, ans, requirements)
-                        break
+            ans = _timed(timings, "answer", llm_api, messages, prompt_key="patient_answer_generator", on_delta=on_delta)
+
+            # 质量评估与入库不影响本轮回答，交给 postprocessor；后台执行时分数以 Future 返回
+            pending = self.postprocessor.submit(
+                self.assess_answer, str(patient_evolve_csv), question, useful_info, ans
+            )
+            if self.postprocessor.deferred:
+                score, rel, faith, human = split_future(pending, 4)
+            else:
+                score, rel, faith, human = pending.result()
         else:
             ans = "医生，这个问题太空泛了，要不就是我有点不太明白，问一些具体的吧，而且我也听不懂医学名词，要我去做检查倒是可以。"
 
         # 追加对话到相对路径文件
         dq_path = self.directory / "doctor_question.txt"
-        with dq_path.open("a", encoding="utf-8") as f:
+        with self._dialog_lock, dq_path.open("a", encoding="utf-8") as f:
             f.write("--- dialog ---\n")
             f.write(f"doctor question: {question}\n")
             f.write(f"patient answer: {ans}\n")
 
+        timings["total"] = round(time.perf_counter() - start, 4)
+        self.last_timings = timings
+        with self._dialog_lock, (self.directory / "patient_timing.jsonl").open("a", encoding="utf-8") as f:
+            f.write(json.dumps({"question": question, **timings}, ensure_ascii=False) + "\n")
+
         return ans, score, rel, faith, human
 
+    @tracked_agent
+    @traced("postprocess.patient", "postprocess")
+    def assess_answer(self, evolve_csv: str, question: str, useful_info: str, ans: str):
+        """质量评估（达到阈值则动态抽取“注意事项”并入库），返回 (score, rel, faith, human)。"""
+        score, rel, faith, human = overall_assessment_patient(question, useful_info, ans, self.profile)
+
+        if score >= 3:
+            dyn_req_tpl = self.prompt_data["dynamic_requirements"]
+            dyn_prompt = dyn_req_tpl.format(question=question)
+            dyn_msg = [{"role": "user", "content": dyn_prompt}]
+
+            # 稳健提取一次 **...** 的 requirements；格式不对时的重试按 format_retry 路由，
+            # 且不读响应缓存（相同的模型与消息会命中同一条格式错误的缓存回答）
+            for attempt in range(3):
+                prompt_key = "dynamic_requirements" if attempt == 0 else retry_key("dynamic_requirements")
+                requirements_raw = llm_api(dyn_msg, prompt_key=prompt_key, cache=attempt == 0)
+                requirements = match_requirements(requirements_raw)
+                if requirements:
+                    store_patient_qa(evolve_csv, question, useful_info, ans, requirements)
+                    break
+        return score, rel, faith, human
+
+    @tracked_agent
     def patient_crisis_ans(self, doctor_ans: str) -> str:
         prompt = self.prompt_data["patient_crisis_answer"].format(
             profile=self.profile, information=self.resource, crisis=self.crisis, doctor_answer=doctor_ans
         )
         messages = [{"role": "user", "content": prompt}]
-        return llm_api(messages)
+        return llm_api(messages, prompt_key="patient_crisis_answer")
 
+    @tracked_agent
     def crisis_begin(self) -> str:
         prompt_tpl = self.prompt_data["patient_crisis_generator"]
-        resource = self.prompt_data["resource"]
-        prompt = prompt_tpl.format(information=resource)
+        prompt = prompt_tpl.format(information=self.resource)
 
         messages = [{"role": "user", "content": prompt}]
-        patient_crisis = llm_api(messages)
+        patient_crisis = llm_api(messages, prompt_key="patient_crisis_generator")
         self.crisis = patient_crisis
         return patient_crisis
@@ -0,0 +1,138 @@
+"""
+回答生成之后的后处理（质量评估、动态要求抽取、进化记忆写入）不在关键路径上，
+交给有界队列 + 工作线程在后台执行；病例结束时 close() 等待全部完成，check() 在有任务失败时抛出
+PostProcessError，病例按失败处理。
+  POSTPROCESS_WORKERS     后台工作线程数，默认 2；设为 0 时在调用线程中同步执行
+  POSTPROCESS_QUEUE_SIZE  队列容量，队列满时提交方阻塞，默认 64
+"""
+import os
+import queue
+import threading
+import contextvars
+import traceback
+from concurrent.futures import Future
+
+from Simulated.simulated_patient.rate_limit import run_as_background
+
+POSTPROCESS_WORKERS = int(os.getenv("POSTPROCESS_WORKERS", "2"))
+POSTPROCESS_QUEUE_SIZE = int(os.getenv("POSTPROCESS_QUEUE_SIZE", "64"))
+
+
+def resolve(value):
+    """后台任务产生的值以 Future 传递，使用时再取结果；普通值原样返回。"""
+    return value.result() if isinstance(value, Future) else value
+
+
+def settle(value, default=0):
+    """与 resolve 相同，但前序后台任务失败时返回 default：异常已由 postprocessor 报告并计入 failed，不再沿轮次级联。"""
+    if isinstance(value, Future):
+        return default if value.exception() is not None else value.result()
+    return value
+
+
+class PostProcessError(RuntimeError):
+    """病例的后台后处理任务有失败。"""
+
+
+def split_future(future: Future, n: int):
+    """把结果为 n 元组的 Future 拆成 n 个 Future。"""
+    parts = [Future() for _ in range(n)]
+
+    def _done(f):
+        exc = f.exception()
+        for i, part in enumerate(parts):
+            if exc is not None:
+                part.set_exception(exc)
+            else:
+                part.set_result(f.result()[i])
+
+    future.add_done_callback(_done)
+    return parts
+
+
+class InlineProcessor:
+    """同步执行：submit 立即运行任务，异常直接抛给调用方。"""
+    deferred = False
+    failed = 0
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        future = Future()
+        future.set_result(fn(*args, **kwargs))
+        return future
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def check(self):
+        pass
+
+
+class PostProcessor:
+    """后台执行：submit 把任务放入有界队列并立即返回 Future。"""
+    deferred = True
+
+    def __init__(self, workers: int = POSTPROCESS_WORKERS, maxsize: int = POSTPROCESS_QUEUE_SIZE):
+        self._queue = queue.Queue(maxsize)
+        self.failed = 0
+        self._closed = False
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"postprocess-{i}", daemon=True)
+            for i in range(max(1, workers))
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        future = Future()
+        # 带上提交方的 contextvars，后台调用的 token 仍记在对应病例 / 智能体名下
+        self._queue.put((future, contextvars.copy_context(), fn, args, kwargs))
+        return future
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                future, ctx, fn, args, kwargs = item
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    # 后台任务中的 LLM 调用按后台优先级排队，让位于关键路径
+                    future.set_result(ctx.run(run_as_background, fn, *args, **kwargs))
+                except BaseException as exc:
+                    self.failed += 1
+                    traceback.print_exception(exc)
+                    future.set_exception(exc)
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """等待已提交的任务全部完成。"""
+        self._queue.join()
+
+    def close(self):
+        """等待任务完成并停止工作线程；可重复调用。"""
+        if self._closed:
+            return
+        self._closed = True
+        self.flush()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def check(self):
+        """有任务失败时抛出 PostProcessError（应在 close() 之后调用）。"""
+        if self.failed:
+            raise PostProcessError(f"{self.failed} 个后处理任务失败")
+
+
+inline = InlineProcessor()
+
+
+def make_postprocessor():
+    return PostProcessor() if POSTPROCESS_WORKERS > 0 else inline
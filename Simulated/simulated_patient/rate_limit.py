@@ -0,0 +1,209 @@
+"""
+LLM / embedding 请求的调度：在 api_call 的后台事件循环上，按优先级分配并发名额，
+并用两个令牌桶限制每分钟请求数与（估算的）token 数，在触发服务商限流之前主动排队。
+关键路径（医生提问、患者回答）先于普通调用，普通调用先于后台调用（质量评估、总结、
+动态要求、embedding 以及后处理线程中的所有调用）。遇到 429 时让出名额、清空请求桶，
+按带随机抖动的指数退避重试。
+  LLM_RPM            每分钟请求数上限，默认 0（不限）
+  LLM_TPM            每分钟 token 数上限，默认 0（不限）；发送前按字符数估算，返回后按实际用量校正
+  LLM_RATE_RETRIES   429 后的重试次数，默认 5
+  LLM_BACKOFF_BASE   退避基数秒数，默认 1；第 n 次重试等待 [0, min(LLM_BACKOFF_MAX, base * 2^n)) 内的随机时长
+  LLM_BACKOFF_MAX    单次退避上限秒数，默认 60
+"""
+import os
+import time
+import heapq
+import random
+import asyncio
+import itertools
+import contextvars
+from contextlib import asynccontextmanager
+
+from openai import RateLimitError
+
+LLM_RPM = int(os.getenv("LLM_RPM", "0"))
+LLM_TPM = int(os.getenv("LLM_TPM", "0"))
+LLM_RATE_RETRIES = int(os.getenv("LLM_RATE_RETRIES", "5"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "1"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "60"))
+
+CRITICAL, NORMAL, BACKGROUND = 0, 1, 2
+PRIORITY_NAMES = {CRITICAL: "critical", NORMAL: "normal", BACKGROUND: "background"}
+
+CRITICAL_KEYS = frozenset({"doctor_question_info", "patient_answer_generator"})
+BACKGROUND_KEYS = frozenset({
+    "summary", "summary_memory", "crisis_memory_summary", "dynamic_requirements",
+    "quality_check_evolve", "embedding",
+})
+# 回答的 token 数无法预知，估算时按此值预留
+COMPLETION_TOKENS_ESTIMATE = 256
+
+_scope = contextvars.ContextVar("request_priority", default=None)
+
+
+def priority_for(prompt_key=None) -> int:
+    """调用点的优先级：关键路径的键始终优先；后台键或处于后台任务中的调用为后台优先级。"""
+    prompt_key = (prompt_key or "").split(":")[0]  # 格式重试（"<key>:retry"）与原调用点同级
+    if prompt_key in CRITICAL_KEYS:
+        return CRITICAL
+    if prompt_key in BACKGROUND_KEYS or _scope.get() == BACKGROUND:
+        return BACKGROUND
+    return NORMAL
+
+
+def run_as_background(fn, *args, **kwargs):
+    """在后台优先级下执行 fn（供后处理工作线程使用，需在 ctx.run 内调用）。"""
+    _scope.set(BACKGROUND)
+    return fn(*args, **kwargs)
+
+
+def estimate_tokens(texts, completion: int = COMPLETION_TOKENS_ESTIMATE) -> int:
+    # 中文约 1 字 1 token，按字符数估算偏保守
+    return sum(len(text or "") for text in texts) + completion
+
+
+class TokenBucket:
+    """每分钟补满 per_minute 个令牌；单次消耗超过容量时按容量计，余额可以为负（欠账）。"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, cost: float) -> float:
+        self._refill()
+        missing = min(cost, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+    def take(self, cost: float):
+        self._refill()
+        self.level -= min(cost, self.capacity)
+
+    def adjust(self, delta: float):
+        self.level = min(self.capacity, self.level - delta)
+
+    def drain(self):
+        self._refill()
+        self.level = min(self.level, 0.0)
+
+
+class Scheduler:
+    """按优先级（同级先到先得）发放并发名额；只在一个事件循环中使用，无需加锁。"""
+
+    def __init__(self, max_concurrency: int, rpm: int = LLM_RPM, tpm: int = LLM_TPM):
+        self.max_concurrency = max_concurrency
+        self.requests = TokenBucket(rpm) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm) if tpm > 0 else None
+        self.in_flight = 0
+        self._waiters = []
+        self._seq = itertools.count()
+        self._timer = None
+        self.stats = {name: {"requests": 0, "wait_seconds": 0.0} for name in PRIORITY_NAMES.values()}
+        self.stats["rate_limited"] = 0
+
+    def _throttle_delay(self, tokens: int) -> float:
+        delay = 0.0
+        if self.requests:
+            delay = max(delay, self.requests.wait_time(1))
+        if self.tokens:
+            delay = max(delay, self.tokens.wait_time(tokens))
+        return delay
+
+    def _dispatch(self):
+        self._timer = None
+        while self._waiters and self.in_flight < self.max_concurrency:
+            _, _, tokens, future = self._waiters[0]
+            if future.cancelled():
+                heapq.heappop(self._waiters)
+                continue
+            delay = self._throttle_delay(tokens)
+            if delay > 0:
+                self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+            heapq.heappop(self._waiters)
+            if self.requests:
+                self.requests.take(1)
+            if self.tokens:
+                self.tokens.take(tokens)
+            self.in_flight += 1
+            future.set_result(None)
+
+    def _kick(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, priority: int, tokens: int):
+        """占用一个名额直到离开 with 块；tokens 为估算的 token 数。"""
+        start = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), tokens, future))
+        self._kick()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+        stats = self.stats[PRIORITY_NAMES[priority]]
+        stats["requests"] += 1
+        stats["wait_seconds"] += time.monotonic() - start
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self):
+        self.in_flight -= 1
+        self._kick()
+
+    def has_idle_slot(self) -> bool:
+        return self.in_flight < self.max_concurrency and not self._waiters
+
+    def settle(self, estimated: int, actual: int):
+        """用实际 token 用量校正令牌桶。"""
+        if self.tokens and actual:
+            self.tokens.adjust(actual - estimated)
+
+    def rate_limited(self):
+        """收到 429：清空请求桶，让排队的请求一起等待。"""
+        self.stats["rate_limited"] += 1
+        if self.requests:
+            self.requests.drain()
+
+    def snapshot(self) -> dict:
+        snapshot = {
+            name: {"requests": s["requests"], "wait_seconds": round(s["wait_seconds"], 3)}
+            for name, s in self.stats.items() if isinstance(s, dict)
+        }
+        snapshot["rate_limited"] = self.stats["rate_limited"]
+        snapshot["queued"] = len(self._waiters)
+        return snapshot
+
+
+def backoff_delay(attempt: int, base: float = LLM_BACKOFF_BASE, cap: float = LLM_BACKOFF_MAX) -> float:
+    """full jitter：[0, min(cap, base * 2^attempt)) 内均匀取值。"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+async def with_backoff(factory, scheduler=None, retries: int = LLM_RATE_RETRIES):
+    """
+    执行 factory() 创建的协程，遇到 RateLimitError 时退避后重新创建并执行
+    （协程只能 await 一次，因此传入工厂而不是协程本身）。
+    """
+    for attempt in range(retries + 1):
+        try:
+            return await factory()
+        except RateLimitError:
+            if attempt == retries:
+                raise
+            if scheduler is not None:
+                scheduler.rate_limited()
+            await asyncio.sleep(backoff_delay(attempt))
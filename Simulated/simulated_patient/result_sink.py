@@ -0,0 +1,113 @@
+"""
+模拟结果的统一写出：每轮问答一条 turn 记录，每个病例一条 case 记录（原始 / 模糊病历、危机事件、
+结论、耗时、token 与缓存统计只存一次），分别追加到 RESULT_DIR 下的 turns.jsonl 与 cases.jsonl。
+记录先放在内存缓冲区，攒够 RESULT_BATCH_SIZE 条或病例结束时批量写出；进程内所有病例共用一个实例。
+  RESULT_DIR         输出目录，默认 results
+  RESULT_BATCH_SIZE  turn 记录的批量大小，默认 64
+
+导出与旧版 question_record.csv 相同列的表格：
+    python -m Simulated.simulated_patient.result_sink results/ question_record.csv
+"""
+import os
+import sys
+import csv
+import json
+import atexit
+import threading
+from pathlib import Path
+
+from Simulated.simulated_patient.tracing import span
+
+RESULT_DIR = os.getenv("RESULT_DIR", "results")
+RESULT_BATCH_SIZE = int(os.getenv("RESULT_BATCH_SIZE", "64"))
+
+LEGACY_COLUMNS = [
+    "row", "question", "answer", "token_count_doctor", "token_count_patient",
+    "resource", "doctor_time", "patient_time", "question_cnt", "answer_cnt",
+]
+
+
+class ResultSink:
+    def __init__(self, directory=RESULT_DIR, batch_size: int = RESULT_BATCH_SIZE):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.turns_path = self.directory / "turns.jsonl"
+        self.cases_path = self.directory / "cases.jsonl"
+        self.batch_size = max(1, batch_size)
+        self._lock = threading.Lock()
+        self._turns = []
+
+    def add_turn(self, record: dict):
+        with self._lock:
+            self._turns.append(record)
+            if len(self._turns) >= self.batch_size:
+                self._write_turns()
+
+    def add_case(self, record: dict):
+        """病例结束时调用：先写出缓冲中的 turn 记录，再写病例记录。"""
+        with self._lock:
+            self._write_turns()
+            self._append(self.cases_path, [record])
+
+    def flush(self):
+        with self._lock:
+            self._write_turns()
+
+    def _write_turns(self):
+        if self._turns:
+            self._append(self.turns_path, self._turns)
+            self._turns = []
+
+    @staticmethod
+    def _append(path: Path, records):
+        with span("results.write", "io", records=len(records)):
+            lines = "".join(json.dumps(record, ensure_ascii=False, default=str) + "\n" for record in records)
+            with path.open("a", encoding="utf-8") as f:
+                f.write(lines)
+
+
+_sink = None
+_sink_lock = threading.Lock()
+
+
+def get_result_sink() -> ResultSink:
+    """进程内共享的写出器，进程退出时写出剩余缓冲。"""
+    global _sink
+    with _sink_lock:
+        if _sink is None:
+            _sink = ResultSink()
+            atexit.register(_sink.flush)
+    return _sink
+
+
+def export_csv(directory, out_path):
+    """把 turns.jsonl 与 cases.jsonl 合并成旧版 question_record.csv 的列格式。"""
+    directory = Path(directory)
+    resources = {}
+    cases_path = directory / "cases.jsonl"
+    if cases_path.is_file():
+        with cases_path.open("r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    case = json.loads(line)
+                    resources[case["run"]] = case.get("resource", "")
+    with (directory / "turns.jsonl").open("r", encoding="utf-8") as f, \
+            Path(out_path).open("w", newline="", encoding="utf-8") as out:
+        writer = csv.writer(out)
+        writer.writerow(LEGACY_COLUMNS)
+        for line in f:
+            if not line.strip():
+                continue
+            turn = json.loads(line)
+            writer.writerow([
+                turn["row"], turn["question"].replace("\n", ""), turn["answer"].replace("\n", ""),
+                turn["token_count_doctor"], turn["token_count_patient"], resources.get(turn["run"], ""),
+                turn["doctor_time"], turn["patient_time"], turn["question_cnt"], turn["answer_cnt"],
+            ])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("用法：python -m Simulated.simulated_patient.result_sink <results 目录> <输出 csv>")
+        sys.exit(1)
+    export_csv(sys.argv[1], sys.argv[2])
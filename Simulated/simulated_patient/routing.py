@@ -0,0 +1,56 @@
+"""
+按调用点（prompt_key）把 llm_api 的请求分配给大模型或 lite 模型。分类、抽取类的短 prompt
+默认走 lite 模型；格式重试（prompt_key 以 ":retry" 结尾，如 "dynamic_requirements:retry"）
+按 "format_retry" 一项路由。llm_api_lite 始终使用 lite 模型。
+  LLM_ROUTES  在默认路由表上覆盖，如 "assign_doctor_office=large,summary=lite"；
+              设为 off 时全部走大模型（即旧行为）
+
+评估某个路由表相对全部走大模型节省的延迟与 token：
+    python benchmark/consultation_bench.py --compare-routes "summary=lite"
+"""
+import os
+
+LARGE, LITE = "large", "lite"
+RETRY_SUFFIX = ":retry"
+
+DEFAULT_ROUTES = {
+    "question_general_detect": LITE,
+    "assign_doctor_office": LITE,
+    "dynamic_requirements": LITE,
+    "patient_crisis_generator": LITE,
+    "format_retry": LITE,
+}
+
+
+def parse_routes(spec: str) -> dict:
+    """"off" 返回空表；否则在默认路由表上应用 "key=large|lite,..." 的覆盖。"""
+    spec = (spec or "").strip()
+    if spec.lower() in ("off", "none", "0"):
+        return {}
+    routes = dict(DEFAULT_ROUTES)
+    for item in spec.split(","):
+        key, sep, target = item.strip().partition("=")
+        if not sep:
+            continue
+        target = target.strip().lower()
+        if target not in (LARGE, LITE):
+            raise ValueError(f"LLM_ROUTES 中 {key} 的目标只能是 large 或 lite：{target}")
+        routes[key.strip()] = target
+    return routes
+
+
+ROUTES = parse_routes(os.getenv("LLM_ROUTES", ""))
+
+
+def retry_key(prompt_key: str) -> str:
+    """格式重试时使用的调用点名。"""
+    return f"{prompt_key}{RETRY_SUFFIX}"
+
+
+def route(prompt_key=None, routes=None) -> str:
+    routes = ROUTES if routes is None else routes
+    if prompt_key in routes:
+        return routes[prompt_key]
+    if prompt_key and prompt_key.endswith(RETRY_SUFFIX):
+        return routes.get("format_retry", route(prompt_key[:-len(RETRY_SUFFIX)], routes))
+    return LARGE
@@ -0,0 +1,104 @@
+"""
+合并相同的在途请求（single-flight）：在 api_call 的后台事件循环上，相同键（对话为
+模型 + 消息 + 采样参数，embedding 为模型 + 文本）的请求已在进行时，后来的调用方直接等待
+它的结果，不再发出上游请求。合并只针对同时在途的请求，结束后即移除；已完成结果的复用由
+响应缓存 / embedding 缓存负责。被合并的请求沿用首个调用方的优先级。
+  LLM_COALESCE  设为 0 关闭合并，默认开启
+"""
+import os
+import asyncio
+from collections import defaultdict, Counter
+
+LLM_COALESCE = os.getenv("LLM_COALESCE", "1").lower() not in ("0", "false", "off", "")
+
+
+class _Flight:
+    """一次上游执行；结果为列表，各键按位置取值。"""
+    __slots__ = ("task", "keys", "waiters", "claimed")
+
+    def __init__(self, task, keys):
+        self.task = task
+        self.keys = keys
+        self.waiters = 0
+        self.claimed = False
+
+
+class SingleFlight:
+    """只在一个事件循环中使用，无需加锁。"""
+
+    def __init__(self, enabled: bool = LLM_COALESCE):
+        self.enabled = enabled
+        self._flights = {}  # key -> (_Flight, 结果中的位置)
+        self.stats = defaultdict(Counter)
+
+    def _start(self, keys, coro):
+        flight = _Flight(asyncio.ensure_future(coro), keys)
+        if self.enabled:
+            for index, key in enumerate(keys):
+                self._flights[key] = (flight, index)
+            flight.task.add_done_callback(lambda _: self._forget(flight))
+        return flight
+
+    def _forget(self, flight):
+        for key in flight.keys:
+            if self._flights.get(key, (None,))[0] is flight:
+                del self._flights[key]
+
+    async def _wait(self, flights):
+        # shield：某个调用方被取消不影响其他调用方；全部调用方都离开后才取消上游请求
+        for flight in flights:
+            flight.waiters += 1
+        try:
+            return await asyncio.gather(*(asyncio.shield(flight.task) for flight in flights))
+        finally:
+            for flight in flights:
+                flight.waiters -= 1
+                if flight.waiters == 0 and not flight.task.done():
+                    # 先移除再取消：任务真正结束前，新的调用方不能再加入这个正在取消的请求
+                    self._forget(flight)
+                    flight.task.cancel()
+
+    async def do(self, kind: str, key, factory):
+        """
+        相同 key 已有在途调用时等待其结果，否则执行 factory()。返回 (结果, 是否为合并的跟随者)；
+        首个拿到结果的调用方不算跟随者（发起者被取消时由跟随者负责记 token 等）。
+        """
+        entry = self._flights.get(key)
+        if entry is not None:
+            flight = entry[0]
+            self.stats[kind]["coalesced"] += 1
+        else:
+            async def single():
+                return [await factory()]
+
+            flight = self._start([key], single())
+            self.stats[kind]["requests"] += 1
+        (result,) = await self._wait([flight])
+        shared, flight.claimed = flight.claimed, True
+        return result[0 if entry is None else entry[1]], shared
+
+    async def do_many(self, kind: str, keys, factory):
+        """
+        keys 互不相同。已在途的键等待原请求，其余的键用 factory(未在途的键) 一起请求
+        （返回与之对齐的结果列表）。返回 (与 keys 对齐的结果, 合并的键数)。
+        """
+        owned = [key for key in keys if key not in self._flights]
+        entries = {}
+        if owned:
+            flight = self._start(owned, factory(owned))
+            entries.update((key, (flight, index)) for index, key in enumerate(owned))
+        entries.update((key, self._flights[key]) for key in keys if key not in entries)
+        self.stats[kind]["requests"] += len(owned)
+        self.stats[kind]["coalesced"] += len(keys) - len(owned)
+        flights = list({id(flight): flight for flight, _ in entries.values()}.values())
+        results = dict(zip(map(id, flights), await self._wait(flights)))
+        return [results[id(entries[key][0])][entries[key][1]] for key in keys], len(keys) - len(owned)
+
+    def snapshot(self) -> dict:
+        """{kind: {requests, coalesced}, in_flight}；requests 为实际发出的请求数（embedding 按文本计）。"""
+        snapshot = {kind: dict(counts) for kind, counts in self.stats.items()}
+        for kind in snapshot:
+            snapshot[kind].setdefault("coalesced", 0)
+            snapshot[kind].setdefault("requests", 0)
+        snapshot["in_flight"] = len({id(flight) for flight, _ in self._flights.values()})
+        return snapshot
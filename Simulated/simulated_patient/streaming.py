@@ -0,0 +1,82 @@
+"""
+流式读取对话回答。调用方只需要回答中的某些字段（如 **问题** 与 ##种类##）时，用 fields 给出
+这些字段的正则；流中每个字段都已出现完整匹配后立即关闭连接，不再等待剩余内容。
+同时记录首个 token 的耗时（TTFT）与所需字段完整的耗时（time-to-field）。
+  LLM_STREAM  设为 1 时所有对话请求都以流式发出（默认 0）；传入 on_delta 的调用总是流式
+提前结束的响应没有 usage，按字符数估算 token；这样的响应不写入响应缓存。
+"""
+import os
+import re
+import time
+
+LLM_STREAM = os.getenv("LLM_STREAM", "0").lower() not in ("0", "false", "off", "")
+
+# 与 simulateflow / patient_agent 的 match_star 一致（跨行）
+STAR_FIELD = re.compile(r"\*\*(.*?)\*\*", re.DOTALL)
+
+
+class FieldExtractor:
+    """逐段接收文本；所有字段都有完整匹配时 feed 返回 True。没有字段时从不提前结束。"""
+
+    def __init__(self, fields=()):
+        self.patterns = [re.compile(field) if isinstance(field, str) else field for field in fields]
+        self._pending = list(self.patterns)
+        self.text = ""
+
+    def feed(self, delta: str) -> bool:
+        self.text += delta
+        if self._pending and delta:
+            self._pending = [pattern for pattern in self._pending if not pattern.search(self.text)]
+        return bool(self.patterns) and not self._pending
+
+
+def signature(fields) -> str:
+    """字段集合的标识，用于区分提前结束与完整读取的请求（合并在途请求时）。"""
+    return "|".join(
+        f"{field}" if isinstance(field, str) else f"{field.pattern}/{field.flags}" for field in fields
+    )
+
+
+async def consume(stream, started: float, fields=(), on_delta=None) -> dict:
+    """
+    读取 AsyncStream，返回与 ChatCompletion.model_dump() 结构相同的字典，另带 stream 字段：
+    {ttft, time_to_field, stopped_early}（秒，从 started 起算）。on_delta 在后台事件循环中调用，应当很快返回。
+    """
+    extractor = FieldExtractor(fields)
+    usage, finish_reason, model, response_id = None, None, None, None
+    ttft = time_to_field = None
+    stopped_early = False
+    try:
+        async for chunk in stream:
+            response_id, model = chunk.id, chunk.model
+            if getattr(chunk, "usage", None):
+                usage = chunk.usage.model_dump()
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            finish_reason = choice.finish_reason or finish_reason
+            delta = choice.delta.content or ""
+            if not delta:
+                continue
+            if ttft is None:
+                ttft = time.perf_counter() - started
+            if on_delta is not None:
+                on_delta(delta)
+            if extractor.feed(delta):
+                time_to_field = time.perf_counter() - started
+                stopped_early = True
+                break
+    finally:
+        await stream.close()
+    return {
+        "id": response_id,
+        "model": model,
+        "object": "chat.completion",
+        "choices": [{
+            "index": 0,
+            "finish_reason": "stop" if stopped_early else finish_reason,
+            "message": {"role": "assistant", "content": extractor.text},
+        }],
+        "usage": usage,
+        "stream": {"ttft": ttft, "time_to_field": time_to_field, "stopped_early": stopped_early},
+    }
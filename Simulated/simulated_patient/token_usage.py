@@ -0,0 +1,115 @@
+import json
+import threading
+import contextvars
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+
+# 当前病例 / 当前智能体，由 case_scope / agent_scope 设置。
+# asyncio 任务会自动继承；线程池中需通过 contextvars.copy_context().run 传递。
+current_case = contextvars.ContextVar("token_case", default="default")
+current_agent = contextvars.ContextVar("token_agent", default="system")
+
+
+class TokenAccounting:
+    """进程内的 token 统计：按 病例 -> (智能体, 调用点) 以及 病例 -> 模型 累加，病例结束时一次性落盘。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(lambda: defaultdict(Counter))
+        self._models = defaultdict(lambda: defaultdict(Counter))
+        self._streams = defaultdict(list)
+
+    def record(self, usage: dict, prompt_key=None, case=None, agent=None, model=None):
+        usage = {k: v for k, v in (usage or {}).items() if isinstance(v, int)}
+        case = case or current_case.get()
+        agent = agent or current_agent.get()
+        prompt_key = prompt_key or "unlabeled"
+        with self._lock:
+            self._counters[case][(agent, prompt_key)].update(usage)
+            if model:
+                self._models[case][model].update(usage)
+            self._streams[case].append((agent, prompt_key, usage))
+
+    def totals(self, case=None) -> Counter:
+        case = case or current_case.get()
+        total = Counter()
+        with self._lock:
+            for counter in self._counters.get(case, {}).values():
+                total.update(counter)
+        return total
+
+    def breakdown(self, case=None) -> dict:
+        case = case or current_case.get()
+        by_agent, by_call_site = defaultdict(Counter), defaultdict(Counter)
+        with self._lock:
+            for (agent, prompt_key), counter in self._counters.get(case, {}).items():
+                by_agent[agent].update(counter)
+                by_call_site[prompt_key].update(counter)
+            by_model = {k: dict(v) for k, v in self._models.get(case, {}).items()}
+        return {
+            "by_agent": {k: dict(v) for k, v in by_agent.items()},
+            "by_call_site": {k: dict(v) for k, v in by_call_site.items()},
+            "by_model": by_model,
+        }
+
+    def pop(self, case=None) -> dict:
+        """取出病例的统计（totals / breakdown / 逐次调用的 stream）并清空。"""
+        case = case or current_case.get()
+        totals = self.totals(case)
+        breakdown = self.breakdown(case)
+        with self._lock:
+            stream = self._streams.pop(case, [])
+            self._counters.pop(case, None)
+            self._models.pop(case, None)
+        return {"totals": dict(totals), "breakdown": breakdown, "stream": stream}
+
+    def flush(self, directory, case=None):
+        """把病例的统计写入 directory（token_overall.txt / token_stream.txt / token_breakdown.json）并清空。"""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        popped = self.pop(case)
+        totals = Counter(popped["totals"])
+
+        overall = "".join(f"{key}: **{value}**\n" for key, value in sorted(totals.items()))
+        lines = []
+        for agent, prompt_key, usage in popped["stream"]:
+            lines.append(f"--- {agent} / {prompt_key} ---\n")
+            lines.extend(f"{key}: **{value}**\n" for key, value in usage.items())
+        (directory / "token_overall.txt").write_text(overall, encoding="utf-8")
+        (directory / "token_stream.txt").write_text("".join(lines), encoding="utf-8")
+        (directory / "token_breakdown.json").write_text(
+            json.dumps(popped["breakdown"], ensure_ascii=False, indent=4), encoding="utf-8"
+        )
+        return totals
+
+
+token_accounting = TokenAccounting()
+
+
+@contextmanager
+def case_scope(case_id: str):
+    token = current_case.set(case_id)
+    try:
+        yield
+    finally:
+        current_case.reset(token)
+
+
+@contextmanager
+def agent_scope(name: str):
+    token = current_agent.set(name)
+    try:
+        yield
+    finally:
+        current_agent.reset(token)
+
+
+def tracked_agent(method):
+    """方法装饰器：调用期间把 self.agent_name 设为当前智能体。"""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with agent_scope(self.agent_name):
+            return method(self, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,146 @@
+"""
+轻量的分段计时（span）。span 可以嵌套，父子关系通过 contextvars 传递，线程池 / 后台任务中
+需像 token 统计一样用 contextvars.copy_context().run 执行；记录按当前病例（token_usage.current_case）归档。
+病例结束时取出该病例的 span，汇总为各阶段的 p50 / p95 / 次数，并可导出为 Chrome trace
+（chrome://tracing 或 https://ui.perfetto.dev 打开）。
+  TRACE      设为 0 关闭计时，默认开启
+  TRACE_DIR  设置后每个病例写出一个 Chrome trace 文件
+
+汇总多个 trace 文件：
+    python -m Simulated.simulated_patient.tracing results/traces/*.json
+"""
+import os
+import sys
+import json
+import time
+import itertools
+import threading
+import contextvars
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+
+from Simulated.simulated_patient.token_usage import current_case
+
+TRACE_ENABLED = os.getenv("TRACE", "1").lower() not in ("0", "false", "off", "")
+TRACE_DIR = os.getenv("TRACE_DIR", "")
+
+_current_span = contextvars.ContextVar("trace_span", default=None)
+_span_ids = itertools.count(1)
+
+
+class Tracer:
+    """进程内按病例收集已结束的 span。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._spans = defaultdict(list)
+
+    def add(self, case, record: dict):
+        with self._lock:
+            self._spans[case].append(record)
+
+    def pop(self, case=None) -> list:
+        case = case or current_case.get()
+        with self._lock:
+            return self._spans.pop(case, [])
+
+
+tracer = Tracer()
+
+
+@contextmanager
+def span(name: str, cat: str = "stage", **args):
+    if not TRACE_ENABLED:
+        yield
+        return
+    span_id = next(_span_ids)
+    parent = _current_span.get()
+    token = _current_span.set(span_id)
+    start = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter_ns() - start
+        _current_span.reset(token)
+        tracer.add(current_case.get(), {
+            "name": name, "cat": cat, "ts": start // 1000, "dur": duration // 1000,
+            "tid": threading.get_ident(), "id": span_id, "parent": parent, "args": args,
+        })
+
+
+def traced(name: str, cat: str = "stage"):
+    """函数装饰器：整个调用记为一个 span。"""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name, cat):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    pos = (len(sorted_values) - 1) * q / 100
+    low = int(pos)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (pos - low)
+
+
+def latency_table(spans) -> dict:
+    """按 span 名称汇总：{name: {count, p50_ms, p95_ms, total_ms}}，按总耗时降序。"""
+    durations = defaultdict(list)
+    for record in spans:
+        durations[record["name"]].append(record["dur"] / 1000)
+    table = {}
+    for name, values in durations.items():
+        values.sort()
+        table[name] = {
+            "count": len(values),
+            "p50_ms": round(_percentile(values, 50), 3),
+            "p95_ms": round(_percentile(values, 95), 3),
+            "total_ms": round(sum(values), 3),
+        }
+    return dict(sorted(table.items(), key=lambda item: -item[1]["total_ms"]))
+
+
+def format_table(table: dict) -> str:
+    width = max([len(name) for name in table] + [5])
+    lines = [f"{'stage':<{width}}  {'count':>7}  {'p50 ms':>10}  {'p95 ms':>10}  {'total ms':>12}"]
+    for name, row in table.items():
+        lines.append(
+            f"{name:<{width}}  {row['count']:>7}  {row['p50_ms']:>10.1f}  {row['p95_ms']:>10.1f}  {row['total_ms']:>12.1f}"
+        )
+    return "\n".join(lines)
+
+
+def write_chrome_trace(spans, path, label=""):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    pid = os.getpid()
+    events = [
+        {
+            "name": record["name"], "cat": record["cat"], "ph": "X",
+            "ts": record["ts"], "dur": record["dur"], "pid": pid, "tid": record["tid"],
+            "args": {"id": record["id"], "parent": record["parent"], **record["args"]},
+        }
+        for record in spans
+    ]
+    trace = {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"case": label}}
+    path.write_text(json.dumps(trace, ensure_ascii=False, default=str), encoding="utf-8")
+
+
+def read_chrome_trace(path) -> list:
+    events = json.loads(Path(path).read_text(encoding="utf-8"))["traceEvents"]
+    return [event for event in events if event.get("ph") == "X"]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("用法：python -m Simulated.simulated_patient.tracing <trace.json> [...]")
+        sys.exit(1)
+    all_spans = [event for path in sys.argv[1:] for event in read_chrome_trace(path)]
+    print(format_table(latency_table(all_spans)))
@@ -1,10 +1,11 @@
-import json
 import random
 import re
 from pathlib import Path
 
 import openpyxl
 from Simulated.simulated_patient.api_call import llm_api
+from Simulated.simulated_patient.case_context import load_prompts
+from Simulated.simulated_patient.case_store import open_case_store
 
 
 # ---------- 工具函数 ----------
@@ -70,10 +71,19 @@ def dropout_vague(text: str) -> str:
 
 def get_patient_info(sheet_name: str, row_number: int, col_number: int):
     """
-    读取相对路径 dataset/patient_text.xlsx 的指定单元格，
-    并将其写入 Simulated/Prompt/prompt_data.json 的 data["resource"][0]。
+    读取相对路径 dataset/patient_text.xlsx 的指定单元格；
+    优先从预先导入的病例库中按索引读取，未启用病例库时才打开工作簿。
     """
     xlsx_path = Path("dataset") / "patient_text.xlsx"
+    store = open_case_store(xlsx_path)
+    if store is not None:
+        # 与直接读取工作簿时一致：缺少数据源或工作表时报错，只有空单元格才返回 ""
+        if not store.has_sheet(sheet_name):
+            if len(store) == 0:
+                raise FileNotFoundError(f"找不到文件：{xlsx_path}（病例库 {store.path} 为空）")
+            raise KeyError(f"病例库中没有工作表：{sheet_name}")
+        return store.cell(sheet_name, row_number, col_number) or ""
+
     if not xlsx_path.is_file():
         raise FileNotFoundError(f"找不到文件：{xlsx_path}")
 
@@ -84,59 +94,23 @@ def get_patient_info(sheet_name: str, row_number: int, col_number: int):
     finally:
         wb.close()
 
-    text = str(cell_value or "")
-
-    json_path = Path("Simulated") / "Prompt" / "prompt_data.json"
-    if not json_path.is_file():
-        raise FileNotFoundError(f"找不到文件：{json_path}")
-
-    with json_path.open("r", encoding="utf-8") as f:
-        data = json.load(f)
-
-    # 确保结构存在
-    if "resource" not in data or not isinstance(data["resource"], list):
-        data["resource"] = [""]
-    if not data["resource"]:
-        data["resource"].append("")
-    data["resource"][0] = text
-
-    with json_path.open("w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
-
-    return text
+    return str(cell_value or "")
 
 
 def get_vague_patient_info(sheet_name: str, row_number: int, col_number: int):
     """
-    读取病人信息 -> 做“模糊化” -> 调用 LLM 生成含糊表达 -> 写回 prompt_data.json 的 data["vague_resource"][0]。
+    读取病人信息 -> 做“模糊化” -> 调用 LLM 生成含糊表达。
     返回 (原始文本, 模糊文本)
     """
     patient_info = get_patient_info(sheet_name, row_number, col_number)
     patient_info_drop = dropout_vague(patient_info)
 
-    json_path = Path("Simulated") / "Prompt" / "prompt_data.json"
-    if not json_path.is_file():
-        raise FileNotFoundError(f"找不到文件：{json_path}")
-
-    with json_path.open("r", encoding="utf-8") as f:
-        data = json.load(f)
-
     # 组装 vagueness prompt
-    if "vagueness" not in data or not isinstance(data["vagueness"], list):
-        raise KeyError("prompt_data.json 缺少 'vagueness' 配置或其类型不是 list")
-    vagueness_prompt = "".join(data["vagueness"])
-    prompt = vagueness_prompt.format(information=patient_info_drop)
-
-    vague_patient_info = llm_api([{"role": "user", "content": prompt}])
-
-    # 写回 vague_resource
-    if "vague_resource" not in data or not isinstance(data["vague_resource"], list):
-        data["vague_resource"] = [""]
-    if not data["vague_resource"]:
-        data["vague_resource"].append("")
-    data["vague_resource"][0] = vague_patient_info
-
-    with json_path.open("w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+    prompts = load_prompts()
+    if "vagueness" not in prompts:
+        raise KeyError("prompt_data.json 缺少 'vagueness' 配置")
+    prompt = prompts["vagueness"].format(information=patient_info_drop)
+
+    vague_patient_info = llm_api([{"role": "user", "content": prompt}], prompt_key="vagueness")
 
     return patient_info, vague_patient_info
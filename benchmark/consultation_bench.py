@@ -0,0 +1,329 @@
+"""
+离线问诊基准：在子进程中启动 mock_llm_server.py，把 simulateflow.flow 指向它完整运行若干病例，
+统计模拟器自身的开销（每轮调用次数、每轮 / 每病例耗时、CPU 时间、峰值 RSS、文件读写量）与各阶段延迟。
+
+    python benchmark/consultation_bench.py --cases 3
+    python benchmark/consultation_bench.py --rows 2 3 4 --chat-latency fixed:0 --embedding-latency fixed:0 --json bench.json
+    python benchmark/consultation_bench.py --compare-routes default --model-latency ep-20240822150534-5nj65=lognormal:0.3,0.3
+
+病例在临时工作目录中运行（复制 prompt、画像、病例工作簿与进化记忆），不会改动仓库中的数据；
+LLM 响应缓存与 embedding 缓存默认关闭，每次运行的请求数一致。--seed 固定危机轮次与 mock 的回答 / 延迟。
+--stream 以流式发出全部对话请求（LLM_STREAM=1），报告各调用点的首 token 与所需字段完整耗时；
+--chunk-interval / --reply-tail 控制 mock 的生成速度与回答末尾的多余内容，用来衡量提前结束的收益。
+--routes 指定模型路由表（LLM_ROUTES 的写法）；--compare-routes 先以全部走大模型（off）运行一次，
+再以给定路由表运行一次，对比两者的延迟与各模型的 token 用量。
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import argparse
+import resource
+import tempfile
+import subprocess
+import urllib.request
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+SHEET_NAME = "病程记录_首次病程"
+COL_NUMBER = 1
+# 复制到临时工作目录的输入（相对仓库根目录）
+WORKSPACE_INPUTS = [
+    Path("Simulated") / "Prompt" / "prompt_data.json",
+    Path("profile"),
+    Path("dataset") / "patient_text.xlsx",
+    Path("dataset") / "patient_data.json",
+    Path("dataset") / "patient_evolve.csv",
+]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def get_json(url, data=None):
+    request = urllib.request.Request(url, data=data, method="POST" if data is not None else "GET")
+    with urllib.request.urlopen(request, timeout=5) as response:
+        return json.loads(response.read())
+
+
+def start_mock(args):
+    port = free_port()
+    command = [
+        sys.executable, str(ROOT / "benchmark" / "mock_llm_server.py"), "--port", str(port),
+        "--chat-latency", args.chat_latency, "--embedding-latency", args.embedding_latency,
+        "--dim", str(args.dim), "--seed", str(args.seed),
+        "--chunk-chars", str(args.chunk_chars), "--chunk-interval", str(args.chunk_interval),
+        "--reply-tail", args.reply_tail,
+    ]
+    for item in args.model_latency:
+        command += ["--model-latency", item]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    base = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            get_json(base + "/stats")
+            return process, base
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("mock 服务启动失败")
+
+
+def prepare_workspace(workspace: Path):
+    for rel in WORKSPACE_INPUTS:
+        src, dst = ROOT / rel, workspace / rel
+        if not src.exists():
+            continue
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        if src.is_dir():
+            shutil.copytree(src, dst)
+        else:
+            shutil.copy2(src, dst)
+
+
+def proc_io() -> dict:
+    """本进程累计的读写字节数（Linux /proc/self/io）；其他平台返回空字典。"""
+    try:
+        text = Path("/proc/self/io").read_text()
+    except OSError:
+        return {}
+    fields = dict(line.split(": ") for line in text.splitlines())
+    return {key: int(fields[key]) for key in ("rchar", "wchar", "read_bytes", "write_bytes")}
+
+
+def cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def peak_rss_mb() -> float:
+    # Linux 上 ru_maxrss 单位为 KB，macOS 上为字节
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+
+def delta(after: dict, before: dict) -> dict:
+    return {key: round(after.get(key, 0) - before.get(key, 0), 3) for key in after}
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    pos = (len(values) - 1) * q / 100
+    low = int(pos)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (pos - low)
+
+
+def read_jsonl(path: Path):
+    if not path.is_file():
+        return []
+    with path.open("r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cases", type=int, default=3, help="未指定 --rows 时，取工作表前 N 个病例")
+    parser.add_argument("--rows", type=int, nargs="*", default=None)
+    parser.add_argument("--sheet", default=SHEET_NAME)
+    parser.add_argument("--col", type=int, default=COL_NUMBER)
+    parser.add_argument("--chat-latency", default="lognormal:0.8,0.4")
+    parser.add_argument("--embedding-latency", default="fixed:0.05")
+    parser.add_argument("--model-latency", action="append", default=[], metavar="MODEL=SPEC",
+                        help="某个模型单独的延迟分布（如模拟主模型变慢），可重复")
+    parser.add_argument("--chunk-chars", type=int, default=4, help="mock 每段回答的字符数")
+    parser.add_argument("--chunk-interval", type=float, default=0.0, help="mock 相邻两段之间的秒数")
+    parser.add_argument("--reply-tail", default="", help="mock 追加在每个对话回答末尾的文字")
+    parser.add_argument("--stream", action="store_true", help="以流式发出对话请求（LLM_STREAM=1）")
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", type=Path, default=None, help="把工作目录（结果、trace）保留到该路径")
+    parser.add_argument("--json", type=Path, default=None, help="把汇总结果写入 JSON，便于对比两次运行")
+    parser.add_argument("--routes", default=None, help='模型路由表，如 "default"、"off" 或 "summary=lite"')
+    parser.add_argument("--compare-routes", default=None, metavar="ROUTES", help="对比全部走大模型与该路由表")
+    args = parser.parse_args(argv)
+    args.keep = args.keep.resolve() if args.keep else None
+    args.json = args.json.resolve() if args.json else None
+    return args
+
+
+def run_bench(args) -> dict:
+    workspace = Path(tempfile.mkdtemp(prefix="consultation_bench_"))
+    prepare_workspace(workspace)
+    mock, base = start_mock(args)
+    # api_call 等模块在导入时读取配置，必须在导入 simulateflow 之前设置
+    os.environ.update({
+        "OPENAI_API_KEY": "mock", "BASE_URL": base + "/v1",
+        "LLM_CACHE_PATH": "", "EMBEDDING_CACHE_PATH": "",
+        "CASE_STORE_PATH": str(workspace / "dataset" / "case_store.sqlite"),
+        "RESULT_DIR": str(workspace / "results"), "TRACE": "1", "TRACE_DIR": str(workspace / "traces"),
+    })
+    if args.stream:
+        os.environ["LLM_STREAM"] = "1"
+    if args.routes is not None:
+        os.environ["LLM_ROUTES"] = "" if args.routes == "default" else args.routes
+    os.chdir(workspace)
+    sys.path.insert(0, str(ROOT))
+    try:
+        from simulateflow import flow
+        from Simulated.simulated_patient.case_store import open_case_store
+        from Simulated.simulated_patient.result_sink import get_result_sink
+        from Simulated.simulated_patient.api_call import (
+            scheduler_stats, latency_stats, coalesce_stats, stream_stats,
+        )
+        from Simulated.simulated_patient.tracing import read_chrome_trace, latency_table, format_table
+
+        rows = args.rows
+        if not rows:
+            store = open_case_store()
+            rows = [row for row, _, _ in store.iter_cases(args.sheet, args.col)][:args.cases]
+        random.seed(args.seed)
+
+        cases = []
+        for row in rows:
+            get_json(base + "/reset", data=b"{}")
+            io_before, cpu_before, start = proc_io(), cpu_seconds(), time.perf_counter()
+            summary = flow(args.sheet, row, args.col)
+            wall = time.perf_counter() - start
+            calls = get_json(base + "/stats")
+            cases.append({
+                "row": row, "turns": summary["turns"], "wall_s": round(wall, 3),
+                "cpu_s": round(cpu_seconds() - cpu_before, 3),
+                "chat_calls": calls.get("chat", 0), "embedding_calls": calls.get("embeddings", 0),
+                "embedding_texts": calls.get("embedding_texts", 0),
+                "mock_latency_s": round(calls.get("chat_seconds", 0) + calls.get("embedding_seconds", 0), 3),
+                "io": delta(proc_io(), io_before),
+            })
+            print(f"row {row}: {summary['turns']} 轮  {wall:.2f}s  CPU {cases[-1]['cpu_s']:.2f}s  "
+                  f"chat {cases[-1]['chat_calls']}  embedding {cases[-1]['embedding_calls']}")
+        get_result_sink().flush()
+
+        turns = read_jsonl(workspace / "results" / "turns.jsonl")
+        tokens_by_model = {}
+        for case in read_jsonl(workspace / "results" / "cases.jsonl"):
+            for model, usage in case["token_breakdown"].get("by_model", {}).items():
+                tokens_by_model[model] = tokens_by_model.get(model, 0) + usage.get("total_tokens", 0)
+        turn_wall = [turn["patient_time"] for turn in turns]
+        spans = [event for path in sorted((workspace / "traces").glob("*.json")) for event in read_chrome_trace(path)]
+        total_turns = max(1, sum(case["turns"] for case in cases))
+        report = {
+            "cases": cases,
+            "turns": len(turns),
+            "chat_calls_per_turn": round(sum(c["chat_calls"] for c in cases) / total_turns, 2),
+            "embedding_calls_per_turn": round(sum(c["embedding_calls"] for c in cases) / total_turns, 2),
+            "turn_wall_s": {"p50": round(percentile(turn_wall, 50), 3), "p95": round(percentile(turn_wall, 95), 3)},
+            "case_wall_s": {"p50": round(percentile([c["wall_s"] for c in cases], 50), 3),
+                            "total": round(sum(c["wall_s"] for c in cases), 3)},
+            "tokens_by_model": tokens_by_model,
+            "cpu_s": round(sum(c["cpu_s"] for c in cases), 3),
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            "io_bytes": {key: sum(c["io"].get(key, 0) for c in cases) for key in ("rchar", "wchar", "write_bytes")},
+            "scheduler": scheduler_stats(),
+            "llm_latency": latency_stats(),
+            "coalescing": coalesce_stats(),
+            "streaming": stream_stats(),
+            "stage_latency": latency_table(spans),
+        }
+    finally:
+        mock.terminate()
+        mock.wait()
+        os.chdir(ROOT)
+        if args.keep:
+            shutil.copytree(workspace, args.keep, dirs_exist_ok=True)
+        shutil.rmtree(workspace, ignore_errors=True)
+    return report
+
+
+def print_report(report):
+    print()
+    print(f"病例 {len(report['cases'])} 个，共 {report['turns']} 轮；每轮 chat 调用 {report['chat_calls_per_turn']} 次，"
+          f"embedding 调用 {report['embedding_calls_per_turn']} 次")
+    print(f"每轮耗时 p50 {report['turn_wall_s']['p50']}s / p95 {report['turn_wall_s']['p95']}s；"
+          f"病例耗时 p50 {report['case_wall_s']['p50']}s，合计 {report['case_wall_s']['total']}s")
+    print(f"CPU {report['cpu_s']}s，峰值 RSS {report['peak_rss_mb']} MB，落盘写入 {report['io_bytes']['write_bytes'] / 1024:.1f} KB，"
+          f"读写调用 {report['io_bytes']['rchar'] / 1024:.1f} / {report['io_bytes']['wchar'] / 1024:.1f} KB（含与 mock 的网络流量）")
+    print()
+    print(format_table(report["stage_latency"]))
+    coalescing = report.get("coalescing", {})
+    for kind in ("chat", "embedding"):
+        if kind in coalescing:
+            print(f"{kind} 合并：实际请求 {coalescing[kind]['requests']}，合并到在途请求 {coalescing[kind]['coalesced']}")
+    streaming = report.get("streaming", {})
+    for key, row in streaming.get("ttft", {}).items():
+        field = streaming.get("time_to_field", {}).get(key, {})
+        line = f"流式 {key}：TTFT p50 {row.get('p50_ms')} ms"
+        if field:
+            line += f"，字段完整 p50 {field.get('p50_ms')} ms，提前结束 {field.get('early_stops', 0)} 次"
+        print(line)
+    print("各模型 token：" + "，".join(f"{model} {tokens}" for model, tokens in report["tokens_by_model"].items()))
+
+
+def _forwarded_argv(argv):
+    """去掉 --compare-routes / --routes / --json / --keep 及其取值，其余参数原样传给两次运行。"""
+    skip = {"--compare-routes", "--routes", "--json", "--keep"}
+    forwarded, i = [], 0
+    while i < len(argv):
+        name = argv[i].split("=", 1)[0]
+        if name in skip:
+            i += 1 if "=" in argv[i] else 2
+            continue
+        forwarded.append(argv[i])
+        i += 1
+    return forwarded
+
+
+def compare_routes(args, argv):
+    """分别在子进程中以 off 与给定路由表运行（配置在导入时读取），对比延迟与 token。"""
+    reports = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, routes in (("off", "off"), ("routed", args.compare_routes)):
+            out = Path(tmp) / f"{label}.json"
+            command = [sys.executable, str(Path(__file__).resolve()), *_forwarded_argv(argv),
+                       "--routes", routes, "--json", str(out)]
+            print(f"===== LLM_ROUTES={routes} =====", flush=True)
+            subprocess.run(command, check=True)
+            reports[label] = json.loads(out.read_text(encoding="utf-8"))
+    base, routed = reports["off"], reports["routed"]
+
+    def change(before, after):
+        return f"{before:>10} -> {after:<10} ({(after - before) / before * 100 if before else 0.0:+.1f}%)"
+
+    print()
+    print(f"===== 路由表 {args.compare_routes!r} 相对全部走大模型 =====")
+    print(f"病例耗时合计  {change(base['case_wall_s']['total'], routed['case_wall_s']['total'])}")
+    print(f"每轮耗时 p50  {change(base['turn_wall_s']['p50'], routed['turn_wall_s']['p50'])}")
+    print(f"每轮耗时 p95  {change(base['turn_wall_s']['p95'], routed['turn_wall_s']['p95'])}")
+    for model in sorted(set(base["tokens_by_model"]) | set(routed["tokens_by_model"])):
+        print(f"{model} token  {change(base['tokens_by_model'].get(model, 0), routed['tokens_by_model'].get(model, 0))}")
+    llm_stages = sorted(name for name in set(base["stage_latency"]) | set(routed["stage_latency"]) if name.startswith("llm:"))
+    for name in llm_stages:
+        before = base["stage_latency"].get(name, {}).get("p50_ms", 0.0)
+        after = routed["stage_latency"].get(name, {}).get("p50_ms", 0.0)
+        print(f"{name} p50 ms  {change(before, after)}")
+    comparison = {"routes": args.compare_routes, "off": base, "routed": routed}
+    if args.json:
+        args.json.write_text(json.dumps(comparison, ensure_ascii=False, indent=2), encoding="utf-8")
+
+
+def main():
+    argv = sys.argv[1:]
+    args = parse_args(argv)
+    if args.compare_routes is not None:
+        compare_routes(args, argv)
+        return
+    report = run_bench(args)
+    print_report(report)
+    if args.json:
+        args.json.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+对比 dataset/bulit_dataset.py 新旧两版按 Patient-SN 聚合的耗时，并核对两者输出一致。
+
+    python benchmark/dataset_build_bench.py --patients 2000 20000
+    python benchmark/dataset_build_bench.py --excel dataset/patient_text.xlsx   # 使用真实工作簿
+
+未指定 --excel 时使用内存中生成的多工作表数据（含重复行与空值），只计聚合与输出，不计 Excel 解析。
+"""
+import sys
+import json
+import time
+import argparse
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "dataset"))
+
+import bulit_dataset  # noqa: E402
+
+
+# ---------- 旧版实现（iterrows + json.dumps(sort_keys) 去重），仅用于对照 ----------
+
+def legacy_deduplicate_records(records):
+    seen = set()
+    unique = []
+    for rec in records:
+        key = json.dumps(rec, ensure_ascii=False, sort_keys=True, default=str)
+        if key not in seen:
+            seen.add(key)
+            unique.append(rec)
+    return unique
+
+
+def legacy_build(sheet_frames):
+    patient_map = {}
+    for sheet_name, df in sheet_frames:
+        df = df.where(pd.notnull(df), None)
+        if "Patient-SN" not in df.columns:
+            continue
+        for _, row in df.iterrows():
+            row_dict = row.to_dict()
+            patient_id = row_dict.get("Patient-SN")
+            if patient_id is None:
+                continue
+            record = {k: v for k, v in row_dict.items() if k != "Patient-SN"}
+            patient_map.setdefault(patient_id, []).append(record)
+    for pid, records in patient_map.items():
+        patient_map[pid] = legacy_deduplicate_records(records)
+    return patient_map
+
+
+# ---------- 数据 ----------
+
+def synthetic_sheets(patients, seed=0):
+    rng = np.random.default_rng(seed)
+    ids = np.array([f"{i:032x}" for i in rng.integers(0, 2 ** 62, patients)])
+    sheets = []
+    for s, (name, rows_per_patient, columns) in enumerate([
+        ("患者基本信息", 1, 5), ("检查_MRI检查", 3, 6), ("病程记录_首次病程", 1, 2),
+        ("病理_全部病理", 2, 4), ("专科检查_专科检查", 2, 3),
+    ]):
+        n = patients * rows_per_patient
+        frame = {"Patient-SN": rng.choice(ids, n)}
+        for c in range(columns):
+            values = np.char.add(f"文本{s}-", rng.integers(0, 50, n).astype(str)).astype(object)
+            values[rng.random(n) < 0.1] = None
+            frame[f"{name}_col{c}"] = values
+        df = pd.DataFrame(frame)
+        # 约 10% 的重复行
+        df = pd.concat([df, df.sample(frac=0.1, random_state=seed)], ignore_index=True)
+        sheets.append((name, df))
+    return sheets
+
+
+def canonical(patient_map):
+    """旧版会把部分空值保留为 NaN，比较前统一为 None。"""
+    def clean(record):
+        return {k: None if isinstance(v, float) and v != v else v for k, v in record.items()}
+    return {str(pid): sorted(json.dumps(clean(r), ensure_ascii=False, sort_keys=True, default=str) for r in recs)
+            for pid, recs in patient_map.items()}
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def bench(label, sheets):
+    rows = sum(len(df) for _, df in sheets)
+    legacy, t_legacy = timed(legacy_build, sheets)
+    new, t_new = timed(bulit_dataset.patient_dict_from_frames, sheets)
+    same = canonical(legacy) == canonical(new)
+    with tempfile.TemporaryDirectory() as tmp:
+        _, t_jsonl = timed(bulit_dataset.write_jsonl, sheets, Path(tmp) / "jsonl", 64)
+        try:
+            _, t_parquet = timed(bulit_dataset.write_parquet, sheets, Path(tmp) / "parquet", 64)
+            parquet = f"{t_parquet:8.2f}s"
+        except ImportError:
+            parquet = "   (无 pyarrow)"
+    print(f"{label:>16} {rows:>9} 行  旧版 {t_legacy:8.2f}s  新版 {t_new:8.2f}s  "
+          f"({t_legacy / max(t_new, 1e-9):5.1f}x)  jsonl {t_jsonl:8.2f}s  parquet {parquet}  一致={same}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--patients", type=int, nargs="+", default=[2000, 20000])
+    parser.add_argument("--excel", type=Path, nargs="*", default=None)
+    args = parser.parse_args()
+
+    if args.excel:
+        sheets, t_read = timed(lambda: list(bulit_dataset.load_sheets(args.excel, bulit_dataset.SHEETS)))
+        print(f"读取工作簿 {t_read:.2f}s")
+        bench("workbook", sheets)
+        return
+    for patients in args.patients:
+        bench(f"{patients} 患者", synthetic_sheets(patients))
+
+
+if __name__ == "__main__":
+    main()
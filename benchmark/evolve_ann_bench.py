@@ -0,0 +1,99 @@
+"""
+对比进化记忆的精确检索与近似检索（recall@2 与单次查询延迟）。
+
+    python benchmark/evolve_ann_bench.py --rows 20000 100000 --queries 500
+    python benchmark/evolve_ann_bench.py --store dataset/patient_evolve.store   # 使用真实存储中的向量
+
+未指定 --store 时使用带簇结构的随机向量（与文本 embedding 的分布更接近）。
+"""
+import sys
+import time
+import argparse
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from Simulated.simulated_patient import ann_index  # noqa: E402
+from Simulated.simulated_patient.evolve_store import EvolveStore, _normalize  # noqa: E402
+
+
+def synthetic_vectors(rows, dim, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(1, rows // 50), dim)).astype(np.float32)
+    labels = rng.integers(0, len(centers), rows)
+    return centers[labels] + 0.3 * rng.standard_normal((rows, dim)).astype(np.float32)
+
+
+def percentile_ms(samples, q):
+    return float(np.percentile(samples, q) * 1000)
+
+
+def run(matrix, queries, k, backend):
+    with tempfile.TemporaryDirectory() as tmp:
+        store = EvolveStore(Path(tmp) / "bench.store", ("qus_embedding",))
+        store.append_many({"qus_embedding": matrix}, [{"question": str(i)} for i in range(len(matrix))])
+
+        ann_index.ANN_BACKEND = "off"
+        exact_ids, exact_lat = [], []
+        for q in queries:
+            start = time.perf_counter()
+            exact_ids.append(store.search("qus_embedding", q, k).ids)
+            exact_lat.append(time.perf_counter() - start)
+
+        ann_index.ANN_BACKEND = backend
+        ann_index.ANN_MIN_ROWS = 0
+        start = time.perf_counter()
+        store.search("qus_embedding", queries[0], k)  # 触发索引构建
+        build_time = time.perf_counter() - start
+        ann_ids, ann_lat = [], []
+        for q in queries:
+            start = time.perf_counter()
+            ann_ids.append(store.search("qus_embedding", q, k).ids)
+            ann_lat.append(time.perf_counter() - start)
+
+    recall = np.mean([len(set(a.tolist()) & set(e.tolist())) / max(1, len(e)) for a, e in zip(ann_ids, exact_ids)])
+    return {
+        "rows": len(matrix),
+        "backend": backend,
+        f"recall@{k}": round(float(recall), 4),
+        "build_s": round(build_time, 2),
+        "exact_p50_ms": round(percentile_ms(exact_lat, 50), 3),
+        "exact_p95_ms": round(percentile_ms(exact_lat, 95), 3),
+        "ann_p50_ms": round(percentile_ms(ann_lat, 50), 3),
+        "ann_p95_ms": round(percentile_ms(ann_lat, 95), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[20000, 100000])
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=2)
+    parser.add_argument("--backend", nargs="+", default=["hnsw", "ivf"], choices=["hnsw", "ivf"])
+    parser.add_argument("--store", help="已有的 .store 目录，使用其中的 qus_embedding 作为数据")
+    args = parser.parse_args()
+
+    if not ann_index.ann_available("hnsw"):
+        raise SystemExit("未安装 faiss，无法运行近似检索基准")
+
+    rng = np.random.default_rng(1)
+    if args.store:
+        base = np.asarray(EvolveStore(args.store, ("qus_embedding",)).vectors("qus_embedding"))
+        datasets = [base]
+    else:
+        datasets = [synthetic_vectors(rows, args.dim) for rows in args.rows]
+
+    for matrix in datasets:
+        # 查询取库中向量加少量扰动，模拟相近的问题
+        picks = rng.integers(0, len(matrix), args.queries)
+        queries = _normalize(matrix[picks]) + 0.05 * rng.standard_normal((args.queries, matrix.shape[1])).astype(np.float32)
+        for backend in args.backend:
+            print(run(matrix, queries, args.k, backend))
+
+
+if __name__ == "__main__":
+    main()
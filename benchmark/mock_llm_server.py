@@ -0,0 +1,273 @@
+"""
+本地的 OpenAI 兼容接口替身（/v1/chat/completions 与 /v1/embeddings），供离线基准测试使用。
+对话接口按 prompt 内容返回固定格式的回答（**...** / ##...##，可被各智能体正常解析），
+embedding 接口按文本哈希生成确定性的单位向量；两类接口的延迟分别按给定分布采样。
+
+    python benchmark/mock_llm_server.py --port 18080 --chat-latency lognormal:0.8,0.4 --embedding-latency fixed:0.05
+    BASE_URL=http://127.0.0.1:18080/v1 OPENAI_API_KEY=mock python run.py --start 2 --end 3
+
+延迟分布写法：fixed:秒、uniform:下限,上限、normal:均值,标准差、lognormal:中位数,sigma。
+回答由 --seed 与请求内容决定；延迟还取决于该请求体是第几次出现（对冲的重复请求延迟不同），
+按相同顺序发出请求时多次运行结果一致。
+对话延迟之外，回答按每 --chunk-chars 个字符间隔 --chunk-interval 秒"生成"：stream=true 时以 SSE 逐段发送
+（首段在采样的延迟之后到达），否则等全部生成完再返回。--reply-tail 在每个回答末尾追加一段文字，
+模拟真实模型在 **...** / ##...## 之后的解释。
+GET /stats 返回累计调用次数，POST /reset 清零。
+"""
+import json
+import math
+import time
+import random
+import hashlib
+import argparse
+import threading
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+
+import numpy as np
+
+# (prompt 中的特征片段, 回答)，按顺序匹配第一个
+DEFAULT_REPLIES = [
+    ("回答应该只为是或否", "**否**"),
+    ("回答应该只是是或否", "是"),
+    ("##科室##", "##NO##"),
+    ("**科室名**", "**神经内科**"),
+    ("**要求**", "**要求1：回答应该符合第一人称病人的口吻。\n要求2：信息中没有的内容不回答。**"),
+    ("**结果**", "**鼻咽癌**"),
+]
+DOCTOR_QUESTIONS = [
+    "**你头痛多久了**##症状详细询问##",
+    "**最近睡眠怎么样**##生活习惯询问##",
+    "**有没有做过MRI检查，结果如何**##体格检查相关问题##",
+    "**之前吃过什么药吗**##治疗和药物反应询问##",
+    "**家里人有类似的情况吗**##基本信息询问##",
+]
+PATIENT_ANSWERS = [
+    "**嗯……医生，大概有一两个月了吧，时好时坏的。**",
+    "**我也说不太清楚，就是总觉得不太舒服。**",
+    "**这个……之前好像查过，具体结果我记不清了。**",
+]
+
+
+def parse_latency(spec: str):
+    """把分布写法解析为采样函数 rng -> 秒。"""
+    kind, _, params = spec.partition(":")
+    values = [float(v) for v in params.split(",") if v]
+    if kind == "fixed":
+        return lambda rng: values[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "normal":
+        return lambda rng: max(0.0, rng.gauss(values[0], values[1]))
+    if kind == "lognormal":
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"未知的延迟分布：{spec}")
+
+
+def _digest(*parts) -> int:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(str(part).encode("utf-8"))
+    return int.from_bytes(h.digest()[:8], "little")
+
+
+class MockBackend:
+    def __init__(self, chat_latency="fixed:0", embedding_latency="fixed:0", dim=1536, seed=0, replies=None,
+                 model_latency=None, chunk_chars=4, chunk_interval=0.0, reply_tail=""):
+        self.chat_latency = parse_latency(chat_latency)
+        # 个别模型单独的延迟分布，如 {"ep-xxx": "fixed:30"}，用于模拟主模型变慢
+        self.model_latency = {model: parse_latency(spec) for model, spec in (model_latency or {}).items()}
+        self.embedding_latency = parse_latency(embedding_latency)
+        self.dim = dim
+        self.seed = seed
+        self.replies = list(replies or []) + DEFAULT_REPLIES
+        self.chunk_chars = chunk_chars
+        self.chunk_interval = chunk_interval
+        self.reply_tail = reply_tail
+        self._lock = threading.Lock()
+        self.stats = Counter()
+        self._seen = Counter()
+
+    def reset(self):
+        with self._lock:
+            self.stats.clear()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.stats)
+
+    def _occurrence(self, digest: int) -> int:
+        with self._lock:
+            self._seen[digest] += 1
+            return self._seen[digest]
+
+    def _count(self, **deltas):
+        with self._lock:
+            self.stats.update(deltas)
+
+    def reply(self, prompt: str) -> str:
+        for pattern, answer in self.replies:
+            if pattern in prompt:
+                return answer + self.reply_tail
+        pool = DOCTOR_QUESTIONS if "##种类##" in prompt else PATIENT_ANSWERS
+        return pool[_digest(self.seed, prompt) % len(pool)] + self.reply_tail
+
+    def chunks(self, content: str):
+        return [content[i:i + self.chunk_chars] for i in range(0, len(content), self.chunk_chars)] or [""]
+
+    def chat(self, body: dict):
+        prompt = "\n".join(str(m.get("content", "")) for m in body.get("messages", []))
+        sample = self.model_latency.get(body.get("model"), self.chat_latency)
+        digest = _digest(self.seed, "chat", body.get("model"), prompt)
+        delay = sample(random.Random(_digest(digest, self._occurrence(digest))))
+        content = self.reply(prompt)
+        usage = {"prompt_tokens": len(prompt), "completion_tokens": len(content)}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        self._count(chat=1, chat_seconds=delay, **{f"model:{body.get('model')}": 1})
+        if not body.get("stream"):
+            # 非流式请求等全部内容生成完才返回
+            delay += len(self.chunks(content)) * self.chunk_interval
+        return delay, {
+            "id": f"mock-{_digest(prompt):x}", "object": "chat.completion", "created": 0, "model": body.get("model"),
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+            "usage": usage,
+        }
+
+    def vector(self, text: str):
+        v = np.random.default_rng(_digest(self.seed, "embedding", text)).standard_normal(self.dim)
+        return (v / np.linalg.norm(v)).round(6).tolist()
+
+    def embeddings(self, body: dict):
+        texts = body.get("input", [])
+        texts = [texts] if isinstance(texts, str) else texts
+        digest = _digest(self.seed, "embedding", *texts)
+        delay = self.embedding_latency(random.Random(_digest(digest, self._occurrence(digest))))
+        self._count(embeddings=1, embedding_texts=len(texts), embedding_seconds=delay)
+        data = [{"object": "embedding", "index": i, "embedding": self.vector(str(t))} for i, t in enumerate(texts)]
+        tokens = sum(len(str(t)) for t in texts)
+        return delay, {"object": "list", "data": data, "model": body.get("model"),
+                       "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}
+
+
+def make_handler(backend: MockBackend):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # 支持 keep-alive，与真实服务一样复用连接
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status, payload):
+            data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            try:
+                self.wfile.write(data)
+            except (BrokenPipeError, ConnectionResetError):
+                # 客户端已取消请求（超时或对冲落败）
+                self.close_connection = True
+
+        def _write_chunk(self, data: bytes):
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        def _stream(self, delay, payload, include_usage):
+            """以 SSE（chunked 编码）逐段发送回答；客户端提前关闭连接时停止。"""
+            def event(choices, **extra):
+                chunk = {"id": payload["id"], "object": "chat.completion.chunk", "created": 0,
+                         "model": payload["model"], "choices": choices, **extra}
+                return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8")
+
+            content = payload["choices"][0]["message"]["content"]
+            time.sleep(delay)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            sent = 0
+            try:
+                for index, piece in enumerate(backend.chunks(content)):
+                    if index:
+                        time.sleep(backend.chunk_interval)
+                    delta = {"role": "assistant", "content": piece} if index == 0 else {"content": piece}
+                    self._write_chunk(event([{"index": 0, "delta": delta, "finish_reason": None}]))
+                    sent += 1
+                self._write_chunk(event([{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+                if include_usage:
+                    self._write_chunk(event([], usage=payload["usage"]))
+                self._write_chunk(b"data: [DONE]\n\n")
+                self._write_chunk(b"")
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True
+                backend._count(stream_closed_early=1)
+            backend._count(stream=1, stream_chunks=sent)
+
+        def do_GET(self):
+            if self.path.rstrip("/").endswith("/stats"):
+                self._send(200, backend.snapshot())
+            else:
+                self._send(404, {"error": {"message": f"unknown path {self.path}"}})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            path = self.path.rstrip("/")
+            if path.endswith("/chat/completions"):
+                delay, payload = backend.chat(body)
+            elif path.endswith("/embeddings"):
+                delay, payload = backend.embeddings(body)
+            elif path.endswith("/reset"):
+                backend.reset()
+                delay, payload = 0.0, {}
+            else:
+                self._send(404, {"error": {"message": f"unknown path {self.path}"}})
+                return
+            if body.get("stream") and path.endswith("/chat/completions"):
+                self._stream(delay, payload, (body.get("stream_options") or {}).get("include_usage"))
+                return
+            time.sleep(delay)
+            self._send(200, payload)
+
+    return Handler
+
+
+def make_server(backend: MockBackend, host="127.0.0.1", port=0):
+    server = ThreadingHTTPServer((host, port), make_handler(backend))
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--chat-latency", default="lognormal:0.8,0.4")
+    parser.add_argument("--embedding-latency", default="fixed:0.05")
+    parser.add_argument("--model-latency", action="append", default=[], metavar="MODEL=SPEC",
+                        help="某个模型单独的延迟分布，可重复")
+    parser.add_argument("--chunk-chars", type=int, default=4, help="每段回答的字符数")
+    parser.add_argument("--chunk-interval", type=float, default=0.0, help="相邻两段之间的秒数（生成速度）")
+    parser.add_argument("--reply-tail", default="", help="追加在每个对话回答末尾的文字")
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--replies", type=Path, default=None,
+                        help='额外的回答规则 JSON：[["prompt 片段", "回答"], ...]，优先于内置规则')
+    args = parser.parse_args()
+
+    replies = json.loads(args.replies.read_text(encoding="utf-8")) if args.replies else None
+    model_latency = dict(item.split("=", 1) for item in args.model_latency)
+    backend = MockBackend(args.chat_latency, args.embedding_latency, args.dim, args.seed, replies, model_latency,
+                          args.chunk_chars, args.chunk_interval, args.reply_tail)
+    server = make_server(backend, args.host, args.port)
+    print(f"mock LLM 服务：http://{args.host}:{server.server_address[1]}/v1", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,15 @@
 from pathlib import Path
-import os
 import re
 import json
 import csv
 import time
 
-from dotenv import load_dotenv
 from Simulated.simulated_patient.vagueness import get_vague_patient_info
 from Simulated.simulated_patient.patient_agent import Patient
 from Simulated.simulated_patient.api_call import llm_api
 from Simulated.simulated_patient.agent_evolve import get_text_embedding
-
-
-# ============== 环境变量（隐去隐私信息，密钥由 llm_api 内部读取） ==============
-load_dotenv()
-if not os.getenv("OPENAI_API_KEY"):
-    raise RuntimeError("未检测到 OPENAI_API_KEY，请在系统或 .env 中设置。")
+from Simulated.simulated_patient.token_usage import token_accounting, case_scope
+from Simulated.simulated_patient.case_context import CaseContext, load_prompts
 
 
 # ============== 工具函数 ==============
@@ -27,48 +21,17 @@ def match_star(context: str) -> str:
     return re.sub(r"\*", "", m.group(0))
 
 
-def read_prompt() -> dict:
-    """读取并拼接 Simulated/Prompt/prompt_data.json 中的各条 prompt。"""
-    p = Path("Simulated/Prompt/prompt_data.json")
-    with p.open("r", encoding="utf-8") as f:
-        data = json.load(f)
-    final = {}
-    for k, v in data.items():
-        # v 可能是列表（每行一段），拼接为完整 prompt
-        if isinstance(v, list):
-            final[k] = "".join(v)
-        else:
-            final[k] = str(v)
-    return final
-
-
 def ensure_parent(path: Path):
     path.parent.mkdir(parents=True, exist_ok=True)
 
 
-def clean_token_count():
-    """清空 token 统计文件（相对路径）。"""
-    tp_overall = Path("./make_task/token_count/token_overall.txt")
-    tp_stream = Path("./make_task/token_count/token_stream.txt")
-    ensure_parent(tp_overall)
-    tp_overall.write_text("", encoding="utf-8")
-    tp_stream.write_text("", encoding="utf-8")
-
-
-def get_token_count() -> str:
-    """读取累计 token（若不存在或为空则返回 '0'）。"""
-    tp_stream = Path("./make_task/token_count/token_stream.txt")
-    if not tp_stream.exists():
-        return "0"
-    token_str = tp_stream.read_text(encoding="utf-8")
-    nums = re.findall(r"\d+", token_str)
-    return nums[-1] if nums else "0"
-
-
 # ============== 主流程 ==============
 def cover(sheet_name: str = "病程记录_首次病程", row_number: int = 6, col_number: int = 1):
-    clean_token_count()
+    with case_scope(f"cover:{sheet_name}:{row_number}"):
+        build_cover(sheet_name, row_number, col_number)
 
+
+def build_cover(sheet_name: str, row_number: int, col_number: int):
     test_label = str(time.time())
     parent_folder = Path("pool")
     directory = parent_folder / test_label
@@ -82,8 +45,9 @@ def cover(sheet_name: str = "病程记录_首次病程", row_number: int = 6, co
     (directory / "resource.txt").write_text(resource, encoding="utf-8")
     (directory / "vague.txt").write_text(vague_info, encoding="utf-8")
 
-    prompt_data = read_prompt()
-    patient = Patient(vague_info, resource, str(directory), prompt_data)
+    prompt_data = load_prompts()
+    case = CaseContext(f"cover:{sheet_name}:{row_number}", resource, vague_info, directory)
+    patient = Patient(case, prompt_data)
 
     # 分配科室
     office = match_star(patient.assign_office())
@@ -100,7 +64,7 @@ def cover(sheet_name: str = "病程记录_首次病程", row_number: int = 6, co
     # 生成封面
     prompt = prompt_data["cover"].format(office, resource)
     messages = [{"role": "user", "content": prompt}]
-    response = llm_api(messages)
+    response = llm_api(messages, prompt_key="cover")
     print(response)
 
     # 提取封面中可能的多项匹配
@@ -122,6 +86,8 @@ def cover(sheet_name: str = "病程记录_首次病程", row_number: int = 6, co
             json.dumps(matched, ensure_ascii=False)      # 以 JSON 形式保存列表
         ])
 
+    token_accounting.flush(directory / "token_count")
+
 
 def cache() -> int:
     """读取/初始化 case_cache.txt 内的行号。"""
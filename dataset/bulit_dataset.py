@@ -1,85 +1,162 @@
+"""
+按 Patient-SN 聚合多个工作表（可来自多个工作簿）的记录，去重后输出。
+
+    python bulit_dataset.py                                   # 兼容旧输出：patient_data.json
+    python bulit_dataset.py a.xlsx b.xlsx --format jsonl --out patients/ --buckets 64
+    python bulit_dataset.py a.xlsx --format parquet --out patients/
+
+jsonl / parquet 按患者哈希分桶写出，同一患者的记录总在同一个桶内；
+处理过程按工作表逐个进行，同时只在内存中保留一个工作表或一个桶的数据。
+"""
+import argparse
 import json
+import tempfile
 from pathlib import Path
 
 import pandas as pd
 
+PATIENT_SN = "Patient-SN"
+SHEETS = ["患者基本信息", "检查_MRI检查", "病程记录_首次病程", "病理_全部病理", "专科检查_专科检查"]
+
 
-def load_sheets(excel_path: Path, sheets):
-    """安全读取指定工作表（不存在的会跳过），返回 {sheet_name: DataFrame}。"""
-    existing = {}
+def load_sheets(excel_paths, sheets):
+    """逐个产出 (sheet_name, DataFrame)；同名工作表跨工作簿拼接，不存在的跳过。"""
+    if isinstance(excel_paths, (str, Path)):
+        excel_paths = [excel_paths]
     for name in sheets:
-        try:
-            df = pd.read_excel(excel_path, sheet_name=name)
-            existing[name] = df
-        except Exception as e:
-            print(f"⚠️ 跳过工作表 {name}: {e}")
-    return existing
+        frames = []
+        for excel_path in excel_paths:
+            try:
+                frames.append(pd.read_excel(excel_path, sheet_name=name))
+            except Exception as e:
+                print(f"⚠️ 跳过 {excel_path} 的工作表 {name}: {e}")
+        if frames:
+            yield name, pd.concat(frames, ignore_index=True)
 
 
 def normalize_df(df: pd.DataFrame) -> pd.DataFrame:
     """将 NaN 转换为 None，便于 JSON 序列化。"""
-    return df.where(pd.notnull(df), None)
-
-
-def deduplicate_records(records):
-    """根据记录内容去重（无序健壮），返回去重后的列表。"""
-    seen = set()
-    unique = []
-    for rec in records:
-        key = json.dumps(rec, ensure_ascii=False, sort_keys=True)
-        if key not in seen:
-            seen.add(key)
-            unique.append(rec)
-    return unique
-
-
-def build_patient_dict(excel_path: Path, sheets):
-    """按 Patient-SN 聚合跨表数据，去重并移除 Patient-SN 字段。"""
-    sheet_map = load_sheets(excel_path, sheets)
-    patient_map = {}
-
-    for sheet_name, df in sheet_map.items():
-        df = normalize_df(df)
-        if "Patient-SN" not in df.columns:
-            print(f"⚠️ 工作表 {sheet_name} 缺少列 'Patient-SN'，已跳过。")
-            continue
+    return df.astype(object).where(pd.notnull(df), None)
 
-        for _, row in df.iterrows():
-            row_dict = row.to_dict()
-            patient_id = row_dict.get("Patient-SN")
-            if patient_id is None:
-                continue
 
-            # 去掉 Patient-SN 字段，仅保留其它信息
-            record = {k: v for k, v in row_dict.items() if k != "Patient-SN"}
+def sheet_records(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    返回去重后的 [Patient-SN, record] 两列，record 为字段字典，保持原有行序。
+    去重键为 Patient-SN 与其余字段（按列名排序、NaN 统一）的 64 位哈希。
+    """
+    df = df[df[PATIENT_SN].notna()]
+    columns = sorted((c for c in df.columns if c != PATIENT_SN), key=str)
+    key = pd.util.hash_pandas_object(df[[PATIENT_SN] + columns], index=False)
+    df = normalize_df(df[~key.duplicated()])
 
-            patient_map.setdefault(patient_id, []).append(record)
+    # 记录保留工作表的原始列顺序，与旧版输出一致
+    body = df[[c for c in df.columns if c != PATIENT_SN]]
+    return pd.DataFrame({PATIENT_SN: df[PATIENT_SN].to_numpy(), "record": body.to_dict(orient="records")})
 
-    # 对每位患者的记录去重
-    for pid, records in patient_map.items():
-        patient_map[pid] = deduplicate_records(records)
 
-    return patient_map
+def iter_sheet_records(sheet_frames):
+    """sheet_frames 为 (sheet_name, DataFrame) 的可迭代对象，通常来自 load_sheets。"""
+    for sheet_name, df in sheet_frames:
+        if PATIENT_SN not in df.columns:
+            print(f"⚠️ 工作表 {sheet_name} 缺少列 '{PATIENT_SN}'，已跳过。")
+            continue
+        yield sheet_name, sheet_records(df)
+
+
+def group_records(frame: pd.DataFrame) -> dict:
+    """[Patient-SN, record] -> {Patient-SN: [record, ...]}，按患者首次出现的顺序。"""
+    return frame.groupby(PATIENT_SN, sort=False)["record"].agg(list).to_dict()
+
+
+def build_patient_dict(excel_paths, sheets):
+    """按 Patient-SN 聚合跨表数据，去重并移除 Patient-SN 字段（整体放在内存中）。"""
+    return patient_dict_from_frames(load_sheets(excel_paths, sheets))
+
+
+def patient_dict_from_frames(sheet_frames):
+    frames = [records for _, records in iter_sheet_records(sheet_frames)]
+    if not frames:
+        return {}
+    return group_records(pd.concat(frames, ignore_index=True))
+
+
+def _bucket_of(patient_sn: pd.Series, buckets: int) -> pd.Series:
+    return pd.util.hash_pandas_object(patient_sn.astype(str), index=False) % buckets
+
+
+def write_jsonl(sheet_frames, out_dir: Path, buckets: int):
+    """每个桶一个 part-XXXXX.jsonl，每行一位患者：{"Patient-SN": ..., "records": [...]}。"""
+    out_dir.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=out_dir) as tmp:
+        tmp = Path(tmp)
+        # 第一遍：各工作表的记录按患者分桶追加到临时文件
+        for _, records in iter_sheet_records(sheet_frames):
+            for bucket, part in records.groupby(_bucket_of(records[PATIENT_SN], buckets), sort=False):
+                with (tmp / f"{bucket:05d}.jsonl").open("a", encoding="utf-8") as f:
+                    for sn, rec in zip(part[PATIENT_SN], part["record"]):
+                        f.write(json.dumps([sn, rec], ensure_ascii=False, default=str) + "\n")
+        # 第二遍：逐桶按患者聚合
+        patients = 0
+        for path in sorted(tmp.glob("*.jsonl")):
+            with path.open("r", encoding="utf-8") as f:
+                frame = pd.DataFrame([json.loads(line) for line in f], columns=[PATIENT_SN, "record"])
+            with (out_dir / f"part-{path.stem}.jsonl").open("w", encoding="utf-8") as f:
+                for sn, recs in group_records(frame).items():
+                    f.write(json.dumps({PATIENT_SN: sn, "records": recs}, ensure_ascii=False, default=str) + "\n")
+                    patients += 1
+    return patients
+
+
+def write_parquet(sheet_frames, out_dir: Path, buckets: int):
+    """Hive 风格分区：bucket=XXXXX/<工作表>.parquet，列为 Patient-SN / sheet / record(JSON 文本)。"""
+    rows = 0
+    for sheet_name, records in iter_sheet_records(sheet_frames):
+        records = records.assign(
+            sheet=sheet_name,
+            record=[json.dumps(rec, ensure_ascii=False, default=str) for rec in records["record"]],
+        )
+        for bucket, part in records.groupby(_bucket_of(records[PATIENT_SN], buckets), sort=False):
+            part_dir = out_dir / f"bucket={bucket:05d}"
+            part_dir.mkdir(parents=True, exist_ok=True)
+            part.to_parquet(part_dir / f"{sheet_name}.parquet", index=False)
+        rows += len(records)
+    return rows
 
 
 def main():
-    # 相对路径：Excel 输入与 JSON 输出
-    excel_file = Path("../dataset/patient_text.xlsx")
-    output_json = Path("patient_data.json")
-
-    if not excel_file.exists():
-        raise FileNotFoundError(f"未找到 Excel 文件：{excel_file.resolve()}")
-
-    sheets = ["患者基本信息", "检查_MRI检查", "病程记录_首次病程", "病理_全部病理", "专科检查_专科检查"]
-
-    patient_dict = build_patient_dict(excel_file, sheets)
-
-    output_json.write_text(
-        json.dumps(patient_dict, ensure_ascii=False, indent=4),
-        encoding="utf-8",
-    )
-    print(f"✅ JSON 文件已生成：{output_json.resolve()}")
+    parser = argparse.ArgumentParser(description="按 Patient-SN 聚合病例工作簿")
+    parser.add_argument("excel", nargs="*", type=Path, default=[Path("../dataset/patient_text.xlsx")])
+    parser.add_argument("--sheets", nargs="+", default=SHEETS)
+    parser.add_argument("--format", choices=["json", "jsonl", "parquet"], default="json")
+    parser.add_argument("--out", type=Path, default=None, help="json 为输出文件，jsonl / parquet 为输出目录")
+    parser.add_argument("--buckets", type=int, default=64)
+    args = parser.parse_args()
+
+    for excel_file in args.excel:
+        if not excel_file.exists():
+            raise FileNotFoundError(f"未找到 Excel 文件：{excel_file.resolve()}")
+
+    if args.format == "json":
+        output_json = args.out or Path("patient_data.json")
+        patient_dict = build_patient_dict(args.excel, args.sheets)
+        output_json.write_text(
+            json.dumps(patient_dict, ensure_ascii=False, indent=4, default=str),
+            encoding="utf-8",
+        )
+        print(f"✅ JSON 文件已生成：{output_json.resolve()}")
+        return
+
+    out_dir = args.out or Path(f"patient_data_{args.format}")
+    if out_dir.exists() and any(out_dir.iterdir()):
+        raise FileExistsError(f"输出目录已存在且非空：{out_dir.resolve()}")
+    sheet_frames = load_sheets(args.excel, args.sheets)
+    if args.format == "jsonl":
+        count = write_jsonl(sheet_frames, out_dir, args.buckets)
+        print(f"✅ 已写出 {count} 位患者：{out_dir.resolve()}")
+    else:
+        count = write_parquet(sheet_frames, out_dir, args.buckets)
+        print(f"✅ 已写出 {count} 条记录：{out_dir.resolve()}")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,20 +1,11 @@
-import os
-from dotenv import load_dotenv
-from openai import OpenAI
+from Simulated.simulated_patient.llm_client import get_embedding_client
 
+DEFAULT_BASE_URL = "https://dashscope.aliyuncs.com/compatible-mode/v1"
 
-def get_embeddings(text: str):
-    """从环境变量读取配置，调用 DashScope/OpenAI 接口生成文本向量。"""
-    # 加载环境变量
-    load_dotenv()
-
-    api_key = os.getenv("OPENAI_API_KEY")
-    base_url = os.getenv("OPENAI_API_BASE", "https://dashscope.aliyuncs.com/compatible-mode/v1")
 
-    if not api_key:
-        raise RuntimeError("未检测到 OPENAI_API_KEY，请在 .env 或系统环境中设置。")
-
-    client = OpenAI(api_key=api_key, base_url=base_url)
+def get_embeddings(text: str):
+    """调用 DashScope/OpenAI 接口生成文本向量；客户端（连接池）在多次调用间共享。"""
+    client = get_embedding_client(DEFAULT_BASE_URL)
 
     completion = client.embeddings.create(
         model="text-embedding-v3",
@@ -1,18 +1,146 @@
-from simulateflow import flow
+"""
+批量运行病例。多个病例在线程池中并发执行（LLM 请求共享同一连接池与并发上限），
+每个病例的结果按病例 id 追加到状态文件，重启后跳过已成功的病例，失败的病例重新运行。
 
-col_number = 1
-sheet_name = '病程记录_首次病程'
+    python run.py --start 2 --end 1300 --concurrency 4 --llm-concurrency 16
+"""
+import argparse
+import json
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
 
-def cache():
-    with open('./make_task/case_cache.txt', 'r', encoding='utf-8') as cc:
-        case_number = cc.read()
-    return case_number
+from simulateflow import flow, case_id
+from Simulated.simulated_patient import api_call
+from Simulated.simulated_patient.case_store import open_case_store
 
-row_number = int(cache())
+SHEET_NAME = '病程记录_首次病程'
+COL_NUMBER = 1
+STATE_PATH = Path('./make_task/run_state.jsonl')
+LEGACY_CACHE_PATH = Path('./make_task/case_cache.txt')
+# 第 1 行是表头
+FIRST_DATA_ROW = 2
 
-while row_number <= 1300:
-    # row_number = int(cache())
-    row_number += 1
-    flow(sheet_name, row_number, col_number)
-    with open('./make_task/case_cache.txt', 'w', encoding='utf-8') as cc:
-        cc.write(str(row_number))
+
+def legacy_start() -> int:
+    """兼容旧的 case_cache.txt 计数：从其后一行开始。"""
+    if LEGACY_CACHE_PATH.is_file():
+        txt = LEGACY_CACHE_PATH.read_text(encoding='utf-8').strip()
+        if txt.isdigit():
+            return max(int(txt) + 1, FIRST_DATA_ROW)
+    return FIRST_DATA_ROW
+
+
+class RunState:
+    """病例 id -> 最近一次运行记录，以 JSONL 追加保存。"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.records = {}
+        self._lock = threading.Lock()
+        if path.is_file():
+            with path.open('r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        record = json.loads(line)
+                        self.records[record['case_id']] = record
+
+    def succeeded(self, cid: str) -> bool:
+        return self.records.get(cid, {}).get('status') == 'ok'
+
+    def record(self, record: dict):
+        with self._lock:
+            self.records[record['case_id']] = record
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with self.path.open('a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+class Throughput:
+    def __init__(self, total: int):
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.tokens = 0
+        self.start = time.time()
+        self._lock = threading.Lock()
+
+    def update(self, record: dict) -> str:
+        with self._lock:
+            self.done += 1
+            self.failed += record['status'] != 'ok'
+            self.tokens += record.get('tokens', 0)
+            elapsed = max(time.time() - self.start, 1e-9)
+            return (
+                f"[{self.done}/{self.total}] 失败 {self.failed}，"
+                f"{self.done / elapsed * 3600:.1f} 病例/小时，"
+                f"{self.tokens / elapsed * 60:.0f} tokens/分钟"
+            )
+
+
+def run_one(sheet_name: str, row_number: int, col_number: int) -> dict:
+    start = time.time()
+    record = {'case_id': case_id(sheet_name, row_number), 'row': row_number}
+    try:
+        summary = flow(sheet_name, row_number, col_number)
+        record.update(summary or {}, status='ok')
+    except Exception as exc:
+        traceback.print_exc()
+        record.update(status='failed', error=f"{type(exc).__name__}: {exc}")
+    record['seconds'] = round(time.time() - start, 3)
+    record['finished_at'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    return record
+
+
+def main():
+    parser = argparse.ArgumentParser(description='批量运行模拟问诊')
+    parser.add_argument('--sheet', default=SHEET_NAME)
+    parser.add_argument('--col', type=int, default=COL_NUMBER)
+    parser.add_argument('--start', type=int, default=None, help='起始行（默认接着 case_cache.txt 的记录）')
+    parser.add_argument('--end', type=int, default=1301, help='结束行（含）')
+    parser.add_argument('--concurrency', type=int, default=int(os.getenv('RUN_CONCURRENCY', '1')),
+                        help='同时运行的病例数')
+    parser.add_argument('--llm-concurrency', type=int, default=api_call.LLM_MAX_CONCURRENCY,
+                        help='所有病例共享的在途 LLM / embedding 请求上限（默认取 LLM_MAX_CONCURRENCY）')
+    parser.add_argument('--state', type=Path, default=STATE_PATH, help='病例状态文件（JSONL）')
+    parser.add_argument('--skip-failed', action='store_true', help='不重跑之前失败的病例')
+    args = parser.parse_args()
+    # 请求上限与连接池大小要在第一个请求之前确定
+    api_call.set_max_concurrency(args.llm_concurrency)
+
+    state = RunState(args.state)
+    start = max(args.start if args.start is not None else legacy_start(), FIRST_DATA_ROW)
+    # 有病例库时只调度非空行
+    store = open_case_store()
+    if store is not None:
+        candidates = [row for row, _, _ in store.iter_cases(args.sheet, args.col, start, args.end)]
+    else:
+        candidates = range(start, args.end + 1)
+    rows = [
+        row for row in candidates
+        if not state.succeeded(case_id(args.sheet, row))
+        and not (args.skip_failed and case_id(args.sheet, row) in state.records)
+    ]
+    print(f"待运行 {len(rows)} 个病例，并发 {args.concurrency}，LLM 请求上限 {args.llm_concurrency}")
+
+    throughput = Throughput(len(rows))
+    with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as pool:
+        futures = [pool.submit(run_one, args.sheet, row, args.col) for row in rows]
+        try:
+            for future in as_completed(futures):
+                record = future.result()
+                state.record(record)
+                print(record['case_id'], record['status'], throughput.update(record))
+        except KeyboardInterrupt:
+            # 已提交未开始的病例直接取消，正在运行的病例跑完后退出
+            for future in futures:
+                future.cancel()
+            raise
+
+
+if __name__ == '__main__':
+    main()
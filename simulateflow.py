@@ -1,31 +1,21 @@
 from pathlib import Path
 import re
-import json
-import csv
 import time
 import random
-import shutil
-import os
 
-from dotenv import load_dotenv
 from Simulated.simulated_patient.vagueness import get_vague_patient_info
 from Simulated.simulated_patient.patient_agent import Patient
 from Simulated.simulated_patient.doctor_agent import Doctor
-from Simulated.simulated_patient.api_call import llm_api  # 用于 LLM 调用（内部应读取环境变量）
+from Simulated.simulated_patient.api_call import llm_api, cache_stats, reset_cache_stats  # 用于 LLM 调用（内部应读取环境变量）
+from Simulated.simulated_patient.token_usage import token_accounting, case_scope
+from Simulated.simulated_patient.postprocess import make_postprocessor
+from Simulated.simulated_patient.case_context import CaseContext, load_prompts
+from Simulated.simulated_patient.result_sink import get_result_sink
+from Simulated.simulated_patient.tracing import span, tracer, latency_table, write_chrome_trace, TRACE_DIR
 # 若需要：from Simulated.simulated_patient.agent_evolve import get_text_embedding
 
 
-# ====== 环境变量（密钥不落地，实际读取在 llm_api 内部）======
-load_dotenv()
-if not os.getenv("OPENAI_API_KEY"):
-    raise RuntimeError("未检测到 OPENAI_API_KEY，请在系统或 .env 中设置。")
-
-
 # ====== 工具函数 ======
-def ensure_parent(path: Path):
-    path.parent.mkdir(parents=True, exist_ok=True)
-
-
 def match_star(context: str) -> str:
     """匹配 **...** 并返回去星号后的原文；找不到则抛出异常。"""
     m = re.search(r"\*\*(.*?)\*\*", context, flags=re.DOTALL)
@@ -34,32 +24,14 @@ def match_star(context: str) -> str:
     return re.sub(r"\*", "", m.group(0))
 
 
-def read_prompt() -> dict:
-    """读取并拼接 Simulated/Prompt/prompt_data.json 中的各条 prompt。"""
-    p = Path("Simulated/Prompt/prompt_data.json")
-    data = json.loads(p.read_text(encoding="utf-8"))
-    final = {}
-    for k, v in data.items():
-        final[k] = "".join(v) if isinstance(v, list) else str(v)
-    return final
-
-
-def clean_token_count():
-    tp_overall = Path("./make_task/token_count/token_overall.txt")
-    tp_stream = Path("./make_task/token_count/token_stream.txt")
-    ensure_parent(tp_overall)
-    tp_overall.write_text("", encoding="utf-8")
-    tp_stream.write_text("", encoding="utf-8")
+def get_token_count() -> str:
+    """当前病例的累计 token（内存统计，无文件读写）。"""
+    return str(token_accounting.totals()["total_tokens"])
 
 
-def get_token_count() -> str:
-    """读取累计 token（若不存在或为空则返回 '0'）。"""
-    tp_stream = Path("./make_task/token_count/token_stream.txt")
-    if not tp_stream.exists():
-        return "0"
-    token_str = tp_stream.read_text(encoding="utf-8")
-    nums = re.findall(r"\d+", token_str)
-    return nums[-1] if nums else "0"
+def print_delta(text: str):
+    """交互模式下逐段打印流式生成的回答。"""
+    print(text, end="", flush=True)
 
 
 def count_chinese_characters(text: str) -> int:
@@ -68,23 +40,42 @@ def count_chinese_characters(text: str) -> int:
 
 # ====== 主流程 ======
 def flow(sheet_name: str = "病程记录_首次病程", row_number: int = 6, col_number: int = 1):
-    clean_token_count()
+    """运行一个病例，返回摘要（病例 id、结果目录、轮数、token 数、耗时）。"""
+    with case_scope(case_id(sheet_name, row_number)):
+        # 质量评估与进化记忆写入在后台执行；病例中途失败时也要等它们结束并停掉工作线程
+        postprocessor = make_postprocessor()
+        try:
+            return run_case(sheet_name, row_number, col_number, postprocessor)
+        finally:
+            postprocessor.close()
+            # 丢弃病例记录写出之后（或病例中途失败时）残留的统计，避免在长时间运行中累积
+            tracer.pop()
+            token_accounting.pop()
 
-    test_label = str(time.time())
+
+def case_id(sheet_name: str, row_number: int) -> str:
+    return f"{sheet_name}:{row_number}"
+
+
+def run_case(sheet_name: str, row_number: int, col_number: int, postprocessor):
+    reset_cache_stats()
+    case_start = time.time()
+
+    # 目录名带上行号，并发运行多个病例时不会撞名
+    test_label = f"{row_number}_{time.time()}"
     parent_folder = Path("exp1")
     directory = parent_folder / test_label
     (directory / "doctor_record").mkdir(parents=True, exist_ok=True)
     print(f"文件夹 {test_label} 已创建在 {parent_folder} 中。")
 
     # 读取患者“完整信息 + 模糊信息”
-    resource, vague_info = get_vague_patient_info(sheet_name, row_number, col_number)
+    with span("case.load"):
+        resource, vague_info = get_vague_patient_info(sheet_name, row_number, col_number)
 
-    # 保存原始资源和模糊信息
-    (directory / "resource.txt").write_text(resource, encoding="utf-8")
-    (directory / "vague.txt").write_text(vague_info, encoding="utf-8")
-
-    prompt_data = read_prompt()
-    patient = Patient(vague_info, resource, str(directory), prompt_data)
+    # 病例信息放在内存中的 CaseContext 里；prompt 注册表只读共享
+    case = CaseContext(case_id(sheet_name, row_number), resource, vague_info, directory)
+    prompt_data = load_prompts()
+    patient = Patient(case, prompt_data, postprocessor=postprocessor)
 
     # 分配科室（从 **...** 提取科室名）
     office = match_star(patient.assign_office())
@@ -99,7 +90,7 @@ def flow(sheet_name: str = "病程记录_首次病程", row_number: int = 6, col
     main_complaint = generate_main_complaint()
 
     # 初始化医生并发起首问
-    doctor = Doctor(patient, office, main_complaint, str(directory), prompt_data)
+    doctor = Doctor(patient, office, main_complaint, str(directory), prompt_data, postprocessor=postprocessor)
     resp = doctor.doctor_qus(main_complaint, 0, 0, 0, 0)
     try:
         doctor_question = match_star(resp)
@@ -114,18 +105,9 @@ def flow(sheet_name: str = "病程记录_首次病程", row_number: int = 6, col
     auto = True
     random_crisis_num = random.randrange(int(max_turn / 2), max_turn)
 
-    # 轮次记录（实验目录内 + 顶层便捷文件）
-    exp_csv = directory / "question_record.csv"
-    top_csv = Path("question_record.csv")
-    for p in (exp_csv, top_csv):
-        if not p.exists():
-            ensure_parent(p)
-            with p.open("w", newline="", encoding="utf-8") as f:
-                writer = csv.writer(f)
-                writer.writerow([
-                    "row", "question", "answer", "token_count_doctor", "token_count_patient",
-                    "resource", "doctor_time", "patient_time", "question_cnt", "answer_cnt"
-                ])
+    # 轮次与病例记录统一交给结果写出器（批量追加，病例级文本只存一次）
+    sink = get_result_sink()
+    crisis = None
 
     while cnt < max_turn:
         cnt += 1
@@ -136,13 +118,12 @@ def flow(sheet_name: str = "病程记录_首次病程", row_number: int = 6, col
             doctor_crisis_ans = doctor.doctor_crisis_answer(office, patient_crisis)
             patient_ans_after_crisis = patient.patient_crisis_ans(doctor_crisis_ans)
 
-            crisis_file = directory / "crisis.txt"
-            crisis_txt = (
-                f"轮数：**{cnt}**病人紧急情况：**{patient_crisis}**"
-                f"医生对紧急情况的回复**{doctor_crisis_ans}**"
-                f"病人对医生回复的反应**{patient_ans_after_crisis}**"
-            )
-            crisis_file.write_text(crisis_txt, encoding="utf-8")
+            crisis = {
+                "turn": cnt,
+                "patient_crisis": patient_crisis,
+                "doctor_answer": doctor_crisis_ans,
+                "patient_reaction": patient_ans_after_crisis,
+            }
 
         start_time = time.time()
 
@@ -165,44 +146,80 @@ def flow(sheet_name: str = "病程记录_首次病程", row_number: int = 6, col
         token_count_doctor = get_token_count()
         middle_time = time.time()
 
-        # 患者回答
-        patient_answer, score, rel, faith, human = patient.patient_ans(doctor_question)
+        # 患者回答（交互模式下边生成边显示）
+        if auto:
+            patient_answer, score, rel, faith, human = patient.patient_ans(doctor_question)
+        else:
+            print("Patient answer: ", end="")
+            patient_answer, score, rel, faith, human = patient.patient_ans(doctor_question, on_delta=print_delta)
+            print()
         token_count_patient = get_token_count()
         end_time = time.time()
 
         doctor_time = middle_time - start_time
         patient_time = end_time - start_time
 
-        # 写入两份 CSV（实验目录与顶层）
-        row = [
-            row_number,
-            doctor_question.replace("\n", ""),
-            patient_answer.replace("\n", ""),
-            token_count_doctor,
-            token_count_patient,
-            resource,
-            doctor_time,
-            patient_time,
-            count_chinese_characters(doctor_question),
-            count_chinese_characters(patient_answer),
-        ]
-        for p in (exp_csv, top_csv):
-            with p.open("a", newline="", encoding="utf-8") as f:
-                csv.writer(f).writerow(row)
+        sink.add_turn({
+            "run": test_label,
+            "case_id": case.case_id,
+            "row": row_number,
+            "turn": cnt,
+            "question": doctor_question,
+            "answer": patient_answer,
+            "token_count_doctor": token_count_doctor,
+            "token_count_patient": token_count_patient,
+            "doctor_time": doctor_time,
+            "patient_time": patient_time,
+            "question_cnt": count_chinese_characters(doctor_question),
+            "answer_cnt": count_chinese_characters(patient_answer),
+            "patient_timings": patient.last_timings,
+        })
+
+    # 等待后台评估与入库完成，记录文件与 token 统计在此之后才完整
+    with span("postprocess.drain"):
+        postprocessor.close()
+    # 有后台任务失败时记录文件不完整，整个病例按失败处理
+    postprocessor.check()
 
     # 结论
     conclusion = doctor.conclusion()
-    (directory / "conclusion.txt").write_text(conclusion, encoding="utf-8")
-
-    # 统计耗时（从最后一轮开始计时）
-    time_cost = time.time() - start_time
-    (directory / "time_cost.txt").write_text(str(time_cost), encoding="utf-8")
-
-    # 迁移 token 统计文件
-    source_folder = Path("./make_task/token_count")
-    destination_folder = directory / "token_count"
-    destination_folder.mkdir(parents=True, exist_ok=True)
-    if source_folder.exists():
-        for file_path in source_folder.glob("*.txt"):
-            shutil.move(str(file_path), str(destination_folder))
-            print(f"文件 {file_path.name} 已移动到 {destination_folder}")
+
+    # 整个病例的耗时（从病例开始计时）
+    time_cost = time.time() - case_start
+
+    # 响应缓存命中统计（节省的调用次数与秒数）
+    stats = cache_stats()
+    if stats:
+        print(f"缓存命中 {stats['hits']} 次，节省 {stats['saved_seconds']} 秒")
+
+    # 病例结束时取出 token 统计，与病例级信息一起写一条记录
+    tokens = token_accounting.pop()
+    # 各阶段耗时汇总写入病例记录；设置 TRACE_DIR 时另存 Chrome trace
+    spans = tracer.pop()
+    if TRACE_DIR and spans:
+        write_chrome_trace(spans, Path(TRACE_DIR) / f"{test_label}.json", label=case.case_id)
+    summary = {
+        "case_id": case.case_id,
+        "directory": str(directory),
+        "turns": cnt,
+        "tokens": tokens["totals"].get("total_tokens", 0),
+        "seconds": round(time.time() - case_start, 3),
+    }
+    sink.add_case({
+        **summary,
+        "run": test_label,
+        "sheet": sheet_name,
+        "row": row_number,
+        "office": office,
+        "main_complaint": main_complaint,
+        "resource": resource,
+        "vague": vague_info,
+        "crisis": crisis,
+        "conclusion": conclusion,
+        "time_cost": time_cost,
+        "token_totals": tokens["totals"],
+        "token_breakdown": tokens["breakdown"],
+        "llm_cache": stats,
+        "stage_latency": latency_table(spans),
+    })
+    return summary
@@ -0,0 +1,39 @@
+import openpyxl
+import pytest
+
+from Simulated.simulated_patient import vagueness
+from Simulated.simulated_patient.case_store import CaseStore
+
+
+@pytest.fixture
+def workbook(tmp_path):
+    path = tmp_path / "patient_text.xlsx"
+    wb = openpyxl.Workbook()
+    sheet = wb.active
+    sheet.title = "病程记录"
+    sheet.append(["Patient-SN", "text"])
+    sheet.append(["p1", "头痛三天"])
+    sheet.append(["p2", None])
+    wb.save(path)
+    return path
+
+
+def test_store_reads_cells_and_skips_header(workbook, tmp_path):
+    store = CaseStore(tmp_path / "store.sqlite").build(workbook)
+    assert store.has_sheet("病程记录") and not store.has_sheet("其他")
+    assert store.cell("病程记录", 2, 1) == "头痛三天"
+    assert store.patient_sn("病程记录", 2) == "p1"
+    assert [row for row, _, _ in store.iter_cases("病程记录", 1, start=1)] == [2]
+    assert store.is_current(workbook)
+
+
+def test_patient_info_errors_match_workbook(workbook, tmp_path, monkeypatch):
+    store = CaseStore(tmp_path / "store.sqlite")
+    monkeypatch.setattr(vagueness, "open_case_store", lambda *_: store)
+    with pytest.raises(FileNotFoundError):
+        vagueness.get_patient_info("病程记录", 2, 1)
+    store.build(workbook)
+    with pytest.raises(KeyError):
+        vagueness.get_patient_info("其他", 2, 1)
+    assert vagueness.get_patient_info("病程记录", 2, 1) == "头痛三天"
+    assert vagueness.get_patient_info("病程记录", 3, 1) == ""
@@ -0,0 +1,147 @@
+import json
+
+import numpy as np
+import pytest
+
+from Simulated.simulated_patient import agent_evolve
+from Simulated.simulated_patient.evolve_store import (
+    DOCTOR_KEY_FIELDS, DOCTOR_VECTOR_COLUMNS, PATIENT_VECTOR_COLUMNS, EvolveStore, _truncate_npy, migrate_csv,
+    open_store, row_key, store_path_for,
+)
+
+
+def unit(*values):
+    vector = np.array(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def patient_store(path):
+    return EvolveStore(path, PATIENT_VECTOR_COLUMNS)
+
+
+def meta(question, answer="好的"):
+    return {"question": question, "rag_info": "", "answer": answer, "requirements": ""}
+
+
+def test_append_and_search_round_trip(tmp_path):
+    store = patient_store(tmp_path / "s.store")
+    rows = store.append_many(
+        {"qus_embedding": np.stack([unit(1, 0, 0), unit(0, 1, 0), unit(1, 1, 0)])},
+        [meta("a"), meta("b"), meta("c")],
+    )
+    assert rows == [0, 1, 2]
+    result = store.search("qus_embedding", unit(1, 0.1, 0), k=2, threshold=0.5)
+    assert result.ids.tolist() == [0, 2] and result.total == 2
+    assert result.scores[0] > result.scores[1]
+    assert [row["question"] for row in store.rows(result.ids)] == ["a", "c"]
+    assert store.vectors().shape == (3, 3)
+
+
+def test_row_key_dedup_ignores_case_and_whitespace(tmp_path):
+    store = patient_store(tmp_path / "s.store")
+    first = store.append({"qus_embedding": unit(1, 0)}, meta("头痛 吗?", "有"))
+    again = store.append({"qus_embedding": unit(0, 1)}, meta("  头痛  吗？", "有"))
+    assert first == again == 0 and len(store) == 1
+    assert row_key("Hello  World") == row_key("hello world")
+    assert store.find(row_key("头痛 吗?", "有")) == 0
+
+
+def test_ids_persist_across_reopen(tmp_path):
+    path = tmp_path / "s.store"
+    patient_store(path).append_many({"qus_embedding": np.stack([unit(1, 0), unit(0, 1)])}, [meta("a"), meta("b")])
+    reopened = patient_store(path)
+    assert (path / "ids.txt").read_text().split() == [row_key("a", "好的"), row_key("b", "好的")]
+    assert reopened.find(row_key("b", "好的")) == 1
+    assert reopened.append({"qus_embedding": unit(1, 1)}, meta("a")) == 0
+
+
+def test_missing_ids_file_is_rebuilt_from_meta(tmp_path):
+    path = tmp_path / "s.store"
+    patient_store(path).append({"qus_embedding": unit(1, 0)}, meta("a"))
+    (path / "ids.txt").unlink()
+    assert row_key("a", "好的") in patient_store(path)
+    assert (path / "ids.txt").read_text() == row_key("a", "好的") + "\n"
+
+
+def test_interrupted_append_is_realigned(tmp_path):
+    path = tmp_path / "d.store"
+    store = EvolveStore(path, DOCTOR_VECTOR_COLUMNS, DOCTOR_KEY_FIELDS)
+    store.append({"qus_embedding": unit(1, 0), "qus2_embedding": unit(0, 1)}, {"question1": "a"})
+    # 模拟第二行写到一半：第一列多了一行向量，元数据多了半行，ids.txt 多了一个 id
+    store.append({"qus_embedding": unit(0, 1), "qus2_embedding": unit(1, 0)}, {"question1": "b"})
+    lines = (path / "meta.jsonl").read_bytes().splitlines(keepends=True)
+    (path / "meta.jsonl").write_bytes(lines[0] + lines[1][:5])
+    _truncate_npy(path / "qus2_embedding.npy", 1)
+
+    reopened = EvolveStore(path, DOCTOR_VECTOR_COLUMNS, DOCTOR_KEY_FIELDS)
+    assert len(reopened) == 1
+    assert reopened.vectors("qus_embedding").shape == (1, 2)
+    assert (path / "meta.jsonl").read_bytes() == lines[0]
+    assert len((path / "ids.txt").read_text().split()) == 1
+    # 之后的追加与元数据对齐
+    row = reopened.append({"qus_embedding": unit(1, 1), "qus2_embedding": unit(1, 1)}, {"question1": "c"})
+    assert row == 1
+    assert reopened.rows([1])[0]["question1"] == "c"
+    assert np.allclose(reopened.vectors("qus2_embedding")[1], unit(1, 1))
+
+
+def test_missing_npy_keeps_meta(tmp_path):
+    path = tmp_path / "s.store"
+    patient_store(path).append({"qus_embedding": unit(1, 0)}, meta("a"))
+    (path / "qus_embedding.npy").unlink()
+    with pytest.raises(FileNotFoundError):
+        patient_store(path)
+    assert json.loads((path / "meta.jsonl").read_text())["question"] == "a"
+
+
+def test_any_similar_requires_every_column_above_threshold(tmp_path):
+    store = EvolveStore(tmp_path / "d.store", DOCTOR_VECTOR_COLUMNS, DOCTOR_KEY_FIELDS)
+    store.append({"qus_embedding": unit(1, 0), "qus2_embedding": unit(0, 1)}, {"question1": "a"})
+    assert store.any_similar({"qus_embedding": unit(1, 0.1), "qus2_embedding": unit(0.1, 1)}, 0.8)
+    assert not store.any_similar({"qus_embedding": unit(1, 0.1), "qus2_embedding": unit(1, 0)}, 0.8)
+    assert not store.any_similar({"qus_embedding": unit(1, 1)}, 0.8)
+    assert store.any_similar({"qus_embedding": unit(1, 1)}, 0.7)
+    assert not EvolveStore(tmp_path / "empty.store", PATIENT_VECTOR_COLUMNS).any_similar({"qus_embedding": unit(1)}, 0)
+
+
+def test_store_patient_qa_skips_near_duplicates(tmp_path, monkeypatch):
+    vectors = {"头痛多久了": unit(1, 0), "头痛几天了": unit(1, 0.05), "发烧吗": unit(0, 1)}
+    monkeypatch.setattr(agent_evolve, "get_text_embedding", vectors.__getitem__)
+    csv_path = tmp_path / "patient_evolve.csv"
+    for question in vectors:
+        agent_evolve.store_patient_qa(str(csv_path), question, "", "三天", "")
+    store = agent_evolve.open_store(csv_path)
+    assert [row["question"] for row in store.rows(range(len(store)))] == ["头痛多久了", "发烧吗"]
+    # CSV 镜像与存储一致：表头 + 2 行
+    assert len(csv_path.read_text(encoding="gbk").splitlines()) == 3
+    assert agent_evolve.get_consistency(str(csv_path), unit(1, 0.02)) == [0]
+    assert agent_evolve.get_consistency(str(csv_path), unit(1, 1)) == []
+
+
+def write_legacy_csv(path, rows):
+    lines = ["qus_embedding,question,rag_info,answer,requirements"]
+    lines += [f'"{",".join(map(str, vector))}",{question},,好的,' for vector, question in rows]
+    path.write_text("\n".join(lines) + "\n", encoding="gbk")
+
+
+def test_migrate_csv(tmp_path):
+    csv_path = tmp_path / "patient_evolve.csv"
+    write_legacy_csv(csv_path, [([1, 0, 0], "头痛"), ([0, 1, 0], "发烧"), ([0, 0, 1], "咳嗽")])
+    store = migrate_csv(csv_path)
+    assert len(store) == 3
+    assert store.vectors().shape == (3, 3) and store.vectors().dtype == np.float32
+    assert set(store.rows([0])[0]) == {"question", "rag_info", "answer", "requirements"}
+    assert store.rows([2])[0]["question"] == "咳嗽"
+
+
+def test_migrate_refuses_non_empty_store_unless_forced(tmp_path):
+    csv_path = tmp_path / "patient_evolve.csv"
+    write_legacy_csv(csv_path, [([1, 0], "头痛")])
+    migrate_csv(csv_path)
+    write_legacy_csv(csv_path, [([1, 0], "头痛"), ([0, 1], "发烧")])
+    with pytest.raises(FileExistsError):
+        migrate_csv(csv_path)
+    (store_path_for(csv_path) / "qus_embedding.npy").unlink()
+    store = migrate_csv(csv_path, force=True)
+    assert len(store) == 2 and store.vectors().shape == (2, 2)
+    assert len(open_store(csv_path)) == 2
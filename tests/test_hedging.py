@@ -0,0 +1,134 @@
+import asyncio
+
+import pytest
+
+from Simulated.simulated_patient import hedging
+from Simulated.simulated_patient.hedging import CircuitBreaker, CLOSED, PROBE, hedged, parse_timeouts, timeout_for
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failures=2, cooldown=60)
+    breaker.failure("m")
+    assert breaker.allow("m") == CLOSED
+    breaker.failure("m")
+    assert breaker.allow("m") is None
+    assert breaker.snapshot()["m"] == {"open": True, "failures": 2, "opened": 1}
+
+
+def test_breaker_success_resets_failure_count():
+    breaker = CircuitBreaker(failures=2, cooldown=60)
+    breaker.failure("m")
+    breaker.success("m")
+    breaker.failure("m")
+    assert breaker.available("m")
+
+
+def test_breaker_lets_one_probe_through_after_cooldown():
+    breaker = CircuitBreaker(failures=1, cooldown=0)
+    breaker.failure("m")
+    assert breaker.allow("m") == PROBE
+    assert breaker.allow("m") is None  # 探测进行中，其他调用仍走降级
+    breaker.success("m")
+    assert breaker.allow("m") == CLOSED
+
+
+def test_breaker_failed_probe_reopens():
+    breaker = CircuitBreaker(failures=1, cooldown=60)
+    breaker.failure("m")
+    breaker._state["m"]["opened_at"] -= 61
+    assert breaker.allow("m") == PROBE
+    breaker.failure("m")
+    assert breaker.allow("m") is None
+
+
+@pytest.mark.parametrize("failed, expected", [(False, PROBE), (True, None)])
+def test_breaker_released_probe_is_not_stuck(failed, expected):
+    breaker = CircuitBreaker(failures=1, cooldown=60)
+    breaker.failure("m")
+    breaker._state["m"]["opened_at"] -= 61
+    assert breaker.allow("m") == PROBE
+    breaker.release("m", failed=failed)
+    # 被取消的探测不计结果，下一次调用重新探测；其他异常按失败处理，重新冷却
+    assert breaker.allow("m") == expected
+
+
+def test_breaker_disabled():
+    breaker = CircuitBreaker(failures=0, cooldown=60)
+    for _ in range(10):
+        breaker.failure("m")
+    assert breaker.allow("m") == CLOSED
+
+
+def _delayed(delays, results, started):
+    """第 n 次调用 factory() 时等待 delays[n] 秒后返回（或抛出）results[n]。"""
+    def factory():
+        index = len(started)
+
+        async def call():
+            started.append(index)
+            try:
+                await asyncio.sleep(delays[index])
+            except asyncio.CancelledError:
+                started[index] = "cancelled"
+                raise
+            if isinstance(results[index], Exception):
+                raise results[index]
+            return results[index]
+        return call()
+    return factory
+
+
+def test_hedged_without_delay_runs_once():
+    started = []
+    result = asyncio.run(hedged(_delayed([0], ["a"], started)))
+    assert result == ("a", None)
+    assert started == [0]
+
+
+def test_hedged_fast_call_is_not_hedged():
+    started = []
+    result = asyncio.run(hedged(_delayed([0, 0], ["a", "b"], started), delay=0.1))
+    assert result == ("a", None)
+    assert started == [0]
+
+
+def test_hedge_wins_and_original_is_cancelled():
+    started = []
+    result = asyncio.run(hedged(_delayed([1, 0], ["slow", "fast"], started), delay=0.01))
+    assert result == ("fast", "won")
+    assert started == ["cancelled", 1]
+
+
+def test_original_wins_and_hedge_is_cancelled():
+    started = []
+    result = asyncio.run(hedged(_delayed([0.05, 1], ["first", "second"], started), delay=0.01))
+    assert result == ("first", "fired")
+    assert started == [0, "cancelled"]
+
+
+def test_hedge_skipped_without_idle_slot():
+    started = []
+    result = asyncio.run(hedged(_delayed([0.05, 0], ["a", "b"], started), delay=0.01, can_hedge=lambda: False))
+    assert result == ("a", None)
+    assert started == [0]
+
+
+def test_hedged_failure_falls_back_to_other_request():
+    started = []
+    result = asyncio.run(hedged(_delayed([0.05, 0.1], [ValueError("x"), "ok"], started), delay=0.01))
+    assert result == ("ok", "won")
+
+
+def test_hedged_both_fail_raises_original_error():
+    started = []
+    with pytest.raises(ValueError, match="first"):
+        asyncio.run(hedged(_delayed([0.02, 0.03], [ValueError("first"), KeyError("second")], started), delay=0.01))
+
+
+def test_retry_keys_use_the_base_key_timeout(monkeypatch):
+    monkeypatch.setattr(hedging, "LLM_TIMEOUTS", parse_timeouts("dynamic_requirements=20,recruit:retry=5,*=90"))
+    assert timeout_for("dynamic_requirements") == 20
+    assert timeout_for("dynamic_requirements:retry") == 20
+    assert timeout_for("recruit:retry") == 5
+    assert timeout_for("summary:retry") == 90
+    assert timeout_for(None) == 90
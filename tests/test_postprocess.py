@@ -0,0 +1,40 @@
+import pytest
+
+from Simulated.simulated_patient.postprocess import (
+    PostProcessError, PostProcessor, settle, split_future,
+)
+
+
+def fail():
+    raise ValueError("boom")
+
+
+def test_failed_task_marks_case_failed():
+    processor = PostProcessor(workers=1, maxsize=4)
+    ok = processor.submit(lambda: 1)
+    bad = processor.submit(fail)
+    processor.close()
+    assert ok.result() == 1
+    assert isinstance(bad.exception(), ValueError)
+    with pytest.raises(PostProcessError):
+        processor.check()
+
+
+def test_close_is_idempotent_and_clean_run_passes():
+    processor = PostProcessor(workers=2, maxsize=1)
+    futures = [processor.submit(lambda i=i: i * 2) for i in range(5)]
+    processor.close()
+    processor.close()
+    processor.check()
+    assert [future.result() for future in futures] == [0, 2, 4, 6, 8]
+
+
+def test_failure_does_not_cascade_through_settled_futures():
+    processor = PostProcessor(workers=1, maxsize=4)
+    score, _ = split_future(processor.submit(fail), 2)
+    # 下一轮任务读取上一轮失败的分数：取默认值，自身照常完成
+    follow = processor.submit(lambda: settle(score) + 1)
+    processor.close()
+    assert follow.result() == 1
+    assert processor.failed == 1
+    assert settle("text", "") == "text"
@@ -0,0 +1,138 @@
+import asyncio
+
+import httpx
+import pytest
+from openai import RateLimitError
+
+from Simulated.simulated_patient import api_call, rate_limit
+from Simulated.simulated_patient.rate_limit import (
+    Scheduler, TokenBucket, CRITICAL, NORMAL, BACKGROUND, priority_for, run_as_background, with_backoff,
+)
+
+
+def test_priority_for_keys():
+    assert priority_for("doctor_question_info") == CRITICAL
+    assert priority_for("summary") == BACKGROUND
+    assert priority_for("dynamic_requirements:retry") == BACKGROUND
+    assert priority_for("recruit") == NORMAL
+    assert priority_for(None) == NORMAL
+
+
+def test_embedding_priority_follows_prompt_key(monkeypatch):
+    seen = []
+
+    async def fake_embeddings(texts, model, priority):
+        seen.append(priority)
+        return [[1.0] for _ in texts]
+
+    monkeypatch.setattr(api_call, "_embeddings", fake_embeddings)
+    monkeypatch.setattr(api_call, "_embedding_cache", None)
+    api_call.get_text_embedding("头痛多久了")
+    api_call.get_text_embedding("头痛多久了", prompt_key="patient_answer_generator")
+    assert seen == [BACKGROUND, CRITICAL]
+
+
+def test_background_scope_lowers_normal_keys_only():
+    assert run_as_background(priority_for, "recruit") == BACKGROUND
+    assert run_as_background(priority_for, "patient_answer_generator") == CRITICAL
+
+
+def test_free_slots_go_by_priority_then_arrival():
+    order = []
+
+    async def scenario():
+        scheduler = Scheduler(max_concurrency=1)
+        release = asyncio.Event()
+
+        async def hold():
+            async with scheduler.slot(NORMAL, 1):
+                await release.wait()
+
+        async def request(name, priority):
+            async with scheduler.slot(priority, 1):
+                order.append(name)
+
+        holder = asyncio.ensure_future(hold())
+        await asyncio.sleep(0)
+        waiters = [
+            asyncio.ensure_future(request(name, priority))
+            for name, priority in [("bg", BACKGROUND), ("normal-1", NORMAL), ("critical", CRITICAL),
+                                   ("normal-2", NORMAL)]
+        ]
+        await asyncio.sleep(0)
+        assert scheduler.snapshot()["queued"] == 4
+        release.set()
+        await asyncio.gather(holder, *waiters)
+        return scheduler
+
+    scheduler = asyncio.run(scenario())
+    assert order == ["critical", "normal-1", "normal-2", "bg"]
+    assert scheduler.in_flight == 0
+    assert scheduler.snapshot()["critical"]["requests"] == 1
+
+
+def test_cancelled_waiter_does_not_leak_a_slot():
+    async def scenario():
+        scheduler = Scheduler(max_concurrency=1)
+        release = asyncio.Event()
+
+        async def hold():
+            async with scheduler.slot(NORMAL, 1):
+                await release.wait()
+
+        async def request():
+            async with scheduler.slot(NORMAL, 1):
+                return "ok"
+
+        holder = asyncio.ensure_future(hold())
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(request())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        release.set()
+        await asyncio.gather(holder, waiter, return_exceptions=True)
+        result = await request()
+        return scheduler, result
+
+    scheduler, result = asyncio.run(scenario())
+    assert result == "ok"
+    assert scheduler.in_flight == 0
+    assert scheduler.has_idle_slot()
+
+
+def test_token_bucket_waits_for_refill():
+    bucket = TokenBucket(per_minute=60)
+    assert bucket.wait_time(60) == 0
+    bucket.take(60)
+    assert bucket.wait_time(1) == pytest.approx(1.0, abs=0.05)
+
+
+def _rate_limit_error():
+    request = httpx.Request("POST", "http://test")
+    return RateLimitError("429", response=httpx.Response(429, request=request), body=None)
+
+
+def test_with_backoff_retries_rate_limits(monkeypatch):
+    monkeypatch.setattr(rate_limit, "backoff_delay", lambda attempt: 0)
+    attempts = []
+
+    async def factory():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise _rate_limit_error()
+        return "ok"
+
+    scheduler = Scheduler(max_concurrency=1)
+    assert asyncio.run(with_backoff(factory, scheduler, retries=5)) == "ok"
+    assert len(attempts) == 3
+    assert scheduler.snapshot()["rate_limited"] == 2
+
+
+def test_with_backoff_gives_up(monkeypatch):
+    monkeypatch.setattr(rate_limit, "backoff_delay", lambda attempt: 0)
+
+    async def factory():
+        raise _rate_limit_error()
+
+    with pytest.raises(RateLimitError):
+        asyncio.run(with_backoff(factory, retries=2))
@@ -0,0 +1,233 @@
+import asyncio
+
+from Simulated.simulated_patient.single_flight import SingleFlight
+
+
+class Upstream:
+    """记录调用次数；release 之前每次调用都挂起。"""
+
+    def __init__(self):
+        self.calls = []
+        self.gate = None
+        self.cancelled = 0
+
+    def factory(self, value):
+        async def call():
+            self.calls.append(value)
+            try:
+                await self.gate.wait()
+            except asyncio.CancelledError:
+                self.cancelled += 1
+                raise
+            return value
+        return call
+
+
+def run(scenario):
+    return asyncio.run(scenario())
+
+
+def test_concurrent_callers_share_one_call():
+    upstream = Upstream()
+
+    async def scenario():
+        upstream.gate = asyncio.Event()
+        flights = SingleFlight()
+        tasks = [asyncio.ensure_future(flights.do("chat", "k", upstream.factory("r"))) for _ in range(3)]
+        await asyncio.sleep(0)
+        upstream.gate.set()
+        return await asyncio.gather(*tasks), flights.snapshot()
+
+    results, snapshot = run(scenario)
+    assert upstream.calls == ["r"]
+    # 只有一个调用方负责记 token 等
+    assert sorted(shared for _, shared in results) == [False, True, True]
+    assert all(value == "r" for value, _ in results)
+    assert snapshot == {"chat": {"requests": 1, "coalesced": 2}, "in_flight": 0}
+
+
+def test_finished_call_is_not_reused():
+    upstream = Upstream()
+
+    async def scenario():
+        upstream.gate = asyncio.Event()
+        upstream.gate.set()
+        flights = SingleFlight()
+        await flights.do("chat", "k", upstream.factory("a"))
+        await flights.do("chat", "k", upstream.factory("b"))
+
+    run(scenario)
+    assert upstream.calls == ["a", "b"]
+
+
+def test_disabled_does_not_coalesce():
+    upstream = Upstream()
+
+    async def scenario():
+        upstream.gate = asyncio.Event()
+        flights = SingleFlight(enabled=False)
+        tasks = [asyncio.ensure_future(flights.do("chat", "k", upstream.factory(i))) for i in range(2)]
+        await asyncio.sleep(0)
+        upstream.gate.set()
+        return await asyncio.gather(*tasks)
+
+    assert run(scenario) == [(0, False), (1, False)]
+    assert upstream.calls == [0, 1]
+
+
+def test_cancelled_leader_does_not_cancel_followers():
+    upstream = Upstream()
+
+    async def scenario():
+        upstream.gate = asyncio.Event()
+        flights = SingleFlight()
+        leader = asyncio.ensure_future(flights.do("chat", "k", upstream.factory("r")))
+        follower = asyncio.ensure_future(flights.do("chat", "k", upstream.factory("r")))
+        await asyncio.sleep(0)
+        leader.cancel()
+        await asyncio.sleep(0)
+        upstream.gate.set()
+        return await follower, leader.cancelled()
+
+    (value, shared), leader_cancelled = run(scenario)
+    assert leader_cancelled
+    # 发起者被取消后，第一个拿到结果的跟随者不算跟随者
+    assert (value, shared) == ("r", False)
+    assert upstream.cancelled == 0
+
+
+def test_upstream_cancelled_when_all_waiters_leave():
+    upstream = Upstream()
+
+    async def scenario():
+        upstream.gate = asyncio.Event()
+        flights = SingleFlight()
+        tasks = [asyncio.ensure_future(flights.do("chat", "k", upstream.factory("r"))) for _ in range(2)]
+        await asyncio.sleep(0)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.sleep(0)
+        return flights.snapshot()
+
+    snapshot = run(scenario)
+    assert upstream.cancelled == 1
+    assert snapshot["in_flight"] == 0
+
+
+def test_join_right_after_last_waiter_cancels_starts_a_new_call():
+    upstream = Upstream()
+
+    async def scenario():
+        upstream.gate = asyncio.Event()
+        flights = SingleFlight()
+        waiter = asyncio.ensure_future(flights.do("chat", "k", upstream.factory("first")))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            pass
+        # 被取消的上游任务此时还没跑完 done 回调；紧接着加入的调用方不能等到这个正在取消的请求
+        upstream.gate.set()
+        return await flights.do("chat", "k", upstream.factory("second"))
+
+    assert run(scenario) == ("second", False)
+    assert upstream.calls == ["first", "second"]
+
+
+def test_errors_reach_every_waiter():
+    async def scenario():
+        flights = SingleFlight()
+        gate = asyncio.Event()
+
+        async def boom():
+            await gate.wait()
+            raise ValueError("upstream")
+
+        tasks = [asyncio.ensure_future(flights.do("chat", "k", boom)) for _ in range(2)]
+        await asyncio.sleep(0)
+        gate.set()
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    assert [type(result) for result in run(scenario)] == [ValueError, ValueError]
+
+
+def test_do_many_requests_only_keys_not_in_flight():
+    batches = []
+
+    async def scenario():
+        gate = asyncio.Event()
+        flights = SingleFlight()
+
+        def factory(keys):
+            async def call():
+                batches.append(list(keys))
+                await gate.wait()
+                return [f"v:{key}" for key in keys]
+            return call()
+
+        first = asyncio.ensure_future(flights.do_many("embedding", ["x", "y"], factory))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(flights.do_many("embedding", ["y", "z"], factory))
+        await asyncio.sleep(0)
+        gate.set()
+        return await first, await second, flights.snapshot()
+
+    first, second, snapshot = run(scenario)
+    assert batches == [["x", "y"], ["z"]]
+    assert first == (["v:x", "v:y"], 0)
+    assert second == (["v:y", "v:z"], 1)
+    assert snapshot["embedding"] == {"requests": 3, "coalesced": 1}
+
+
+def test_do_many_cancelled_caller_keeps_shared_batch():
+    batches = []
+
+    async def scenario():
+        gate = asyncio.Event()
+        flights = SingleFlight()
+
+        def factory(keys):
+            async def call():
+                batches.append(list(keys))
+                await gate.wait()
+                return [f"v:{key}" for key in keys]
+            return call()
+
+        first = asyncio.ensure_future(flights.do_many("embedding", ["x"], factory))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(flights.do_many("embedding", ["x"], factory))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        gate.set()
+        return await second
+
+    assert run(scenario) == (["v:x"], 1)
+    assert batches == [["x"]]
+
+
+def test_do_many_batch_cancelled_when_all_waiters_leave():
+    cancelled = []
+
+    async def scenario():
+        flights = SingleFlight()
+
+        def factory(keys):
+            async def call():
+                try:
+                    await asyncio.Event().wait()
+                except asyncio.CancelledError:
+                    cancelled.append(keys)
+                    raise
+            return call()
+
+        task = asyncio.ensure_future(flights.do_many("embedding", ["x", "y"], factory))
+        await asyncio.sleep(0)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await asyncio.sleep(0)
+
+    run(scenario)
+    assert cancelled == [["x", "y"]]